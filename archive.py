@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Binary archive of the sessions of all the participants, for longitudinal
+analyses. An archive is a folder with three files:
+ - trials.dat, the responses of all the sessions as fixed-width records
+   (TRIAL_DTYPE: result code, stimulus, correct answer, reaction time and
+   onset), appended session after session
+ - sessions.idx, one fixed-width record per session (INDEX_DTYPE: player
+   code, date, session number, mode and the extent of its trials in
+   trials.dat), sorted by player code and date, after a header with the
+   generation of the tail
+ - sessions-<generation>.tail, the records of the latest sessions, unsorted,
+   in the same format
+
+The files are memory-mapped as NumPy structured arrays, so the sessions of a
+participant are found by a binary search of the index and a scan of the tail
+(up to TAIL_LENGTH records), and their trials are views of the mapped file:
+nothing is parsed or copied, and the time does not depend on the size of the
+archive.
+
+A save appends the trials, and then their records to the tail, so it does not
+depend on the size of the archive either. When the tail is full, it is merged
+with the index, which is rewritten in full (O(N log N)) and replaced
+atomically with a header naming the next, empty, tail: once every
+TAIL_LENGTH sessions. The trials and the records are only appended after the
+complete records of the files (a crash may leave a partial one), and a record
+after its trials, so a crash leaves the archive as it was.
+
+    python archive.py import results.csv archive
+    python archive.py show archive P012
+    python archive.py summary archive
+
+The archive is also a results backend (RESULTS_STORAGE = "archive" in main.py).
+"""
+
+import os, sys, csv, glob, stat, time, argparse, datetime, tempfile
+import numpy as np
+import helpers
+from buffers import RESULT_CODES, RESULT_LETTERS
+from storage import ResultsBackend, AppendOnlyStore, iter_trials
+
+TRIALS_MAGIC = b'PASAT-TRIALS-v1\n'
+INDEX_MAGIC = b'PASAT-INDEX-v1\n\n'
+# The magic and the generation of the tail
+INDEX_HEADER_LENGTH = len(INDEX_MAGIC) + 8
+TAIL_MAGIC = b'PASAT-TAIL-v1\n\n\n'
+# The sessions saved before the tail is merged with the index
+TAIL_LENGTH = 1024
+# 12 bytes per response; missing reaction times and onsets are nan, unknown stimuli 0
+TRIAL_DTYPE = np.dtype([('result', 'i1'),
+                        ('stimulus', 'u1'),
+                        ('correct_answer', 'u1'),
+                        ('reserved', 'u1'),
+                        ('reaction_time', '<f4'),
+                        ('onset', '<f4')])
+PLAYER_CODE_LENGTH = 32
+# 57 bytes per session (INDEX_DTYPE.itemsize)
+INDEX_DTYPE = np.dtype([('player_code', 'S%d' % PLAYER_CODE_LENGTH),
+                        ('date', '<i8'), # seconds since the epoch
+                        ('session', '<u4'),
+                        ('mode', 'u1'),
+                        ('start', '<u8'), # the first trial in trials.dat
+                        ('n_trials', '<u4')])
+MODE_CODES = {'PASAT': 1, 'Addition': 2}
+MODE_NAMES = {code: mode for (mode, code) in MODE_CODES.items()}
+
+class ArchivedSession:
+    """
+    A session of the archive. trials is a read-only view of its records in
+    the mapped trials.dat.
+    """
+    __slots__ = ('player_code', 'date', 'session', 'mode', 'trials')
+
+    def __init__(self, entry, trials):
+        self.player_code = entry['player_code'].decode('utf-8')
+        self.date = datetime.datetime.fromtimestamp(int(entry['date']))
+        self.session = int(entry['session'])
+        self.mode = MODE_NAMES[int(entry['mode'])]
+        self.trials = trials
+
+    def results_list(self):
+        return [RESULT_LETTERS[code] for code in self.trials['result'].tolist()]
+
+    def reaction_times_list(self):
+        """
+        Returns the reaction times with 0 for the missing ones, as in the results file
+        """
+        return [0 if np.isnan(reaction_time) else round(reaction_time, 3)
+                for reaction_time in self.trials['reaction_time'].tolist()]
+
+class SessionArchive(ResultsBackend):
+    """
+    The archive in the folder archive_dirpath (created if needed)
+    """
+    def __init__(self, archive_dirpath):
+        self.archive_dirpath = archive_dirpath
+        self.trials_filepath = os.path.join(archive_dirpath, "trials.dat")
+        self.index_filepath = os.path.join(archive_dirpath, "sessions.idx")
+        os.makedirs(archive_dirpath, exist_ok=True)
+        with helpers.locked(self.index_filepath):
+            if not os.path.isfile(self.trials_filepath):
+                with open(self.trials_filepath, 'wb') as trials_file:
+                    trials_file.write(TRIALS_MAGIC)
+            if not os.path.isfile(self.index_filepath):
+                with open(self.index_filepath, 'wb') as index_file:
+                    index_file.write(INDEX_MAGIC + _generation_bytes(0))
+        self._mapped = None
+        self.trials = self.index = self.tail = None
+        self.refresh()
+
+    @staticmethod
+    def _map(filepath, header_length, dtype):
+        """
+        Maps the complete records of the file, after its header (a partial
+        record is left by a crash or being written)
+        """
+        try:
+            size = os.path.getsize(filepath) - header_length
+        except FileNotFoundError:
+            # A tail which is not started yet
+            size = 0
+        count = size // dtype.itemsize
+        if count <= 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filepath, dtype=dtype, mode='r', offset=header_length, shape=(count,))
+
+    def _generation(self):
+        with open(self.index_filepath, 'rb') as index_file:
+            return int.from_bytes(index_file.read(INDEX_HEADER_LENGTH)[len(INDEX_MAGIC):], 'little')
+
+    def _tail_filepath(self, generation):
+        return os.path.join(self.archive_dirpath, "sessions-%d.tail" % generation)
+
+    def refresh(self):
+        """
+        Maps the files again if they have been changed, e.g. by another process
+        """
+        tail_filepath = self._tail_filepath(self._generation())
+        try:
+            tail_size = os.stat(tail_filepath).st_size
+        except FileNotFoundError:
+            tail_size = 0
+        mapped = (os.stat(self.index_filepath).st_mtime_ns, tail_size, os.stat(self.trials_filepath).st_size)
+        if mapped != self._mapped:
+            # The records before the trials, so that all the trials of the
+            # sessions are mapped
+            self.index = self._map(self.index_filepath, INDEX_HEADER_LENGTH, INDEX_DTYPE)
+            self.tail = self._map(tail_filepath, len(TAIL_MAGIC), INDEX_DTYPE)
+            self.trials = self._map(self.trials_filepath, len(TRIALS_MAGIC), TRIAL_DTYPE)
+            self._mapped = mapped
+
+    def __len__(self):
+        """
+        Returns the number of sessions
+        """
+        return len(self.index) + len(self.tail)
+
+    def _session(self, entry):
+        start = int(entry['start'])
+        return ArchivedSession(entry, self.trials[start:start+int(entry['n_trials'])])
+
+    def participant(self, player_code):
+        """
+        Returns the sessions of the participant, by date
+        """
+        key = player_code.encode('utf-8')
+        codes = self.index['player_code']
+        first = np.searchsorted(codes, key, side='left')
+        last = np.searchsorted(codes, key, side='right')
+        entries = self.index[first:last]
+        latest = self.tail[self.tail['player_code'] == key]
+        if len(latest):
+            entries = _sorted_entries(np.concatenate([entries, latest]))
+        return [self._session(entry) for entry in entries]
+
+    def sessions(self):
+        """
+        Yields all the sessions, by player code and date
+        """
+        entries = self.index
+        if len(self.tail):
+            entries = _sorted_entries(np.concatenate([self.index, self.tail]))
+        for entry in entries:
+            yield self._session(entry)
+
+    def player_codes(self):
+        codes = np.concatenate([self.index['player_code'], self.tail['player_code']])
+        return [code.decode('utf-8') for code in np.unique(codes).tolist()]
+
+    ### Writing
+    def add_sessions(self, sessions):
+        """
+        Adds sessions, an iterable of (player code, date (datetime), session
+        number, mode ('PASAT'/'Addition'), trials (a TRIAL_DTYPE array)). All
+        the sessions are checked before anything is written (ValueError).
+        The trials are appended to trials.dat, then their records to the
+        tail, which is merged with the index when it is full.
+        """
+        checked = []
+        for (player_code, date, session, mode, trials) in sessions:
+            player_code = player_code.encode('utf-8')
+            if len(player_code) > PLAYER_CODE_LENGTH:
+                raise ValueError("Player codes are up to %d bytes in the archive" % PLAYER_CODE_LENGTH)
+            if mode not in MODE_CODES:
+                raise ValueError("Unknown mode: %s" % mode)
+            checked.append((player_code, int(date.timestamp()), session, MODE_CODES[mode],
+                            np.asarray(trials, dtype=TRIAL_DTYPE)))
+        if not checked:
+            return
+        with helpers.locked(self.index_filepath):
+            entries = []
+            with open(self.trials_filepath, 'r+b') as trials_file:
+                start = _truncate_partial_record(trials_file, len(TRIALS_MAGIC), TRIAL_DTYPE)
+                for (player_code, date, session, mode, trials) in checked:
+                    trials_file.write(trials.tobytes())
+                    entries.append((player_code, date, session, mode, start, len(trials)))
+                    start += len(trials)
+                trials_file.flush()
+                os.fsync(trials_file.fileno())
+            generation = self._generation()
+            tail_filepath = self._tail_filepath(generation)
+            with open(tail_filepath, 'ab') as tail_file:
+                if tail_file.tell() == 0:
+                    tail_file.write(TAIL_MAGIC)
+            with open(tail_filepath, 'r+b') as tail_file:
+                n_latest = _truncate_partial_record(tail_file, len(TAIL_MAGIC), INDEX_DTYPE)
+                tail_file.write(np.array(entries, dtype=INDEX_DTYPE).tobytes())
+                tail_file.flush()
+                os.fsync(tail_file.fileno())
+            if n_latest + len(entries) >= TAIL_LENGTH:
+                self._merge_tail(generation)
+        self.refresh()
+
+    def _merge_tail(self, generation):
+        """
+        Merges the tail of the generation with the index, which is replaced at
+        once by the sorted sessions and the next generation, with an empty
+        tail. Called with the index locked.
+        """
+        index = self._map(self.index_filepath, INDEX_HEADER_LENGTH, INDEX_DTYPE)
+        tail = self._map(self._tail_filepath(generation), len(TAIL_MAGIC), INDEX_DTYPE)
+        index = _sorted_entries(np.concatenate([index, tail]))
+        temp_fd, temp_filepath = tempfile.mkstemp(suffix='.tmp', dir=self.archive_dirpath)
+        with os.fdopen(temp_fd, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC + _generation_bytes(generation + 1))
+            index_file.write(index.tobytes())
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        del index, tail
+        # Keep the permissions of the index
+        os.chmod(temp_filepath, stat.S_IMODE(os.stat(self.index_filepath).st_mode))
+        os.replace(temp_filepath, self.index_filepath)
+        # The merged tails are no longer read (one left by a crash, or still
+        # mapped by a reader on Windows, is removed at the next merge)
+        next_tail_filepath = self._tail_filepath(generation + 1)
+        for tail_filepath in glob.glob(os.path.join(self.archive_dirpath, "sessions-*.tail")):
+            if tail_filepath != next_tail_filepath:
+                try:
+                    os.remove(tail_filepath)
+                except OSError:
+                    pass
+
+    def save_session(self, player_name, player_code, session_ids, modes, all_results, all_reaction_times,
+                     all_onsets=None, all_dispatch_latencies=None, all_stimuli=None, all_stats=None,
+                     all_keystroke_latencies=None):
+        all_onsets = all_onsets or {}
+        all_stimuli = all_stimuli or {}
+        date = datetime.datetime.now()
+        self.add_sessions([(player_code, date, session_ids[mode], mode,
+                            encode_trials(mode, all_results[mode], all_reaction_times[mode],
+                                          all_onsets.get(mode), all_stimuli.get(mode)))
+                           for mode in modes])
+
+def _generation_bytes(generation):
+    return generation.to_bytes(8, 'little')
+
+def _sorted_entries(entries):
+    return np.sort(entries, order=['player_code', 'date', 'session', 'mode'], kind='stable')
+
+def _truncate_partial_record(file, header_length, dtype):
+    """
+    Truncates the partial record (if any) at the end of file, left by a crash,
+    and moves to the end. Returns the number of complete records.
+    """
+    size = file.seek(0, os.SEEK_END)
+    count = (size - header_length) // dtype.itemsize
+    complete_size = header_length + count * dtype.itemsize
+    if complete_size != size:
+        file.truncate(complete_size)
+        file.seek(complete_size)
+    return count
+
+def encode_trials(mode, results, reaction_times, onsets=None, stimuli=None):
+    """
+    Returns the trials of a session as a TRIAL_DTYPE array (see storage.iter_trials)
+    """
+    return np.array([(RESULT_CODES[trial['result']], trial['stimulus'] or 0, trial['correct_answer'] or 0, 0,
+                      np.nan if trial['reaction_time'] is None else trial['reaction_time'],
+                      np.nan if trial['actual_onset'] is None else trial['actual_onset'])
+                     for trial in iter_trials(mode, results, reaction_times, None, onsets, stimuli)],
+                    dtype=TRIAL_DTYPE)
+
+### Import
+def _list_column(value):
+    """
+    Returns a list column of a results row, which is a string in the CSV files
+    """
+    if isinstance(value, list):
+        return value
+    # Imported here, as cohort is only needed for the import
+    from cohort import iter_list_items
+    return list(iter_list_items(value or ''))
+
+def iter_row_sessions(rows):
+    """
+    Yields the sessions of the rows of a results file (or the records of an
+    append-only store) in the format of SessionArchive.add_sessions. The
+    results files have no stimuli or onsets per trial, which are left unknown.
+    """
+    for row in rows:
+        try:
+            date = datetime.datetime.strptime(row['Date'] + ' ' + row['Time'], "%Y %B %d %I:%M:%S %p")
+        except (KeyError, TypeError, ValueError):
+            date = datetime.datetime.fromtimestamp(0)
+        for mode in helpers.PREFIXES:
+            results = _list_column(row.get(mode + " results list"))
+            if not results:
+                continue
+            reaction_times = _list_column(row.get(mode + " reaction times"))
+            yield (row['Player Code'], date, int(row.get('Session') or 1), mode,
+                   encode_trials(mode, results, reaction_times))
+
+def import_results(archive, filepath, batch_size=1000):
+    """
+    Adds the sessions of a results CSV file or an append-only results log
+    (.log) to the archive, batch_size sessions at a time. Returns the number
+    of sessions added.
+    """
+    if filepath.endswith('.log'):
+        rows = AppendOnlyStore(filepath).records()
+        csvfile = None
+    else:
+        csvfile = open(filepath, 'r', newline='', encoding='utf-8', errors='replace')
+        rows = csv.DictReader(csvfile, dialect='excel')
+    n_sessions = 0
+    batch = []
+    try:
+        for session in iter_row_sessions(rows):
+            batch.append(session)
+            if len(batch) == batch_size:
+                archive.add_sessions(batch)
+                n_sessions += len(batch)
+                batch = []
+        archive.add_sessions(batch)
+        n_sessions += len(batch)
+    finally:
+        if csvfile is not None:
+            csvfile.close()
+    return n_sessions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage a PASAT session archive")
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import', help="Add the sessions of results files to an archive")
+    import_parser.add_argument('results', nargs='+', help="results CSV files or append-only logs (.log)")
+    import_parser.add_argument('archive')
+    show_parser = subparsers.add_parser('show', help="Show the sessions of a participant")
+    show_parser.add_argument('archive')
+    show_parser.add_argument('player_code')
+    summary_parser = subparsers.add_parser('summary', help="Show the size of an archive")
+    summary_parser.add_argument('archive')
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        archive = SessionArchive(args.archive)
+        for filepath in args.results:
+            print("%s: %d sessions" % (filepath, import_results(archive, filepath)))
+    elif args.command == 'show':
+        archive = SessionArchive(args.archive)
+        started = time.perf_counter()
+        sessions = archive.participant(args.player_code)
+        elapsed = time.perf_counter() - started
+        for session in sessions:
+            answered = session.trials['reaction_time']
+            print("%s session %d, %s: %d trials, %d correct, mean reaction time %.3f s"
+                  % (session.date.strftime("%Y-%m-%d %H:%M"), session.session, session.mode, len(session.trials),
+                     int((session.trials['result'] == RESULT_CODES['C']).sum()),
+                     float(np.nanmean(answered)) if (~np.isnan(answered)).any() else 0))
+        print("%d sessions found in %.3f ms" % (len(sessions), elapsed * 1000))
+    elif args.command == 'summary':
+        archive = SessionArchive(args.archive)
+        print("%d participants, %d sessions, %d trials (%d bytes)"
+              % (len(archive.player_codes()), len(archive), len(archive.trials),
+                 len(archive.trials) * TRIAL_DTYPE.itemsize))
+    else:
+        parser.print_help()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
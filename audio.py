@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+In-process audio engine for the stimuli. All the audio/<language>/*.wav
+files are decoded into memory once at startup, a single output stream is
+kept open for the whole session, and starting a stimulus is a non-blocking
+call that only swaps the buffer the stream is reading from. A whole session
+can also be rendered into one track (render_track), whose playback position
+(position) is then the clock of the stimuli. The converted and normalized
+clips can be cached on disk (ClipCache), so later launches only read them.
+"""
+
+import os, wave, threading, time, hashlib
+from collections import namedtuple
+import numpy as np
+
+# Every clip is converted to this format when it is loaded, so that one output
+# stream can play the stimuli of all languages
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2 # bytes, i.e. 16-bit PCM
+SAMPLE_DTYPE = np.dtype('<i%d' % SAMPLE_WIDTH)
+FULL_SCALE = 2 ** (8 * SAMPLE_WIDTH - 1) - 1
+# Every clip is scaled to this peak (fraction of the full scale) when it is
+# loaded, so that the stimuli of all languages are equally loud
+NORMALIZED_PEAK = 0.9
+
+Clip = namedtuple('Clip', ['frames', 'n_frames', 'duration'])
+
+class AudioUnavailableError(RuntimeError):
+    """
+    Raised when the stimuli cannot be played, e.g. without sounddevice or an output device
+    """
+
+def decode_samples(frames, sample_width):
+    """
+    Returns raw little-endian PCM frames of sample_width bytes (8-bit WAV
+    samples are unsigned) as an array of floats on the scale of SAMPLE_WIDTH
+    """
+    if sample_width == 1:
+        samples = np.frombuffer(frames, dtype=np.uint8).astype(np.float64) - 128
+    elif sample_width == 3:
+        # Sign-extended by placing the 3 bytes in the top of 4
+        padded = np.zeros((len(frames) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(frames, dtype=np.uint8)[:len(padded) * 3].reshape(-1, 3)
+        samples = padded.view('<i4').ravel().astype(np.float64) / 2 ** 8
+    else:
+        samples = np.frombuffer(frames, dtype='<i%d' % sample_width).astype(np.float64)
+    return samples * 2 ** (8 * (SAMPLE_WIDTH - sample_width))
+
+def encode_samples(samples):
+    """
+    Returns an array of samples on the scale of SAMPLE_WIDTH as raw PCM frames,
+    clipped to the full scale
+    """
+    return np.clip(np.round(samples), -FULL_SCALE - 1, FULL_SCALE).astype(SAMPLE_DTYPE).tobytes()
+
+def convert_frames(frames, sample_rate, channels, sample_width):
+    """
+    Converts raw PCM frames to the stream format (SAMPLE_RATE, CHANNELS and
+    SAMPLE_WIDTH), e.g. the mono Farsi recordings to stereo. The sample rate
+    is converted by linear interpolation.
+    """
+    samples = decode_samples(frames, sample_width)
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    if sample_rate != SAMPLE_RATE and len(samples):
+        n_frames = int(round(len(samples) * SAMPLE_RATE / sample_rate))
+        times = np.arange(n_frames) * (sample_rate / SAMPLE_RATE)
+        samples = np.column_stack([np.interp(times, np.arange(len(samples)), samples[:, channel])
+                                   for channel in range(channels)])
+    if channels == 1 and CHANNELS == 2:
+        samples = np.repeat(samples, 2, axis=1)
+    elif channels == 2 and CHANNELS == 1:
+        samples = samples.mean(axis=1, keepdims=True)
+    return encode_samples(samples.ravel())
+
+def normalize_frames(frames, peak=NORMALIZED_PEAK):
+    """
+    Scales the frames (in the stream format) so that their peak is peak times
+    the full scale. Silent frames are returned as they are.
+    """
+    samples = np.frombuffer(frames, dtype=SAMPLE_DTYPE).astype(np.float64)
+    current_peak = np.abs(samples).max() if len(samples) else 0
+    if not current_peak:
+        return frames
+    return encode_samples(samples * (peak * FULL_SCALE / current_peak))
+
+def make_clip(frames):
+    n_frames = len(frames) // (CHANNELS * SAMPLE_WIDTH)
+    return Clip(frames, n_frames, n_frames / SAMPLE_RATE)
+
+def load_wav(filepath, peak=NORMALIZED_PEAK):
+    """
+    Decodes a WAV file and returns it as a Clip in the stream format,
+    normalized to peak (not normalized if peak is None)
+    """
+    with wave.open(filepath, 'rb') as wav:
+        frames = wav.readframes(wav.getnframes())
+        frames = convert_frames(frames, wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+    if peak is not None:
+        frames = normalize_frames(frames, peak)
+    return make_clip(frames)
+
+class ClipCache:
+    """
+    Caches the clips, converted to the stream format and normalized, as raw
+    PCM files in cache_dir (the clips folder in the user cache folder by
+    default). A cached clip is named by the hash of the WAV file and of the
+    format, so it is converted again if either of them changes.
+    """
+    def __init__(self, cache_dir=None, peak=NORMALIZED_PEAK):
+        if cache_dir is None:
+            from helpers import user_cache_dir
+            cache_dir = os.path.join(user_cache_dir(), "clips")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.peak = peak
+
+    def cache_filepath(self, wav_bytes):
+        key = hashlib.sha1(wav_bytes)
+        key.update(repr((SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH, self.peak)).encode())
+        return os.path.join(self.cache_dir, key.hexdigest() + ".pcm")
+
+    def load(self, filepath):
+        """
+        Returns the clip of the WAV file, from the cache if possible
+        """
+        with open(filepath, 'rb') as wav_file:
+            cache_filepath = self.cache_filepath(wav_file.read())
+        if os.path.isfile(cache_filepath):
+            with open(cache_filepath, 'rb') as cache_file:
+                return make_clip(cache_file.read())
+        clip = load_wav(filepath, self.peak)
+        # Written to a temporary file first, so a partly written clip is never read
+        temp_filepath = cache_filepath + ".%d.tmp" % os.getpid()
+        with open(temp_filepath, 'wb') as cache_file:
+            cache_file.write(clip.frames)
+        os.replace(temp_filepath, cache_filepath)
+        return clip
+
+### Sinks
+class NullSink:
+    """
+    Discards the audio, but keeps a log of what would have been played and when
+    (as time.perf_counter() values). Useful for running the test headless.
+    The playback position advances with time.perf_counter_ns(), as if the
+    audio was played without latency.
+    """
+    def __init__(self):
+        self.played = []
+        self.is_open = False
+        self._n_frames = 0
+        self._started_ns = None
+        self._paused_ns = None
+    def open(self, sample_rate, channels, sample_width):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.is_open = True
+    def play(self, frames):
+        self.played.append((time.perf_counter(), len(frames)))
+        self._n_frames = len(frames) // (self.channels * self.sample_width)
+        self._started_ns = time.perf_counter_ns()
+        self._paused_ns = None
+    def position(self):
+        """
+        Returns the number of frames of the current buffer that have been
+        played, as a float, and the time.perf_counter_ns() it was measured at
+        """
+        now_ns = time.perf_counter_ns()
+        if self._started_ns is None:
+            return 0.0, now_ns
+        end_ns = self._paused_ns if self._paused_ns is not None else now_ns
+        return min(self._n_frames, (end_ns - self._started_ns) * self.sample_rate / 1e9), now_ns
+    def pause(self):
+        if self._paused_ns is None:
+            self._paused_ns = time.perf_counter_ns()
+    def resume(self):
+        if self._paused_ns is not None:
+            if self._started_ns is not None:
+                self._started_ns += time.perf_counter_ns() - self._paused_ns
+            self._paused_ns = None
+    def stop(self):
+        self._started_ns = None
+        self._n_frames = 0
+    def close(self):
+        self.is_open = False
+
+class FileSink(NullSink):
+    """
+    Writes everything that is played, back to back, into a WAV file.
+    """
+    def __init__(self, filepath):
+        super().__init__()
+        self.filepath = filepath
+        self.wav = None
+    def open(self, sample_rate, channels, sample_width):
+        super().open(sample_rate, channels, sample_width)
+        self.wav = wave.open(self.filepath, 'wb')
+        self.wav.setframerate(sample_rate)
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(sample_width)
+    def play(self, frames):
+        super().play(frames)
+        self.wav.writeframes(frames)
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+        super().close()
+
+class SoundDeviceSink:
+    """
+    Plays the audio through one sounddevice output stream that is opened once
+    and kept running. The stream callback reads from the current buffer, so
+    play() only replaces the buffer and returns immediately. The callback also
+    notes when the block it fills will reach the DAC, from which the playback
+    position is extrapolated.
+    """
+    def __init__(self, device=None, latency='low'):
+        self.device = device
+        self.latency = latency
+        self.stream = None
+        self._lock = threading.Lock()
+        self._buffer = b''
+        self._position = 0
+        self._paused = False
+        # (perf_counter_ns when the last block reaches the DAC, its first frame, its frames)
+        self._last_block = None
+    def open(self, sample_rate, channels, sample_width):
+        try:
+            import sounddevice
+        except ImportError:
+            raise AudioUnavailableError("sounddevice is not installed")
+        except OSError as error: # the PortAudio library is not found
+            raise AudioUnavailableError("the PortAudio library cannot be loaded (%s)" % error)
+        self.sample_rate = sample_rate
+        self.frame_size = channels * sample_width
+        try:
+            self.stream = sounddevice.RawOutputStream(samplerate=sample_rate, channels=channels,
+                                                      dtype='int%d' % (8*sample_width),
+                                                      device=self.device, latency=self.latency,
+                                                      callback=self._callback)
+            self.stream.start()
+        except sounddevice.PortAudioError as error:
+            raise AudioUnavailableError("the audio output cannot be opened (%s)" % error)
+    def _callback(self, outdata, frames, time_info, status):
+        n_bytes = frames * self.frame_size
+        dac_ns = time.perf_counter_ns() + int((time_info.outputBufferDacTime - time_info.currentTime) * 1e9)
+        with self._lock:
+            if self._paused:
+                chunk = b''
+            else:
+                chunk = self._buffer[self._position:self._position+n_bytes]
+                self._last_block = (dac_ns, self._position // self.frame_size, len(chunk) // self.frame_size)
+            self._position += len(chunk)
+        outdata[:len(chunk)] = chunk
+        # Pad with silence when the buffer has been played completely
+        if len(chunk) < n_bytes:
+            outdata[len(chunk):] = bytes(n_bytes - len(chunk))
+    def play(self, frames):
+        # A new buffer is played from its start, even after a pause (as NullSink)
+        with self._lock:
+            self._buffer = frames
+            self._position = 0
+            self._last_block = None
+            self._paused = False
+    def position(self):
+        """
+        Returns the number of frames of the current buffer that have reached
+        the DAC, as a float, and the time.perf_counter_ns() it was measured at
+        """
+        now_ns = time.perf_counter_ns()
+        with self._lock:
+            if self._last_block is None:
+                return 0.0, now_ns
+            dac_ns, first_frame, n_frames = self._last_block
+        played = (now_ns - dac_ns) * self.sample_rate / 1e9
+        return first_frame + min(max(played, 0), n_frames), now_ns
+    def pause(self):
+        with self._lock:
+            self._paused = True
+    def resume(self):
+        with self._lock:
+            self._paused = False
+    def stop(self):
+        self.play(b'')
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+def default_sink():
+    """
+    Returns a SoundDeviceSink, which raises AudioUnavailableError when it is
+    opened without sounddevice or an output device. There is no fallback to a
+    NullSink, which has to be asked for explicitly (e.g. with --no-audio in
+    main.py), as a session without sound is not a valid test.
+    """
+    return SoundDeviceSink()
+
+### Engine
+class AudioEngine:
+    """
+    Keeps the decoded stimuli of all languages in memory and plays them
+    through a single sink. The clips are loaded through clip_cache (ClipCache)
+    if it is given. If a speech_index (speech.SpeechIndex) is given, the speech
+    onset and offset of every stimulus are looked up when it is loaded.
+    """
+    def __init__(self, audio_dir, sink=None, speech_index=None, clip_cache=None):
+        self.audio_dir = audio_dir
+        self.sink = sink if sink is not None else default_sink()
+        self.speech_index = speech_index
+        self.clip_cache = clip_cache
+        self.sample_rate = SAMPLE_RATE
+        self.clips = {}
+        # (onset, offset) of the speech of each stimulus in seconds, if speech_index is given
+        self.speech = {}
+        self.sink.open(SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH)
+
+    def languages(self):
+        """
+        Returns the languages with a folder in audio_dir
+        """
+        return sorted(name for name in os.listdir(self.audio_dir)
+                      if os.path.isdir(os.path.join(self.audio_dir, name)))
+
+    def preload(self, languages=None):
+        """
+        Decodes all the stimuli of the languages (all available languages by default)
+        """
+        if languages is None:
+            languages = self.languages()
+        for language in languages:
+            language_dir = os.path.join(self.audio_dir, language)
+            for filename in os.listdir(language_dir):
+                number, ext = os.path.splitext(filename)
+                if ext.lower() == '.wav' and number.isdigit():
+                    filepath = os.path.join(language_dir, filename)
+                    clip = self.clip_cache.load(filepath) if self.clip_cache is not None else load_wav(filepath)
+                    self.clips[(language, int(number))] = clip
+                    if self.speech_index is not None:
+                        self.speech[(language, int(number))] = self.speech_index.get(filepath, clip, SAMPLE_RATE,
+                                                                                     CHANNELS, SAMPLE_WIDTH)
+        if self.speech_index is not None:
+            self.speech_index.save()
+
+    def loaded_languages(self):
+        return {language for (language, number) in self.clips}
+
+    def clip(self, language, number):
+        if (language, number) not in self.clips:
+            self.preload([language])
+        return self.clips[(language, number)]
+
+    def duration(self, language, number):
+        """
+        Returns the duration of the stimulus in seconds
+        """
+        return self.clip(language, number).duration
+
+    def reference_offsets(self, language, reference="stimulus"):
+        """
+        Returns the time from the start of each stimulus of the language to its
+        reference (one of speech.RT_REFERENCES) as {number: seconds}, to measure
+        the reaction times from the speech onset or offset instead of the start
+        """
+        if reference == "stimulus":
+            return {}
+        if self.speech_index is None:
+            raise ValueError("The speech onsets are not available without a speech index")
+        if not any(key[0] == language for key in self.speech):
+            self.preload([language])
+        index = 0 if reference == "speech onset" else 1
+        return {number: times[index] for ((clip_language, number), times) in self.speech.items()
+                if clip_language == language}
+
+    def play(self, language, number):
+        """
+        Starts playing the stimulus and returns immediately
+        """
+        self.sink.play(self.clip(language, number).frames)
+
+    def render_track(self, language, numbers, interval):
+        """
+        Renders the stimuli of numbers into one track, each one starting at the
+        frame of its onset (number index at index * interval seconds), followed
+        by silence until the end of the last interval. Returns the track and
+        the onsets in frames.
+        """
+        onsets = [int(round(index * interval * SAMPLE_RATE)) for index in range(len(numbers) + 1)]
+        n_frames = onsets[-1]
+        for onset, number in zip(onsets, numbers):
+            n_frames = max(n_frames, onset + self.clip(language, number).n_frames)
+        # Mixed in a wider type, in case a stimulus is longer than the interval
+        track = np.zeros(n_frames * CHANNELS, dtype=np.int32)
+        for onset, number in zip(onsets, numbers):
+            samples = np.frombuffer(self.clip(language, number).frames, dtype=SAMPLE_DTYPE)
+            start = onset * CHANNELS
+            track[start:start+len(samples)] += samples
+        return encode_samples(track), onsets
+
+    def play_track(self, track):
+        """
+        Starts playing a track rendered by render_track and returns immediately
+        """
+        self.sink.play(track)
+
+    def position(self):
+        """
+        Returns the playback position of the current track or stimulus (frames,
+        as a float) and the time.perf_counter_ns() it was measured at
+        """
+        return self.sink.position()
+
+    def pause(self):
+        self.sink.pause()
+
+    def resume(self):
+        self.sink.resume()
+
+    def stop(self):
+        self.sink.stop()
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Timing-accuracy benchmarks of the stimulus threads, run under offscreen Qt
+with the audio discarded (audio.NullSink):
+
+    python benchmarks.py --interval 0.1 --stimuli 60 120 600 --output benchmarks.json
+
+For PlayNumbersThread, PlayTrackThread and PlayDemoThread, every run of n stimuli reports the
+error of the inter-stimulus intervals (ISI), the cumulative drift of the
+onsets, the latency of the signals reaching the main thread, and the error of
+the reaction times measured from synthetic key events posted at known times
+(through timing.EventTimestampMapper and SessionEngine, as in Window). The
+jitter of the QTimer that samples the session clock for the timer_label is
+reported too, and the startup time of main.py until its first paint (with
+--profile-startup). Finally, a number of processes save to the same results
+CSV file at once (helpers.update_csv), to check that no row is lost. The
+results are written as JSON, to compare them across releases.
+"""
+
+import os, sys, csv, json, math, time, random, platform, argparse, datetime, subprocess, tempfile, multiprocessing
+from collections import OrderedDict
+# Must be set before Qt is imported
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication, QWidget
+from PyQt5 import QtCore, QtGui
+import timing
+from audio import AudioEngine, NullSink
+from engine import SessionEngine
+import helpers
+from helpers import resource_path
+from threads import PlayNumbersThread, PlayDemoThread, PlayTrackThread
+
+def summary(errors):
+    """
+    Returns the mean, standard deviation and maximum absolute value of errors
+    """
+    if not errors:
+        return OrderedDict([('n', 0), ('mean', None), ('sd', None), ('max_abs', None)])
+    mean = sum(errors) / len(errors)
+    sd = math.sqrt(sum((error - mean)**2 for error in errors) / len(errors))
+    return OrderedDict([('n', len(errors)), ('mean', mean), ('sd', sd),
+                        ('max_abs', max(abs(error) for error in errors))])
+
+class ResponseProbe(QWidget):
+    """
+    Receives the synthetic key events and submits them to the engine the way
+    Window does: the time of the response is the timestamp of the event, mapped
+    onto the session clock. Keeps the true and the measured reaction times.
+    """
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self.event_time_mapper = timing.EventTimestampMapper()
+        self.true_reaction_times = []
+        self.measured_reaction_times = []
+        self._true_times = {}
+
+    def post_answer(self, answer):
+        """
+        Posts a key event with the answer, timestamped now, to the event queue
+        """
+        event = QtGui.QKeyEvent(QtCore.QEvent.KeyPress, QtCore.Qt.Key_Return, QtCore.Qt.NoModifier, str(answer))
+        now_ns = time.perf_counter_ns()
+        event.setTimestamp(now_ns // 1000000)
+        self._true_times[event.timestamp()] = (now_ns, self.engine.time_presented)
+        QApplication.postEvent(self, event)
+
+    def keyPressEvent(self, e):
+        response_time, dispatch_latency = self.event_time_mapper.map(e.timestamp(), self.engine.clock)
+        if self.engine.respond(e.text(), response_time, dispatch_latency) is None:
+            return
+        true_ns, time_presented = self._true_times.pop(e.timestamp())
+        self.true_reaction_times.append(self.engine.clock.to_session_ns(true_ns) / 1e9 - time_presented)
+        self.measured_reaction_times.append(response_time - time_presented)
+
+def run_thread(thread_class, n_stimuli, interval, audio_engine, rng):
+    """
+    Runs a session of n_stimuli with a thread of thread_class (PlayNumbersThread,
+    PlayTrackThread or PlayDemoThread), answers every stimulus with a synthetic key event after
+    a random reaction time, and returns the results of the run
+    """
+    mode = 'PASAT' if issubclass(thread_class, PlayNumbersThread) else 'Demo'
+    clock = timing.SessionClock()
+    engine = SessionEngine(mode, n_stimuli, interval, clock=clock, rng=rng)
+    if mode == 'PASAT':
+        thread = thread_class(engine.stimuli, interval, 'en', audio_engine, clock)
+        new_stimulus = thread.new_number
+    else:
+        thread = PlayDemoThread(engine.stimuli, interval, clock)
+        new_stimulus = thread.new_pair
+    probe = ResponseProbe(engine)
+    signal_latencies = []
+
+    def on_stimulus(stimulus, onset):
+        signal_latencies.append(clock.elapsed() - onset)
+        engine.present(stimulus, onset)
+        if engine.accepting:
+            reaction_time = rng.uniform(0.2, 0.7) * interval
+            delay = max(0, onset + reaction_time - clock.elapsed())
+            QtCore.QTimer.singleShot(int(round(delay * 1000)), QtCore.Qt.PreciseTimer,
+                                     lambda: probe.post_answer(engine.correct_answer()))
+    new_stimulus.connect(on_stimulus)
+    loop = QtCore.QEventLoop()
+    thread.finished.connect(loop.quit)
+    thread.start()
+    loop.exec_()
+    thread.wait()
+    engine.finish(thread.scheduler.onsets())
+
+    onsets = thread.scheduler.onsets()
+    actual_onsets = [actual for (planned, actual) in onsets]
+    isi_errors = [1000 * (later - earlier - interval) for (earlier, later) in zip(actual_onsets, actual_onsets[1:])]
+    onset_errors = timing.onset_errors(onsets)
+    reaction_time_errors = [1000 * (measured - true) for (measured, true) in
+                            zip(probe.measured_reaction_times, probe.true_reaction_times)]
+    return OrderedDict([('n_stimuli', n_stimuli),
+                        ('isi_error_ms', summary(isi_errors)),
+                        ('onset_error_ms', summary(onset_errors)),
+                        # The onset error of the last stimulus, i.e. the drift accumulated over the run
+                        ('cumulative_drift_ms', onset_errors[-1] if onset_errors else None),
+                        ('signal_latency_ms', summary([1000 * latency for latency in signal_latencies])),
+                        ('reaction_time_error_ms', summary(reaction_time_errors)),
+                        ('responses_missed', len(engine.results) - len(reaction_time_errors))])
+
+def run_session_timer(n_ticks, tick_interval=100):
+    """
+    Runs the QTimer which samples the session clock for the timer_label (a
+    tick every tick_interval ms, as in Window) for n_ticks, and returns the
+    error of the intervals between the ticks
+    """
+    clock = timing.SessionClock()
+    clock.start()
+    ticks = []
+    timer = QtCore.QTimer()
+    timer.setInterval(tick_interval)
+    loop = QtCore.QEventLoop()
+    def on_tick():
+        ticks.append(clock.elapsed())
+        if len(ticks) > n_ticks:
+            timer.stop()
+            loop.quit()
+    timer.timeout.connect(on_tick)
+    timer.start()
+    loop.exec_()
+    tick_errors = [1000 * (later - earlier) - tick_interval for (earlier, later) in zip(ticks, ticks[1:])]
+    return OrderedDict([('n_ticks', n_ticks), ('tick_interval_ms', tick_interval),
+                        ('tick_error_ms', summary(tick_errors))])
+
+def run_startup(n_runs):
+    """
+    Starts main.py n_runs times with --profile-startup --exit-after-startup
+    --no-audio, and returns the wall time of the runs and the mean time of
+    each phase. The runs are in a temporary working directory, so the results
+    files and the journal of the installation are not touched, with an empty
+    cache folder: the first run is a cold start (the clips are converted and
+    cached), and the others are warm starts.
+    """
+    runs = []
+    main_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        profile_filepath = os.path.join(temp_dir, "startup_profile.json")
+        env = dict(os.environ, PASAT_CACHE_DIR=os.path.join(temp_dir, "cache"))
+        for dummy in range(n_runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, main_filepath, "--profile-startup=" + profile_filepath,
+                            "--exit-after-startup", "--no-audio"], cwd=temp_dir, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wall_time = 1000 * (time.perf_counter() - started)
+            with open(profile_filepath, 'r', encoding='utf-8') as profile_file:
+                runs.append((wall_time, json.load(profile_file)['phases']))
+    def phase_means(runs):
+        phase_times = OrderedDict()
+        for wall_time, phases in runs:
+            for phase in phases:
+                phase_times.setdefault(phase['phase'], []).append(phase['ms'])
+        return OrderedDict((phase, sum(times) / len(times)) for (phase, times) in phase_times.items())
+    warm_runs = runs[1:]
+    return OrderedDict([('n_runs', n_runs),
+                        ('cold_wall_ms', runs[0][0]),
+                        ('cold_phases_ms', phase_means(runs[:1])),
+                        ('wall_ms', summary([wall_time for (wall_time, phases) in warm_runs])),
+                        ('phases_ms', phase_means(warm_runs))])
+
+def _save_csv_rows(csv_filepath, writer_index, n_saves):
+    """
+    Saves n_saves sessions with distinct player codes to csv_filepath
+    """
+    rng = random.Random(writer_index)
+    for index in range(n_saves):
+        results = [rng.choice('CIN') for dummy in range(60)]
+        reaction_times = [round(rng.uniform(0.5, 2.5), 3) if result == 'C' else 0 for result in results]
+        helpers.update_csv(csv_filepath, '', "writer%d-%d" % (writer_index, index), {'Addition': [], 'PASAT': results},
+                           {'Addition': [], 'PASAT': reaction_times}, ['PASAT'], {'Addition': 1, 'PASAT': 1})
+
+def run_csv_writers(n_processes, n_saves):
+    """
+    Runs n_processes processes saving n_saves sessions each to the same results
+    CSV file at once, and returns the number of rows lost and duplicated, of
+    temporary files left and of processes which failed (all 0 if the saves
+    are safe)
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_filepath = os.path.join(temp_dir, "results.csv")
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=_save_csv_rows, args=(csv_filepath, writer_index, n_saves))
+                     for writer_index in range(n_processes)]
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+        player_codes = []
+        # Not written if all the processes failed
+        if os.path.isfile(csv_filepath):
+            with open(csv_filepath, 'r', newline='') as csvfile:
+                player_codes = [row['Player Code'] for row in csv.DictReader(csvfile, dialect='excel')]
+        expected = {"writer%d-%d" % (writer_index, index)
+                    for writer_index in range(n_processes) for index in range(n_saves)}
+        # Temporary files left behind by the writers
+        leftovers = [filename for filename in os.listdir(temp_dir) if filename.endswith('.tmp')]
+    return OrderedDict([('processes', n_processes),
+                        ('saves_per_process', n_saves),
+                        ('rows', len(player_codes)),
+                        ('rows_lost', len(expected - set(player_codes))),
+                        ('duplicate_rows', len(player_codes) - len(set(player_codes))),
+                        ('temporary_files_left', len(leftovers)),
+                        ('failed_processes', sum(process.exitcode != 0 for process in processes)),
+                        ('seconds', elapsed)])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the timing accuracy of the stimulus threads")
+    parser.add_argument('--interval', type=float, default=0.1, help="seconds between the stimuli (default 0.1)")
+    parser.add_argument('--stimuli', type=int, nargs='+', default=[60, 120, 600],
+                        help="numbers of stimuli of the runs (default 60 120 600)")
+    parser.add_argument('--ticks', type=int, default=100, help="ticks of the session clock timer (default 100)")
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help="number of times main.py is started to measure the startup time (default 5)")
+    parser.add_argument('--csv-writers', type=int, default=8,
+                        help="number of processes saving to one results CSV file at once (default 8)")
+    parser.add_argument('--csv-saves', type=int, default=20, help="sessions saved by each of them (default 20)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmarks.json', help="JSON file of the results")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    audio_engine = AudioEngine(resource_path("audio"), NullSink())
+    audio_engine.preload(['en'])
+    rng = random.Random(args.seed)
+    results = OrderedDict([('date', datetime.datetime.now().isoformat()),
+                           ('python', platform.python_version()),
+                           ('qt', QtCore.QT_VERSION_STR),
+                           ('platform', platform.platform()),
+                           ('qpa_platform', os.environ.get('QT_QPA_PLATFORM')),
+                           ('interval', args.interval),
+                           ('threads', OrderedDict())])
+    for thread_class in (PlayNumbersThread, PlayTrackThread, PlayDemoThread):
+        runs = []
+        for n_stimuli in args.stimuli:
+            run = run_thread(thread_class, n_stimuli, args.interval, audio_engine, rng)
+            runs.append(run)
+            print("%s, %d stimuli: ISI error %.3f +/- %.3f ms (max %.3f), drift %.3f ms, RT error %.3f +/- %.3f ms"
+                  % (thread_class.__name__, n_stimuli, run['isi_error_ms']['mean'], run['isi_error_ms']['sd'],
+                     run['isi_error_ms']['max_abs'], run['cumulative_drift_ms'],
+                     run['reaction_time_error_ms']['mean'] or 0, run['reaction_time_error_ms']['sd'] or 0))
+        results['threads'][thread_class.__name__] = runs
+    results['session_timer'] = run_session_timer(args.ticks)
+    print("Session clock timer: tick error %.3f +/- %.3f ms (max %.3f)"
+          % tuple(results['session_timer']['tick_error_ms'][key] for key in ('mean', 'sd', 'max_abs')))
+    if args.startup_runs:
+        results['startup'] = run_startup(args.startup_runs)
+        print("Startup until the first paint: cold %.1f ms, warm %.1f +/- %.1f ms"
+              % (results['startup']['cold_wall_ms'], results['startup']['wall_ms']['mean'] or 0,
+                 results['startup']['wall_ms']['sd'] or 0))
+    if args.csv_writers:
+        results['csv_writers'] = csv_writers = run_csv_writers(args.csv_writers, args.csv_saves)
+        print("Results CSV file: %d processes x %d sessions, %d rows lost, %d duplicated, %d failed processes"
+              % (args.csv_writers, args.csv_saves, csv_writers['rows_lost'], csv_writers['duplicate_rows'],
+                 csv_writers['failed_processes']))
+    audio_engine.close()
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+    print("Saved to %s" % args.output)
+    # The concurrent saves must not lose, duplicate or leave anything behind
+    if args.csv_writers and any(results['csv_writers'][key] for key in
+                                ('rows_lost', 'duplicate_rows', 'temporary_files_left', 'failed_processes')):
+        print("The concurrent saves to the results CSV file FAILED")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Compact buffers for the responses of a session, so that long runs (e.g.
+thousands of stimuli) are kept in a few typed arrays instead of lists of
+Python objects: one byte per result and per presented number, and four
+bytes per reaction time or dispatch latency. Missing times are stored as
+MISSING (nan) instead of 0. The arrays support the buffer protocol, so
+they can be read without copying (e.g. numpy.frombuffer(buffer.results,
+numpy.int8)), and the lists of the results file are exported on demand.
+"""
+
+import math
+from array import array
+
+# The codes of the results in SessionBuffer.results (0 is used as padding by scoring.py)
+RESULT_CODES = {'C': 1, 'I': 2, 'N': 3}
+RESULT_LETTERS = {code: letter for (letter, code) in RESULT_CODES.items()}
+# A missing reaction time or dispatch latency
+MISSING = float('nan')
+
+class SessionBuffer:
+    """
+    The stimuli presented and the responses of a session. stimulus_width is 1
+    for the numbers of PASAT and 2 for the pairs of the demo, which are stored
+    flattened in presented.
+    """
+    __slots__ = ('stimulus_width', 'presented', 'results', 'reaction_times', 'dispatch_latencies')
+
+    def __init__(self, stimulus_width=1):
+        self.stimulus_width = stimulus_width
+        self.presented = array('B')
+        self.results = array('b')
+        self.reaction_times = array('f')
+        self.dispatch_latencies = array('f')
+
+    def __len__(self):
+        """
+        Returns the number of responses
+        """
+        return len(self.results)
+
+    def present(self, stimulus):
+        if self.stimulus_width == 1:
+            self.presented.append(stimulus)
+        else:
+            self.presented.extend(stimulus)
+
+    @property
+    def n_presented(self):
+        return len(self.presented) // self.stimulus_width
+
+    def stimulus(self, index):
+        """
+        Returns the presented stimulus number index (negative from the last one)
+        """
+        if self.stimulus_width == 1:
+            return self.presented[index]
+        if index < 0:
+            index += self.n_presented
+        start = index * self.stimulus_width
+        return tuple(self.presented[start:start+self.stimulus_width])
+
+    def add(self, result, reaction_time=None, dispatch_latency=None):
+        """
+        Adds a response with its result ("C"/"I"/"N") and its reaction time and
+        dispatch latency in seconds (None if missing)
+        """
+        self.results.append(RESULT_CODES[result])
+        self.reaction_times.append(MISSING if reaction_time is None else reaction_time)
+        self.dispatch_latencies.append(MISSING if dispatch_latency is None else dispatch_latency)
+
+    def views(self):
+        """
+        Returns memoryviews of results, reaction_times and dispatch_latencies
+        """
+        return memoryview(self.results), memoryview(self.reaction_times), memoryview(self.dispatch_latencies)
+
+    ### Export in the format of the results file
+    def results_list(self):
+        return [RESULT_LETTERS[code] for code in self.results]
+
+    def results_string(self):
+        """
+        Returns the results as one string, e.g. "CCIN"
+        """
+        return ''.join(self.results_list())
+
+    @staticmethod
+    def _times_list(times, missing):
+        # Rounded to milliseconds again, as float32 does not keep e.g. 1.234 exactly
+        return [missing if math.isnan(time) else round(time, 3) for time in times]
+
+    def reaction_times_list(self):
+        """
+        Returns the reaction times with 0 for the missing ones, as in the results file
+        """
+        return self._times_list(self.reaction_times, 0)
+
+    def dispatch_latencies_list(self):
+        """
+        Returns the dispatch latencies with None for the missing ones
+        """
+        return self._times_list(self.dispatch_latencies, None)
+
+    def presented_list(self):
+        return [self.stimulus(index) for index in range(self.n_presented)]
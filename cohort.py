@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Cohort-level aggregates of any number of results files (as written by
+helpers.update_csv or storage.AppendOnlyStore.compact), e.g. to pool the data
+of several sites:
+
+    python cohort.py sites/*/results.csv --jobs 4 --output cohort.json
+
+The files are streamed row by row through a pipeline of generators, and the
+results list and reaction times columns are parsed item by item, without
+evaluating them as Python lists. The sessions are scored in batches of
+BATCH_SIZE with scoring.score_sessions (NumPy), and their stats are added to
+a Distribution per site, mode and stat, which keeps its count, mean, SD, range and a fixed-width histogram
+(for the percentiles), so the memory used does not depend on the number of
+sessions (beyond a batch). The files are aggregated in parallel by a process pool, and the
+aggregates of the files are merged.
+"""
+
+import os, re, csv, sys, json, math, argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from helpers import PREFIXES
+from scoring import score_sessions
+
+# The stats aggregated per session, with the range and bin width of their histograms
+SESSION_STATS = (("correct %", 0, 100, 0.5),
+                 ("mean reaction time", 0, 10, 0.01),
+                 ("last third correct - first third correct", -100, 100, 1),
+                 ("percent decrease in the last third", -100, 100, 1))
+# The reaction times of all the correct responses are pooled too
+RESPONSE_STATS = (("reaction times", 0, 10, 0.01),)
+PERCENTILES = (5, 25, 50, 75, 95)
+# Cognitive fatigability is present when the last third correct - first third
+# correct is <= -3 (see helpers.get_fatigability)
+FATIGABILITY_THRESHOLD = -3
+ALL_SITES = "All sites"
+# The sessions of a site and mode scored at once
+BATCH_SIZE = 256
+
+_LIST_ITEM = re.compile(r"[^,\[\]\s]+")
+
+class Distribution:
+    """
+    The count, mean, variance (Welford's method, merged with Chan's formula),
+    minimum and maximum of the values added, and their histogram with bins of
+    bin_width between low and high (values out of the range are counted in
+    the first or last bin), from which the percentiles are estimated
+    """
+    def __init__(self, low, high, bin_width):
+        self.low = low
+        self.high = high
+        self.bin_width = bin_width
+        self.bins = [0] * int(math.ceil((high - low) / bin_width))
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        index = int((value - self.low) // self.bin_width)
+        self.bins[min(max(index, 0), len(self.bins) - 1)] += 1
+
+    def merge(self, other):
+        """
+        Adds the values of other, a Distribution with the same bins
+        """
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.bins = [mine + theirs for (mine, theirs) in zip(self.bins, other.bins)]
+
+    @property
+    def sd(self):
+        if not self.count:
+            return None
+        return math.sqrt(self.m2 / self.count)
+
+    def percentile(self, percent):
+        """
+        Estimates the percentile by linear interpolation within its bin
+        """
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.bins):
+            if count and cumulative + count >= rank:
+                value = self.low + (index + (rank - cumulative) / count) * self.bin_width
+                return min(max(value, self.minimum), self.maximum)
+            cumulative += count
+        return self.maximum
+
+    def fraction_at_most(self, threshold):
+        """
+        Returns the fraction of the values <= threshold, which must be the
+        upper edge of a bin (e.g. an integer for integer bins)
+        """
+        if not self.count:
+            return None
+        index = int(math.floor((threshold - self.low) / self.bin_width)) + 1
+        return sum(self.bins[:max(index, 0)]) / self.count
+
+    def summary(self):
+        summary = OrderedDict([('n', self.count),
+                               ('mean', self.mean if self.count else None),
+                               ('sd', self.sd),
+                               ('min', self.minimum)])
+        for percent in PERCENTILES:
+            summary['p%d' % percent] = self.percentile(percent)
+        summary['max'] = self.maximum
+        return summary
+
+def new_distributions():
+    return OrderedDict((stat_name, Distribution(low, high, bin_width))
+                       for (stat_name, low, high, bin_width) in SESSION_STATS + RESPONSE_STATS)
+
+class CohortAggregate:
+    """
+    The Distributions of SESSION_STATS and RESPONSE_STATS of every (site, mode)
+    """
+    def __init__(self):
+        self.distributions = OrderedDict()
+        self.n_rows = 0
+        self.n_sessions = 0
+
+    def _distributions(self, site, mode):
+        key = (site, mode)
+        if key not in self.distributions:
+            self.distributions[key] = new_distributions()
+        return self.distributions[key]
+
+    def add_sessions(self, site, mode, all_results, all_reaction_times):
+        """
+        Scores sessions from the lists of their results and reaction times at
+        once, and adds their stats. The sessions without results are skipped.
+        """
+        sessions = [(results, reaction_times) for (results, reaction_times) in zip(all_results, all_reaction_times)
+                    if results]
+        if not sessions:
+            return
+        distributions = self._distributions(site, mode)
+        for results, reaction_times in sessions:
+            for reaction_time in reaction_times:
+                if reaction_time:
+                    distributions["reaction times"].add(reaction_time)
+        self.n_sessions += len(sessions)
+        columns = score_sessions(*zip(*sessions))
+        for (stat_name, low, high, bin_width) in SESSION_STATS:
+            for value in columns[stat_name].tolist():
+                # nan where the formula gives None
+                if value == value:
+                    distributions[stat_name].add(value)
+
+    def add_session(self, site, mode, results, reaction_times):
+        """
+        Scores a session from iterables of its results and reaction times, and
+        adds its stats
+        """
+        self.add_sessions(site, mode, [list(results)], [list(reaction_times)])
+
+    def merge(self, other):
+        self.n_rows += other.n_rows
+        self.n_sessions += other.n_sessions
+        for (site, mode), distributions in other.distributions.items():
+            for stat_name, distribution in self._distributions(site, mode).items():
+                distribution.merge(distributions[stat_name])
+
+    def results(self):
+        """
+        Returns the summaries of the stats by site (and ALL_SITES) and mode,
+        with the percent of the sessions with cognitive fatigability
+        """
+        all_distributions = OrderedDict(self.distributions)
+        for (site, mode), distributions in self.distributions.items():
+            pooled = all_distributions.setdefault((ALL_SITES, mode), new_distributions())
+            for stat_name, distribution in distributions.items():
+                pooled[stat_name].merge(distribution)
+        results = OrderedDict()
+        for (site, mode), distributions in all_distributions.items():
+            mode_results = OrderedDict((stat_name, distribution.summary())
+                                       for (stat_name, distribution) in distributions.items())
+            fatigable = distributions["last third correct - first third correct"].fraction_at_most(FATIGABILITY_THRESHOLD)
+            mode_results["fatigable %"] = None if fatigable is None else 100 * fatigable
+            results.setdefault(site, OrderedDict())[mode] = mode_results
+        return results
+
+### Pipeline
+def iter_list_items(text):
+    """
+    Yields the items of a list column, e.g. "['C', 'I', 'N']" or
+    "[0.532, 0, None]", one by one as str, float or None
+    """
+    for match in _LIST_ITEM.finditer(text):
+        item = match.group()
+        if item[0] in "'\"":
+            yield item[1:-1]
+        elif item == 'None':
+            yield None
+        else:
+            yield float(item)
+
+def iter_rows(filepath):
+    """
+    Yields the rows of a results file as dicts. The header is the first row,
+    so the files written with fewer columns by earlier versions are read too.
+    """
+    # The names of the players are not used, so they need not be decoded correctly
+    with open(filepath, 'r', newline='', encoding='utf-8', errors='replace') as csvfile:
+        for row in csv.DictReader(csvfile, dialect='excel'):
+            yield row
+
+def iter_sessions(rows, site):
+    """
+    Yields (site, mode, results, reaction times) for every mode played in the
+    rows, with the lists as generators of their items
+    """
+    for row in rows:
+        for mode in PREFIXES:
+            results = row.get(mode + " results list")
+            if not results:
+                continue
+            yield (site, mode, iter_list_items(results),
+                   iter_list_items(row.get(mode + " reaction times") or ""))
+
+def site_name(filepath, site_from='folder'):
+    """
+    Returns the site of a results file: the name of its folder, or of the file
+    without its extension
+    """
+    filepath = os.path.abspath(filepath)
+    if site_from == 'folder':
+        return os.path.basename(os.path.dirname(filepath))
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+def aggregate_file(filepath, site_from='folder'):
+    """
+    Streams a results file and returns its CohortAggregate
+    """
+    aggregate = CohortAggregate()
+    site = site_name(filepath, site_from)
+    def counted(rows):
+        for row in rows:
+            aggregate.n_rows += 1
+            yield row
+    # The sessions waiting to be scored, by mode
+    batches = OrderedDict()
+    for (site, mode, results, reaction_times) in iter_sessions(counted(iter_rows(filepath)), site):
+        all_results, all_reaction_times = batches.setdefault(mode, ([], []))
+        all_results.append(list(results))
+        all_reaction_times.append(list(reaction_times))
+        if len(all_results) == BATCH_SIZE:
+            aggregate.add_sessions(site, mode, *batches.pop(mode))
+    for mode, batch in batches.items():
+        aggregate.add_sessions(site, mode, *batch)
+    return aggregate
+
+def aggregate_files(filepaths, site_from='folder', jobs=None):
+    """
+    Aggregates the files in a pool of jobs processes (one per CPU by default,
+    or in this process if jobs is 1), and returns the merged CohortAggregate
+    """
+    aggregate = CohortAggregate()
+    if jobs == 1 or len(filepaths) < 2:
+        for filepath in filepaths:
+            aggregate.merge(aggregate_file(filepath, site_from))
+        return aggregate
+    with ProcessPoolExecutor(jobs) as executor:
+        for file_aggregate in executor.map(aggregate_file, filepaths, [site_from] * len(filepaths)):
+            aggregate.merge(file_aggregate)
+    return aggregate
+
+def _format(value, digits=2):
+    return "-" if value is None else "%.*f" % (digits, value)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aggregate the PASAT results files of a cohort")
+    parser.add_argument('files', nargs='+', help="results CSV files")
+    parser.add_argument('--site-from', choices=('folder', 'file'), default='folder',
+                        help="name the sites after the folders (default) or the names of the files")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of processes (default: one per CPU, 1: no pool)")
+    parser.add_argument('--output', help="JSON file of the aggregates")
+    args = parser.parse_args(argv)
+
+    aggregate = aggregate_files(args.files, args.site_from, args.jobs)
+    results = aggregate.results()
+    print("%d files, %d rows, %d sessions" % (len(args.files), aggregate.n_rows, aggregate.n_sessions))
+    for site, modes in results.items():
+        for mode, mode_results in modes.items():
+            correct = mode_results["correct %"]
+            reaction_time = mode_results["mean reaction time"]
+            print("%s, %s (n=%d): correct %% %s +/- %s (median %s), mean reaction time %s s (median %s), "
+                  "fatigable %s%%"
+                  % (site, mode, correct['n'], _format(correct['mean']), _format(correct['sd']),
+                     _format(correct['p50']), _format(reaction_time['mean'], 3), _format(reaction_time['p50'], 3),
+                     _format(mode_results["fatigable %"], 1)))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(OrderedDict([('files', args.files), ('rows', aggregate.n_rows),
+                                   ('sessions', aggregate.n_sessions), ('sites', results)]),
+                      output_file, indent=2)
+        print("Saved to %s" % args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Collects the results of several stations (the computers running PASAT in a
+lab) in one results store, so that the stations do not write to a shared
+file. The collector is an asyncio server on TCP or on a Unix socket:
+
+    python collector.py serve --address 0.0.0.0:8765 --storage sqlite --results results.sqlite
+    python collector.py serve --address unix:/tmp/pasat-collector.sock
+
+The stations send their sessions with storage.CollectorBackend (set
+RESULTS_STORAGE = "collector" and its address in RESULTS_FILEPATHS in
+main.py), which keeps them in an outbox until they are acknowledged, so a
+station can go on testing while the collector is down and sends its sessions
+later. The protocol is one JSON object per line: the stations send
+{"id", "station", "session"} messages, where session holds the arguments of
+ResultsBackend.save_session, and the collector replies {"id", "ok"} (and
+"error" if the session could not be saved) once the session is saved.
+
+The sessions received from all the connections are queued and saved in
+batches by a single writer, through one results backend (storage.open_backend),
+in a worker thread so the connections are served meanwhile. A session which
+is sent again (e.g. when an acknowledgement was lost) is acknowledged
+without being saved twice.
+
+Everything can be tried on one machine: simulate runs a collector and a
+number of stations, some of them sending before the collector is up,
+and checks that all their sessions have been saved:
+
+    python collector.py simulate --stations 6 --sessions 20
+"""
+
+import os, sys, json, time, socket, random, asyncio, argparse, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+import storage
+
+class Collector:
+    """
+    Saves the sessions received from the stations in the results backend of
+    type results_storage ("csv", "append" or "sqlite", see storage.open_backend)
+    at results_filepath, in batches of up to batch_size sessions
+    """
+    # Longer than a batch takes, so that the CSVBackend writes when it is flushed
+    COALESCE_WINDOW = 60
+    # The longest message (line) read, far above the 64 KiB default of asyncio
+    # (a session of 1500 stimuli is about 100 KB)
+    MESSAGE_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, results_storage, results_filepath, batch_size=64):
+        self.results_storage = results_storage
+        self.results_filepath = results_filepath
+        self.batch_size = batch_size
+        # The backend is opened and used in this thread only (e.g. SQLite
+        # connections must stay in the thread which created them)
+        self.executor = ThreadPoolExecutor(1)
+        self.backend = None
+        self.saved_ids = set()
+        self.n_saved = 0
+        self.n_batches = 0
+        self.queue = None
+        self.server = None
+        self._writer_task = None
+
+    async def start(self, address):
+        """
+        Starts listening on address ("host:port" or "unix:path") and saving the sessions
+        """
+        loop = asyncio.get_running_loop()
+        # The CSV file is rewritten once per batch (see _save_batch)
+        self.backend = await loop.run_in_executor(self.executor, storage.open_backend, self.results_storage,
+                                                  self.results_filepath, self.COALESCE_WINDOW)
+        self.queue = asyncio.Queue()
+        self._writer_task = asyncio.ensure_future(self._write_batches())
+        family, address = storage.parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = await asyncio.start_unix_server(self._serve_station, address, limit=self.MESSAGE_LIMIT)
+        else:
+            self.server = await asyncio.start_server(self._serve_station, *address, limit=self.MESSAGE_LIMIT)
+        return self.server
+
+    async def stop(self):
+        """
+        Stops listening, and returns once the queued sessions are saved
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        await self.queue.join()
+        self._writer_task.cancel()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.backend.close)
+        self.executor.shutdown()
+
+    async def _serve_station(self, reader, writer):
+        acknowledgements = []
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError) as error:
+                    # Longer than MESSAGE_LIMIT: it is skipped, and its id is unknown
+                    writer.write((json.dumps({'id': None, 'ok': False, 'error': "%s: %s" % (
+                        type(error).__name__, error)}) + '\n').encode('utf-8'))
+                    continue
+                if not line:
+                    break
+                try:
+                    message = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                saved = asyncio.get_running_loop().create_future()
+                await self.queue.put((message, saved))
+                acknowledgements.append(asyncio.ensure_future(self._acknowledge(writer, message, saved)))
+            # The station has stopped sending, the acknowledgements are sent before closing
+            await asyncio.gather(*acknowledgements)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _acknowledge(self, writer, message, saved):
+        error = await saved
+        reply = {'id': message.get('id'), 'ok': error is None}
+        if error is not None:
+            reply['error'] = error
+        writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a session, then take the sessions queued meanwhile
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            errors = await loop.run_in_executor(self.executor, self._save_batch,
+                                                [message for (message, saved) in batch])
+            self.n_batches += 1
+            for (message, saved), error in zip(batch, errors):
+                saved.set_result(error)
+                self.queue.task_done()
+
+    def _save_batch(self, messages):
+        """
+        Saves the sessions of the messages, and returns the error of each (None if saved)
+        """
+        errors = []
+        saved_ids = []
+        for message in messages:
+            try:
+                if message['id'] not in self.saved_ids:
+                    self.backend.save_session(**message['session'])
+                    self.saved_ids.add(message['id'])
+                    saved_ids.append(message['id'])
+                    self.n_saved += 1
+                errors.append(None)
+            except Exception as error:
+                errors.append("%s: %s" % (type(error).__name__, error))
+        # The sessions are acknowledged once they are written
+        if hasattr(self.backend, 'flush'):
+            try:
+                self.backend.flush()
+            except Exception as error:
+                # Not acknowledged, so the stations send the sessions again
+                errors = ["%s: %s" % (type(error).__name__, error)] * len(messages)
+                self.saved_ids.difference_update(saved_ids)
+                self.n_saved -= len(saved_ids)
+        return errors
+
+### Simulation
+def _simulated_session(rng, player_code):
+    """
+    Returns the arguments of save_session for a random PASAT session of player_code
+    """
+    from engine import simulate_session
+    engine = simulate_session(n_stimuli=61, rng=rng,
+                              respond=lambda engine: (engine.correct_answer() if rng.random() < 0.7 else 1,
+                                                      rng.uniform(0.5, 2.5)) if rng.random() < 0.9 else None)
+    empty = {'Addition': [], 'PASAT': []}
+    return dict(player_name='', player_code=player_code, session_ids={'Addition': 1, 'PASAT': 1},
+                modes=['PASAT'], all_results=dict(empty, PASAT=engine.results),
+                all_reaction_times=dict(empty, PASAT=engine.reaction_times),
+                all_onsets=dict(empty, PASAT=engine.onsets), all_stimuli=dict(empty, PASAT=engine.stimuli))
+
+def _run_station(address, station, n_sessions, outbox_dir, started, seed):
+    """
+    Saves n_sessions with a CollectorBackend, half of them before the collector
+    has started (they are queued in the outbox), and returns the number of
+    sessions still queued at the end
+    """
+    rng = random.Random(seed)
+    backend = storage.CollectorBackend(address, station, outbox_dir)
+    for index in range(n_sessions):
+        if index == n_sessions // 2:
+            started.wait()
+        backend.save_session(**_simulated_session(rng, "%s-%d" % (station, index)))
+    backend.close()
+    backend.send_queued()
+    return len(backend.queued())
+
+def simulate(n_stations, n_sessions, seed=0):
+    """
+    Runs a collector saving in a temporary SQLite database and n_stations
+    stations (threads) saving n_sessions each, and returns a report
+    """
+    temp_dir = tempfile.mkdtemp()
+    if hasattr(socket, 'AF_UNIX'):
+        address = "unix:" + os.path.join(temp_dir, "collector.sock")
+    else:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            address = "127.0.0.1:%d" % probe.getsockname()[1]
+    db_filepath = os.path.join(temp_dir, "results.sqlite")
+    started = threading.Event()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        stations = ThreadPoolExecutor(n_stations)
+        station_runs = [loop.run_in_executor(stations, _run_station, address, "station%d" % index, n_sessions,
+                                             os.path.join(temp_dir, "outbox%d" % index), started, seed + index)
+                        for index in range(n_stations)]
+        # The stations queue their first sessions while the collector is down
+        await asyncio.sleep(0.5)
+        collector = Collector("sqlite", db_filepath)
+        await collector.start(address)
+        started_at = time.perf_counter()
+        started.set()
+        still_queued = await asyncio.gather(*station_runs)
+        elapsed = time.perf_counter() - started_at
+        await collector.stop()
+        return collector, sum(still_queued), elapsed
+    collector, still_queued, elapsed = asyncio.run(run())
+    backend = storage.SQLiteBackend(db_filepath)
+    n_rows = backend.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    backend.close()
+    return {'address': address, 'sent': n_stations * n_sessions, 'saved': collector.n_saved,
+            'rows': n_rows, 'batches': collector.n_batches, 'still queued': still_queued,
+            'seconds': elapsed}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect the PASAT results of several stations in one store")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="Run the collector")
+    serve_parser.add_argument('--address', default='127.0.0.1:8765',
+                              help="host:port or unix:path to listen on (default 127.0.0.1:8765)")
+    serve_parser.add_argument('--storage', choices=('csv', 'append', 'sqlite'), default='sqlite')
+    serve_parser.add_argument('--results', default=None,
+                              help="results file (default results.csv, results.log or results.sqlite)")
+    simulate_parser = subparsers.add_parser('simulate', help="Run a collector and stations on this machine")
+    simulate_parser.add_argument('--stations', type=int, default=6)
+    simulate_parser.add_argument('--sessions', type=int, default=20, help="sessions per station")
+    simulate_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        results_filepath = args.results or {"csv": "results.csv", "append": "results.log",
+                                            "sqlite": "results.sqlite"}[args.storage]
+        collector = Collector(args.storage, results_filepath)
+        async def serve():
+            await collector.start(args.address)
+            print("Collecting on %s into %s (Ctrl+C to stop)" % (args.address, results_filepath))
+            try:
+                await collector.server.serve_forever()
+            finally:
+                await collector.stop()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        print("%d sessions saved" % collector.n_saved)
+    elif args.command == 'simulate':
+        report = simulate(args.stations, args.sessions, args.seed)
+        for key, value in report.items():
+            print("%s: %s" % (key, value))
+        return 0 if report['rows'] == report['sent'] and not report['still queued'] else 1
+    else:
+        parser.print_help()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
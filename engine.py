@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+The logic of a PASAT (or demo) session, independent of Qt: generation of the
+stimuli, scoring of the answers, reaction times and the stats of the results.
+Window is a view over a SessionEngine, which is driven by the events of the
+stimulus threads (present) and the user input (type_digit and respond), and
+measures time with an injectable clock (a timing.SessionClock by default).
+"""
+
+import random
+from collections import OrderedDict
+import timing
+from stats import SessionStats
+from buffers import SessionBuffer
+from keystrokes import KeystrokeLog, capacity_for, DIGIT, ENTER, ERASE, BUTTON
+
+class SessionEngine:
+    """
+    A session of PASAT (mode = 'PASAT'), where the answer is the sum of the
+    last two numbers presented, or of the demo (mode = 'Demo'), where the answer
+    is the sum of the pair presented. The responses are kept in a SessionBuffer,
+    and exported as in the results file by results, reaction_times and
+    dispatch_latencies: "C" (correct)/"I" (incorrect)/"N" (not answered) for
+    each answer, and the reaction times of the correct answers (0 for the others).
+    """
+    def __init__(self, mode, n_stimuli, interval, clock=None, rng=None, stimuli=None, reference_offsets=None,
+                 journal=None):
+        """
+        Initializes the session with mode ('PASAT'/'Demo'), n_stimuli (number of
+        numbers or pairs), interval (seconds), clock (used for the time of the
+        answers if not given, a timing.SessionClock by default), rng (random.Random
+        used to generate the stimuli), stimuli (to use instead of random ones),
+        reference_offsets ({stimulus: seconds} from the onset of each stimulus
+        to the point the reaction times are measured from, e.g. the speech
+        onset, see AudioEngine.reference_offsets; the onset by default) and
+        journal (a journal.SessionJournal to which every scored response is
+        appended, none by default)
+        """
+        self.mode = mode
+        self.interval = interval
+        self.clock = clock if clock is not None else timing.SessionClock()
+        self.rng = rng if rng is not None else random.Random()
+        self.stimuli = stimuli if stimuli is not None else self.generate_stimuli(n_stimuli)
+        self.reference_offsets = reference_offsets if reference_offsets is not None else {}
+        self.journal = journal
+        # The stimuli that have been presented so far and the responses
+        self.buffer = SessionBuffer(1 if mode == 'PASAT' else 2)
+        self.onsets = []
+        self.time_presented = 0
+        # Answers are accepted after the first number in PASAT and after the
+        # first pair in the demo, only once (answered) per interval, and not
+        # while the session is paused
+        self.started = False
+        self.answered = False
+        self.paused = False
+        # The digits typed in the current interval, and the time of the last one
+        self.typed_answer = ''
+        self.typed_response = (None, None)
+        self.finished = False
+        # Set by the application once the results are saved (or discarded),
+        # so that they are not saved again with the next session
+        self.saved = False
+        # Updated with every scored response, read by stats() and the live readout
+        self.session_stats = SessionStats()
+        # The input accepted, as (time, 'type', 'erase', 'respond' or 'button',
+        # digit or answer), to be able to replay the session (see replay.py)
+        self.events = []
+        # Every key accepted, with its latency from the stimulus. The log is
+        # flushed into keystroke_events and keystroke_latencies by finish(),
+        # with the number of events it could not hold in keystrokes_dropped.
+        self.keystrokes = KeystrokeLog(capacity_for(len(self.stimuli)))
+        self.keystroke_events = []
+        self.keystroke_latencies = {'first key': [], 'completion': []}
+        self.keystrokes_dropped = 0
+
+    @property
+    def accepting(self):
+        """
+        Whether an answer can be submitted at the moment
+        """
+        return self.started and not self.answered and not self.paused and not self.finished
+
+    @property
+    def result_mode(self):
+        """
+        The name of the mode in the results file ('Addition' for the demo)
+        """
+        return 'PASAT' if self.mode == 'PASAT' else 'Addition'
+
+    @property
+    def presented(self):
+        return self.buffer.presented_list()
+
+    @property
+    def results(self):
+        return self.buffer.results_list()
+
+    @property
+    def reaction_times(self):
+        return self.buffer.reaction_times_list()
+
+    @property
+    def dispatch_latencies(self):
+        return self.buffer.dispatch_latencies_list()
+
+    @property
+    def padding(self):
+        """
+        The stimulus which is presented after the last one by the threads
+        """
+        return 0 if self.mode == 'PASAT' else (0,0)
+
+    def generate_stimuli(self, n_stimuli):
+        """
+        Returns n_stimuli random numbers (PASAT) or pairs of numbers (demo) in [1, 10],
+        so the possible answers are [2, 20]
+        """
+        if self.mode == 'PASAT':
+            return [self.rng.randint(1,10) for dummy in range(n_stimuli)]
+        return [(self.rng.randint(1,10), self.rng.randint(1,10)) for dummy in range(n_stimuli)]
+
+    def correct_answer(self):
+        if self.mode == 'PASAT':
+            return self.buffer.stimulus(-1) + self.buffer.stimulus(-2)
+        return sum(self.buffer.stimulus(-1))
+
+    ### Events
+    def present(self, stimulus, onset):
+        """
+        Called when a stimulus is presented at onset (seconds of the clock). If
+        no answer has been submitted in the previous interval, the typed answer
+        (or no answer) is scored first, and its result is returned. The reaction
+        times of the new stimulus are measured from onset plus its reference offset.
+        """
+        result = None
+        if self.started and not self.answered:
+            result = self._score(self.typed_answer, *self.typed_response)
+        self.answered = False
+        self.typed_answer = ''
+        self.typed_response = (None, None)
+        self.time_presented = onset + self.reference_offsets.get(stimulus, 0)
+        if stimulus == self.padding:
+            self.started = False
+            return result
+        self.buffer.present(stimulus)
+        self.started = (self.mode != 'PASAT') or (self.buffer.n_presented >= 2)
+        return result
+
+    def type_digit(self, digit, response_time=None, dispatch_latency=None):
+        """
+        Adds a digit to the typed answer. If the answer is not confirmed by respond,
+        it is scored at the next stimulus, timed to the last digit typed.
+        Returns False if answers are not accepted at the moment.
+        """
+        if not self.accepting:
+            return False
+        if response_time is None:
+            response_time = self.clock.elapsed()
+        self.typed_answer += digit
+        self.typed_response = (response_time, dispatch_latency)
+        self.events.append((response_time, 'type', digit))
+        self._log_key(DIGIT, int(digit), response_time)
+        return True
+
+    def erase_digit(self, response_time=None, dispatch_latency=None):
+        """
+        Removes the last digit of the typed answer (a correction). Returns False
+        if answers are not accepted at the moment or nothing has been typed.
+        """
+        if not self.accepting or not self.typed_answer:
+            return False
+        if response_time is None:
+            response_time = self.clock.elapsed()
+        self.typed_answer = self.typed_answer[:-1]
+        self.typed_response = (response_time, dispatch_latency)
+        self.events.append((response_time, 'erase', ''))
+        self._log_key(ERASE, 0, response_time)
+        return True
+
+    def respond(self, answer, response_time=None, dispatch_latency=None, key=ENTER):
+        """
+        Submits the answer (str or int, '' for no answer) given at response_time
+        (seconds of the clock, now by default) with key (keystrokes.ENTER, or
+        keystrokes.BUTTON for an answer button) and returns its result
+        ("C"/"I"/"N"), or None if answers are not accepted at the moment.
+        """
+        if not self.accepting:
+            return None
+        self.answered = True
+        if response_time is None:
+            response_time = self.clock.elapsed()
+        self.events.append((response_time, 'button' if key == BUTTON else 'respond', answer))
+        self._log_key(key, int(answer) if key == BUTTON else 0, response_time)
+        return self._score(answer, response_time, dispatch_latency)
+
+    def _log_key(self, key, value, response_time):
+        # The key belongs to the response which is scored next
+        self.keystrokes.log(len(self.buffer), key, value, response_time - self.time_presented)
+
+    def _score(self, answer, response_time=None, dispatch_latency=None):
+        if response_time is None:
+            response_time = self.clock.elapsed()
+        reaction_time = round(response_time - self.time_presented, 3)
+        if dispatch_latency is not None:
+            dispatch_latency = round(dispatch_latency, 3)
+        if answer not in ('', None):
+            # answer is a string, whether it comes from mouse or keyboard input
+            result = 'C' if int(answer) == self.correct_answer() else 'I'
+        else:
+            result = 'N'
+        # Only the reaction times of the correct answers are kept
+        if result != 'C':
+            reaction_time = None
+        self.buffer.add(result, reaction_time, dispatch_latency)
+        self.session_stats.add(result, reaction_time or 0, dispatch_latency)
+        if self.journal is not None:
+            self.journal.response(len(self.buffer) - 1, result, reaction_time, dispatch_latency)
+        return result
+
+    def finish(self, onsets=None):
+        """
+        Ends the session. onsets is the list of (planned, actual) onsets of the stimuli.
+        """
+        self.onsets = list(onsets) if onsets is not None else []
+        self.finished = True
+        first_key, completion = self.keystrokes.trial_latencies(len(self.buffer))
+        self.keystroke_latencies = {'first key': first_key, 'completion': completion}
+        self.keystrokes_dropped = self.keystrokes.dropped
+        self.keystroke_events = self.keystrokes.flush()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    ### Results
+    def stats(self):
+        """
+        Returns the stats of the results as an OrderedDict with the (English)
+        names shown in the results dialog as keys, read from session_stats
+        """
+        if not len(self.buffer):
+            return OrderedDict()
+        values = self.session_stats.values()
+        onset_error_mean, onset_error_sd, onset_error_max = timing.jitter_stats(self.onsets)
+        return OrderedDict([('Correct Answers', values['correct count']),
+                            ('Incorrect Answers', values['incorrect count']),
+                            ('Not Answered', values['not answered count']),
+                            ('Correct %', values['correct %']),
+                            ('Results List', self.buffer.results_string()),
+                            ('Reaction Times', self.reaction_times),
+                            # for correct answers that are nonzero
+                            ('Mean Reaction Time', values['mean reaction time']),
+                            ('Reaction Time SD', values['reaction time SD']),
+                            ('Mean Dispatch Latency', values['mean dispatch latency']),
+                            ('Last third correct - First third correct', values['last third correct - first third correct']),
+                            ('Percent decrease in the last third', values['percent decrease in the last third']),
+                            ('Mean onset error (ms)', onset_error_mean),
+                            ('Max onset error (ms)', onset_error_max)])
+
+    def record(self):
+        """
+        Returns the stimuli, the onsets, the input events and the results of the
+        session as a JSON-serializable dict, which can be replayed by replay.py
+        """
+        return OrderedDict([('mode', self.mode),
+                            ('interval', self.interval),
+                            ('reference_offsets', [[stimulus, offset] for (stimulus, offset)
+                                                   in sorted(self.reference_offsets.items())]),
+                            ('stimuli', [list(stimulus) if isinstance(stimulus, tuple) else stimulus
+                                         for stimulus in self.stimuli]),
+                            ('onsets', [list(onset) for onset in self.onsets]),
+                            ('events', [list(event) for event in self.events]),
+                            ('keystrokes', self.keystroke_events),
+                            ('keystrokes_dropped', self.keystrokes_dropped),
+                            ('results', self.results),
+                            ('reaction_times', self.reaction_times)])
+
+def simulate_session(mode='PASAT', n_stimuli=61, interval=3, respond=None, rng=None, stimuli=None):
+    """
+    Runs a whole session without waiting: the stimulus number i is presented at
+    i * interval. respond(engine) is called whenever answers are accepted, and
+    returns (answer, reaction time) or None for no answer. Returns the finished
+    SessionEngine.
+    """
+    engine = SessionEngine(mode, n_stimuli, interval, rng=rng, stimuli=stimuli)
+    onsets = []
+    for index, stimulus in enumerate(engine.stimuli):
+        onset = index * interval
+        engine.present(stimulus, onset)
+        onsets.append((onset, onset))
+        if engine.accepting and respond is not None:
+            response = respond(engine)
+            if response is not None:
+                answer, reaction_time = response
+                engine.respond(answer, onset + reaction_time)
+    engine.present(engine.padding, len(engine.stimuli) * interval)
+    engine.finish(onsets)
+    return engine
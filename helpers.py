@@ -4,10 +4,18 @@ Created on Thu Aug 29 17:25:33 2019
 
 @author: Amin Saberi
 """
-from PyQt5.QtWidgets import QApplication
 import gettext
-from threads import resource_path
-import csv, datetime, os, math
+from timing import jitter_stats
+import csv, datetime, os, sys, math, stat, tempfile, functools, contextlib
+# Locks of the results file
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 from collections import OrderedDict
 
 PREFIXES = ("Addition", "PASAT")#, "PASAT first half", "PASAT last half")
@@ -19,10 +27,52 @@ RESULTS_FORMULAS = (("correct count", lambda results: results.count('C')),
                     ("last third correct - first third correct", lambda results: get_fatigability(results)),
                     ("percent decrease in the last third", lambda results: get_fatigability(results, as_percent = True)))
 REACTION_TIME_FORMULAS = (("reaction times", lambda reaction_times: reaction_times), 
-                          ("mean reaction time", lambda reaction_times: non_zero_mean(reaction_times)))
+                          ("mean reaction time", lambda reaction_times: non_zero_mean(reaction_times)),
+                          ("reaction time SD", lambda reaction_times: non_zero_sd(reaction_times)))
+# dispatch latencies are the delays between the input events and their handling (None if unknown)
+DISPATCH_LATENCY_FORMULAS = (("dispatch latencies", lambda dispatch_latencies: dispatch_latencies),
+                             ("mean dispatch latency", lambda dispatch_latencies: non_zero_mean(dispatch_latencies)))
+# keystroke latencies are {'first key': [...], 'completion': [...]}, the latencies
+# from the stimulus to the first key of each answer and to the key which completed
+# it, correct or not (0 if no key was pressed, see keystrokes.py)
+KEYSTROKE_LATENCY_FORMULAS = (("first key latencies", lambda latencies: latencies['first key']),
+                              ("mean first key latency", lambda latencies: non_zero_mean(latencies['first key'])),
+                              ("completion latencies", lambda latencies: latencies['completion']),
+                              ("mean completion latency", lambda latencies: non_zero_mean(latencies['completion'])))
+# onsets are lists of (planned, actual) onsets of the stimuli, recorded by timing.StimulusScheduler
+ONSET_FORMULAS = (("onset error mean (ms)", lambda onsets: jitter_stats(onsets)[0]),
+                  ("onset error SD (ms)", lambda onsets: jitter_stats(onsets)[1]),
+                  ("onset error max (ms)", lambda onsets: jitter_stats(onsets)[2]))
 
 
 ### General Helpers
+@functools.lru_cache(maxsize=None)
+def resource_path(relative_path):
+    """
+    Needed for PyInstaller to find the audio files
+    """
+    # The folder of the PyInstaller bundle, or the folder of the program (so
+    # that it can be run from another working directory)
+    base_path = getattr(sys, '_MEIPASS', None) or os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_path, relative_path)
+
+def user_cache_dir(appname="PASAT"):
+    """
+    Returns the folder of the cache files of the user (created if needed), or
+    the folder in the PASAT_CACHE_DIR environment variable if it is set
+    """
+    if os.environ.get('PASAT_CACHE_DIR'):
+        path = os.environ['PASAT_CACHE_DIR']
+    elif sys.platform == 'win32':
+        base_path = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        path = os.path.join(base_path, appname, 'Cache')
+    elif sys.platform == 'darwin':
+        path = os.path.join(os.path.expanduser('~/Library/Caches'), appname)
+    else:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), appname)
+    os.makedirs(path, exist_ok=True)
+    return path
+
 def en_to_ar_num(number_str):
     """
     Converts English string numbers to Arabic string numbers
@@ -44,14 +94,22 @@ def en_to_ar_num(number_str):
     for digit in str(number_str):
         arnum += dic[digit]    
     return arnum
+@functools.lru_cache(maxsize=None)
+def get_translation(language):
+    """
+    Returns the gettext translation of the language, which is loaded only once
+    """
+    if language == "fa":
+        return gettext.translation('PASAT', localedir = resource_path('locale'), languages=['fa'])
+    return gettext.NullTranslations()
+
 def redefine_gettext(language):
+    translation = get_translation(language)
+    translation.install()
+    _ = translation.gettext
     if language == "fa":
-        fa = gettext.translation('PASAT', localedir = resource_path('locale'), languages=['fa'])
-        fa.install()
-        _ = fa.gettext
         _n = en_to_ar_num
     else:
-        _ = gettext.gettext
         # if language is not "fa", instead of english to arabic number translator function
         # pass the gettext.gettext as _n, that does nothing.
         _n = gettext.gettext
@@ -71,6 +129,17 @@ def non_zero_mean(lst):
     else:
         return 0
 
+def non_zero_sd(lst):
+    """
+    Returns the (population) standard deviation of non-zero numbers of a list,
+    or None if there are none
+    """
+    values = [num for num in lst if num]
+    if not values:
+        return None
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((num - mean) ** 2 for num in values) / len(values))
+
 def get_fatigability(results, denominator=3, as_percent=False):
     """
     Compares the number of correct responses in the last 1/denominator vs first
@@ -108,6 +177,8 @@ def center_widget(app, widget):
     Moves the widget belonging to the app to the center of screen 
     (not its parent). Use it for QMainWindow, QDialog and QWidget.
     """
+    # Imported here so that the other helpers can be used without Qt (e.g. by engine)
+    from PyQt5.QtWidgets import QApplication
     frameGm = widget.frameGeometry()
     screen = app.desktop().screenNumber(QApplication.desktop().cursor().pos())
     centerPoint = app.desktop().screenGeometry(screen).center()
@@ -116,47 +187,182 @@ def center_widget(app, widget):
 
 
 ### CSV File Handlers
-def update_csv(csv_filepath, player_name, player_code, all_results, all_reaction_times, modes, session_ids):
+def get_fieldnames():
+    """
+    Returns the columns of the results CSV file
     """
-    Each of the arguments (except csv_filename) are dicts with 'Addition' and
-    'PASAT' keys. For example to get the demo results we would use results['Addition']
-    """    
     fieldnames = ['Player Code', 'Player Name', 'Date', 'Time']
     for prefix in PREFIXES:
-        for (stat_name, formula) in RESULTS_FORMULAS + REACTION_TIME_FORMULAS:
+        for (stat_name, formula) in RESULTS_FORMULAS + REACTION_TIME_FORMULAS + DISPATCH_LATENCY_FORMULAS + \
+                                    ONSET_FORMULAS + KEYSTROKE_LATENCY_FORMULAS:
             fieldnames.append(prefix+" "+stat_name)
-    
-    current_row_data = OrderedDict()
-    if os.path.isfile(csv_filepath):
-        csvfile = open('results.csv','r')
-        reader = csv.DictReader(csvfile, fieldnames, dialect='excel')
-        rows = list(reader) #exclude header
-        csvfile.close()
-        for row in rows:
-            if row['Player Code'] == player_code: #TODO and session is the same
-                current_row_data = row
-
-    else: #if no existing file, create a new rows list and add header to it
-        rows = []
-        rows.append(OrderedDict())
-        for fieldname in fieldnames:
-            rows[0][fieldname] = fieldname
-    #if there is no row for the current player_code and session_id, add one at the end of rows    
-    if not current_row_data: 
-        rows.append(current_row_data)
-        
-    csvfile = open("results.csv", "w", newline='')
-    writer = csv.DictWriter(csvfile, fieldnames, dialect = 'excel')
-
-    current_row_data['Player Code'] = player_code
-    current_row_data['Player Name'] = player_name
-    current_row_data['Date'] = datetime.datetime.now().strftime("%Y %B %d")
-    current_row_data['Time'] = datetime.datetime.now().strftime("%I:%M:%S %p")
+    return fieldnames
+
+def get_row_data(player_name, player_code, all_results, all_reaction_times, modes,
+                 all_onsets=None, all_dispatch_latencies=None, all_stats=None, all_keystroke_latencies=None):
+    """
+    Calculates the stats of the modes and returns them as an OrderedDict with
+    the columns of the results file as keys. Only the columns of the given modes
+    are included, so that a row with the results of the other mode can be updated
+    with it. See update_csv for the arguments. The stats of the modes in
+    all_stats (stats.SessionStats) are read from them instead of being calculated.
+    """
+    if all_onsets is None:
+        all_onsets = {prefix: [] for prefix in PREFIXES}
+    if all_dispatch_latencies is None:
+        all_dispatch_latencies = {prefix: [] for prefix in PREFIXES}
+    if all_keystroke_latencies is None:
+        all_keystroke_latencies = {prefix: {'first key': [], 'completion': []} for prefix in PREFIXES}
+
+    row_data = OrderedDict()
+    row_data['Player Code'] = player_code
+    row_data['Player Name'] = player_name
+    row_data['Date'] = datetime.datetime.now().strftime("%Y %B %d")
+    row_data['Time'] = datetime.datetime.now().strftime("%I:%M:%S %p")
 
     for mode in modes: # Addition or PASAT
-        for (stat_name, formula) in RESULTS_FORMULAS:
-            current_row_data[mode+" "+stat_name] = formula(all_results[mode])
-        for (stat_name, formula) in REACTION_TIME_FORMULAS:
-            current_row_data[mode+" "+stat_name] = formula(all_reaction_times[mode])
-    writer.writerows(rows)
-    csvfile.close()
+        precomputed = all_stats[mode].values() if all_stats and mode in all_stats else {}
+        for (formulas, data) in ((RESULTS_FORMULAS, all_results[mode]),
+                                 (REACTION_TIME_FORMULAS, all_reaction_times[mode]),
+                                 (DISPATCH_LATENCY_FORMULAS, all_dispatch_latencies[mode])):
+            for (stat_name, formula) in formulas:
+                if stat_name in precomputed:
+                    row_data[mode+" "+stat_name] = precomputed[stat_name]
+                else:
+                    row_data[mode+" "+stat_name] = formula(data)
+        for (stat_name, formula) in ONSET_FORMULAS:
+            row_data[mode+" "+stat_name] = formula(all_onsets[mode])
+        for (stat_name, formula) in KEYSTROKE_LATENCY_FORMULAS:
+            row_data[mode+" "+stat_name] = formula(all_keystroke_latencies[mode])
+    return row_data
+
+def acquire_lock(filepath, blocking=True):
+    """
+    Takes an exclusive advisory lock on filepath + '.lock' (the file itself may
+    be replaced while it is locked), with fcntl, or msvcrt on Windows, and
+    returns the open lock file, to be passed to release_lock. If blocking is
+    False, returns None at once when another process holds the lock. Where
+    neither fcntl nor msvcrt exists, the lock is always taken.
+    """
+    lock_file = open(filepath + '.lock', 'a+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt is not None:
+            lock_file.seek(0)
+            while True:
+                try:
+                    # Retries for 10 seconds before raising
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if not blocking:
+                        raise
+    except OSError:
+        lock_file.close()
+        if blocking:
+            raise
+        return None
+    return lock_file
+
+def release_lock(lock_file):
+    """
+    Releases a lock taken by acquire_lock
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        elif msvcrt is not None:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+        lock_file.close()
+
+@contextlib.contextmanager
+def locked(filepath, blocking=True):
+    """
+    Holds an exclusive lock on filepath while in the context (see
+    acquire_lock), so that only one process at a time reads and rewrites it.
+    The context value is whether the lock is held, which is always True
+    unless blocking is False.
+    """
+    lock_file = acquire_lock(filepath, blocking)
+    try:
+        yield lock_file is not None
+    finally:
+        if lock_file is not None:
+            release_lock(lock_file)
+
+def update_csv_rows(csv_filepath, rows_data):
+    """
+    Updates the rows of the results CSV file with rows_data, a list of the
+    row data of sessions (as returned by get_row_data), in one locked
+    read-modify-write. Each row data updates the row of its player code, or
+    is added at the end. The file is written to a temporary file in the same
+    folder, which is fsynced and then replaces the results file, so the file
+    is never left half written.
+    """
+    fieldnames = get_fieldnames()
+    with locked(csv_filepath):
+        rows = []
+        if os.path.isfile(csv_filepath):
+            with open(csv_filepath, 'r', newline='') as csvfile:
+                # The rows are read with the header of the file, which may be
+                # one of an earlier version with fewer or other columns
+                reader = csv.DictReader(csvfile, dialect='excel')
+                rows = list(reader)
+                # The columns which are not (or no longer) written are kept at the end
+                fieldnames += [fieldname for fieldname in reader.fieldnames or []
+                               if fieldname and fieldname not in fieldnames]
+        # The last row of each player code
+        rows_by_code = {row.get('Player Code'): row for row in rows}
+        for row_data in rows_data:
+            current_row_data = rows_by_code.get(row_data['Player Code']) #TODO and session is the same
+            #if there is no row for the current player_code and session_id, add one at the end of rows
+            if current_row_data is None:
+                current_row_data = OrderedDict()
+                rows.append(current_row_data)
+                rows_by_code[row_data['Player Code']] = current_row_data
+            current_row_data.update(row_data)
+
+        csv_dirpath = os.path.dirname(os.path.abspath(csv_filepath))
+        temp_fd, temp_filepath = tempfile.mkstemp(prefix='.' + os.path.basename(csv_filepath) + '.',
+                                                  suffix='.tmp', dir=csv_dirpath)
+        try:
+            with os.fdopen(temp_fd, "w", newline='') as csvfile:
+                # The values past the header of a row (None key) are dropped
+                writer = csv.DictWriter(csvfile, fieldnames, restval='', extrasaction='ignore', dialect = 'excel')
+                writer.writeheader()
+                writer.writerows(rows)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+            if os.path.isfile(csv_filepath):
+                # Keep the permissions of the results file
+                os.chmod(temp_filepath, stat.S_IMODE(os.stat(csv_filepath).st_mode))
+            else:
+                # The temporary file is only readable by its owner
+                os.chmod(temp_filepath, default_file_mode())
+            os.replace(temp_filepath, csv_filepath)
+        except BaseException:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            raise
+
+def default_file_mode():
+    """
+    Returns the permissions of a new file created with open(), which are those
+    not masked by the umask
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def update_csv(csv_filepath, player_name, player_code, all_results, all_reaction_times, modes, session_ids,
+               all_onsets=None, all_dispatch_latencies=None, all_stats=None, all_keystroke_latencies=None):
+    """
+    Each of the arguments (except csv_filename) are dicts with 'Addition' and
+    'PASAT' keys. For example to get the demo results we would use results['Addition']
+    """    
+    update_csv_rows(csv_filepath, [get_row_data(player_name, player_code, all_results, all_reaction_times, modes,
+                                                all_onsets, all_dispatch_latencies, all_stats,
+                                                all_keystroke_latencies)])
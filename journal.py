@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe journal of the responses of the sessions (see JOURNAL_DIR in
+main.py). Every scored response is appended to a binary journal as it
+happens, so a session which is interrupted (e.g. by a crash or a power cut)
+can be recovered on the next launch instead of being lost.
+
+Every running instance writes its own journal in the journal folder, and
+holds its lock (helpers.acquire_lock) until it exits, so several instances
+can run at once: at launch, only the journals which are not locked, i.e.
+whose instance has crashed, are recovered (recover_abandoned).
+
+The journal starts with MAGIC, followed by records of the form
+
+    type (1 byte), payload length (4 bytes), payload, CRC32 of all of these (4 bytes)
+
+A record which is cut short or does not match its CRC (the last write before
+a crash) ends the journal. The records are written and fsynced by a
+JournalWriter on a background thread: all the records queued while it is
+writing are written together and fsynced once (group commit), so appending
+never blocks on the disk. When the results of the sessions are saved, the
+journal is truncated, and it is removed when its instance exits.
+"""
+
+import os, glob, json, time, queue, struct, zlib, threading
+from collections import OrderedDict
+import helpers
+from buffers import SessionBuffer, RESULT_CODES, RESULT_LETTERS, MISSING
+
+MAGIC = b'PASATJ1\n'
+# The types of the records
+SESSION_START = 1 # session id and the session header (JSON)
+RESPONSE = 2 # session id, trial, result code, reaction time, dispatch latency
+SESSION_END = 3 # session id
+_FRAME = struct.Struct('<BI')
+_CRC = struct.Struct('<I')
+_SESSION_ID = struct.Struct('<Q')
+_RESPONSE = struct.Struct('<QIbff')
+# Markers queued to the writer thread
+_TRUNCATE = object()
+_CLOSE = object()
+
+def encode_record(record_type, payload):
+    frame = _FRAME.pack(record_type, len(payload)) + payload
+    return frame + _CRC.pack(zlib.crc32(frame))
+
+def iter_records(filepath):
+    """
+    Yields the (type, payload) of the records of the journal, until its end
+    or the first incomplete or corrupted record
+    """
+    if not os.path.isfile(filepath):
+        return
+    with open(filepath, 'rb') as journal_file:
+        if journal_file.read(len(MAGIC)) != MAGIC:
+            return
+        while True:
+            frame = journal_file.read(_FRAME.size)
+            if len(frame) < _FRAME.size:
+                return
+            record_type, length = _FRAME.unpack(frame)
+            payload = journal_file.read(length)
+            crc = journal_file.read(_CRC.size)
+            if len(payload) < length or len(crc) < _CRC.size or \
+               _CRC.unpack(crc)[0] != zlib.crc32(frame + payload):
+                return
+            yield record_type, payload
+
+def recover(filepath):
+    """
+    Returns the sessions of the journal which have not been ended, as a list
+    of OrderedDicts with the session header (see JournalWriter.start_session)
+    and the results, reaction_times and dispatch_latencies of the responses
+    journaled, in the format of the results file
+    """
+    sessions = OrderedDict()
+    buffers = {}
+    for record_type, payload in iter_records(filepath):
+        if record_type == SESSION_START:
+            session_id, = _SESSION_ID.unpack_from(payload)
+            sessions[session_id] = json.loads(payload[_SESSION_ID.size:].decode('utf-8'),
+                                              object_pairs_hook=OrderedDict)
+            buffers[session_id] = SessionBuffer()
+        elif record_type == RESPONSE:
+            session_id, trial, code, reaction_time, dispatch_latency = _RESPONSE.unpack(payload)
+            # Only the responses in order are kept, e.g. not a response journaled
+            # twice, so the trials stay aligned with the stimuli
+            if session_id in buffers and trial == len(buffers[session_id]):
+                buffers[session_id].add(RESULT_LETTERS[code],
+                                        None if reaction_time != reaction_time else reaction_time,
+                                        None if dispatch_latency != dispatch_latency else dispatch_latency)
+        elif record_type == SESSION_END:
+            session_id, = _SESSION_ID.unpack(payload)
+            sessions.pop(session_id, None)
+    recovered = []
+    for session_id, session in sessions.items():
+        buffer = buffers[session_id]
+        session['results'] = buffer.results_list()
+        session['reaction_times'] = buffer.reaction_times_list()
+        session['dispatch_latencies'] = buffer.dispatch_latencies_list()
+        recovered.append(session)
+    return recovered
+
+def new_journal_filepath(journal_dir):
+    """
+    Returns the path of a new journal in journal_dir, named by the time and
+    the process
+    """
+    return os.path.join(journal_dir, "%s-%d.journal" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+
+def _remove_lock_file(filepath):
+    try:
+        os.remove(filepath + '.lock')
+    except OSError:
+        pass
+
+def recover_abandoned(journal_dir, save):
+    """
+    Recovers the journals of journal_dir which are not locked by a running
+    instance: calls save(session) for each of their sessions which have not
+    been ended and have responses (see recover), and removes each journal once all of its
+    sessions are saved. Returns the number of sessions saved. If save raises,
+    the journal is kept and the exception is raised.
+    """
+    n_saved = 0
+    for filepath in sorted(glob.glob(os.path.join(journal_dir, "*.journal"))):
+        with helpers.locked(filepath, blocking=False) as claimed:
+            # Also skipped if another instance has just recovered it
+            if not claimed or not os.path.isfile(filepath):
+                continue
+            for session in recover(filepath):
+                # The sessions without responses have nothing to save
+                if session['results']:
+                    save(session)
+                    n_saved += 1
+            os.remove(filepath)
+        _remove_lock_file(filepath)
+    return n_saved
+
+class SessionJournal:
+    """
+    The journal of one session, returned by JournalWriter.start_session and
+    passed to its SessionEngine, which journals every scored response
+    """
+    def __init__(self, writer, session_id):
+        self.writer = writer
+        self.session_id = session_id
+
+    def response(self, trial, result, reaction_time=None, dispatch_latency=None):
+        self.writer.append(RESPONSE, _RESPONSE.pack(self.session_id, trial, RESULT_CODES[result],
+                                                    MISSING if reaction_time is None else reaction_time,
+                                                    MISSING if dispatch_latency is None else dispatch_latency))
+
+    def end(self):
+        """
+        Marks the session as ended, so that it is not recovered
+        """
+        self.writer.end_session(self.session_id)
+
+class JournalWriter:
+    """
+    Appends the records to the journal at filepath from a background thread,
+    which writes and fsyncs the records queued at once. The journal is locked
+    until the writer is closed.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._lock_file = helpers.acquire_lock(filepath)
+        self.queue = queue.Queue()
+        # The sessions which have been started and not ended
+        self.open_sessions = set()
+        self._last_session_id = 0
+        self._file = open(filepath, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._sync()
+        self._thread = threading.Thread(target=self._run, name="JournalWriter", daemon=True)
+        self._thread.start()
+
+    def append(self, record_type, payload):
+        """
+        Queues a record to be written, without waiting for it
+        """
+        self.queue.put(encode_record(record_type, payload))
+
+    def start_session(self, mode, player_name, player_code, interval, stimuli):
+        """
+        Journals the start of a session and returns its SessionJournal
+        """
+        # Unique across launches, as the journal may hold sessions of an earlier one
+        session_id = max(time.time_ns(), self._last_session_id + 1)
+        self._last_session_id = session_id
+        self.open_sessions.add(session_id)
+        header = OrderedDict([('mode', mode),
+                              ('player_name', player_name),
+                              ('player_code', player_code),
+                              ('interval', interval),
+                              ('stimuli', [list(stimulus) if isinstance(stimulus, tuple) else stimulus
+                                           for stimulus in stimuli]),
+                              ('started', time.strftime("%Y-%m-%d %H:%M:%S"))])
+        self.append(SESSION_START, _SESSION_ID.pack(session_id) + json.dumps(header).encode('utf-8'))
+        return SessionJournal(self, session_id)
+
+    def end_session(self, session_id):
+        self.open_sessions.discard(session_id)
+        self.append(SESSION_END, _SESSION_ID.pack(session_id))
+
+    def truncate(self):
+        """
+        Empties the journal once the records queued so far are written, if no
+        session is open, i.e. once the results of the sessions have been saved
+        """
+        if not self.open_sessions:
+            self.queue.put(_TRUNCATE)
+
+    def sync(self, timeout=None):
+        """
+        Waits until the records queued so far are on the disk
+        """
+        written = threading.Event()
+        self.queue.put(written)
+        return written.wait(timeout)
+
+    def close(self):
+        """
+        Writes the records queued, stops the writer thread and unlocks the
+        journal. The journal is removed if no session is open, and is otherwise
+        kept to be recovered on the next launch (e.g. a session whose results
+        were not saved).
+        """
+        if self._thread.is_alive():
+            self.queue.put(_CLOSE)
+            self._thread.join()
+        if self._lock_file is not None:
+            if not self.open_sessions:
+                os.remove(self.filepath)
+            helpers.release_lock(self._lock_file)
+            self._lock_file = None
+            if not self.open_sessions:
+                _remove_lock_file(self.filepath)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _run(self):
+        closed = False
+        while not closed:
+            # Block for the first item, then take all the items queued meanwhile
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiters = []
+            for item in items:
+                if item is _CLOSE:
+                    closed = True
+                elif item is _TRUNCATE:
+                    self._file.truncate(0)
+                    self._file.seek(0)
+                    self._file.write(MAGIC)
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    self._file.write(item)
+            self._sync()
+            for waiter in waiters:
+                waiter.set()
+        self._file.close()
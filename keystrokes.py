@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Keystroke-level log of the responses. Every digit, Enter, Backspace and
+answer button pressed in a session is logged by the SessionEngine with the
+trial it belongs to and its latency from the presentation of the stimulus
+(the same reference as the reaction times), so that the first-key latency,
+the inter-key intervals and the corrections of the answers can be analyzed,
+and not only the time of the final answer.
+
+The events are kept in a KeystrokeLog, a ring buffer of preallocated typed
+arrays: logging an event stores four numbers in them, and nothing grows while
+the session runs. The SessionEngine sizes it from the length of the session
+(capacity_for), and if more events are logged than it holds anyway, the
+oldest ones are dropped: their number is reported (KeystrokeLog.dropped,
+SessionEngine.keystrokes_dropped) and the latencies of the trials they
+belonged to are unknown (None). At the end of the session the log is flushed
+into a list of events for the session record (see SessionEngine.record).
+"""
+
+from array import array
+
+# The keys logged
+DIGIT = 1
+ENTER = 2
+ERASE = 3 # Backspace
+BUTTON = 4 # an answer button, with the answer as the value
+KEY_NAMES = {DIGIT: 'digit', ENTER: 'enter', ERASE: 'erase', BUTTON: 'button'}
+# The keys which confirm an answer
+CONFIRMING_KEYS = (ENTER, BUTTON)
+# Events kept before the oldest ones are overwritten (about 1000 trials of
+# two-digit answers with a correction)
+DEFAULT_CAPACITY = 4096
+# The events per trial a log is sized for (two answers of two digits with a
+# correction, and Enter)
+KEYS_PER_TRIAL = 8
+
+def capacity_for(n_trials):
+    """
+    Returns the capacity of the log of a session of n_trials trials
+    """
+    return max(DEFAULT_CAPACITY, KEYS_PER_TRIAL * n_trials)
+
+class KeystrokeLog:
+    """
+    A ring buffer of the last capacity events, each stored as its trial (the
+    index of the response it belongs to), key, value (the digit or the answer
+    of a button, 0 otherwise) and latency in seconds
+    """
+    __slots__ = ('capacity', 'trials', 'keys', 'values', 'latencies', 'count')
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.trials = array('i', [0]) * capacity
+        self.keys = array('b', [0]) * capacity
+        self.values = array('b', [0]) * capacity
+        self.latencies = array('d', [0.0]) * capacity
+        # The number of events logged since the last flush
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dropped(self):
+        """
+        The number of events which have been overwritten
+        """
+        return max(0, self.count - self.capacity)
+
+    def log(self, trial, key, value, latency):
+        index = self.count % self.capacity
+        self.trials[index] = trial
+        self.keys[index] = key
+        self.values[index] = value
+        self.latencies[index] = latency
+        self.count += 1
+
+    def events(self):
+        """
+        Yields the events kept as (trial, key, value, latency), from the oldest
+        """
+        start = self.count - len(self)
+        for position in range(start, self.count):
+            index = position % self.capacity
+            yield self.trials[index], self.keys[index], self.values[index], self.latencies[index]
+
+    def trial_latencies(self, n_trials):
+        """
+        Returns the first-key latencies (of the first digit or button) and the
+        completion latencies (of the Enter or button which confirmed the answer,
+        or of the last digit typed if it was not confirmed) of n_trials trials,
+        with 0 for the trials without keys, as the lists of the results file.
+        If events have been dropped, the latencies of the trials up to the
+        oldest event kept (which may have lost some of its events) are None.
+        """
+        first_key = [0] * n_trials
+        completion = [0] * n_trials
+        confirmed = [False] * n_trials
+        events = list(self.events())
+        if self.dropped:
+            unknown = min(n_trials, events[0][0] + 1) if events else n_trials
+            first_key[:unknown] = completion[:unknown] = [None] * unknown
+        for trial, key, value, latency in events:
+            if not 0 <= trial < n_trials:
+                continue
+            if first_key[trial] is None:
+                continue
+            latency = round(latency, 3)
+            if key in (DIGIT, BUTTON) and not first_key[trial]:
+                first_key[trial] = latency
+            if key in CONFIRMING_KEYS:
+                completion[trial] = latency
+                confirmed[trial] = True
+            elif key == DIGIT and not confirmed[trial]:
+                completion[trial] = latency
+        return first_key, completion
+
+    def flush(self):
+        """
+        Returns the events kept as a list of [trial, key name, value, latency]
+        and empties the log
+        """
+        events = [[trial, KEY_NAMES[key], value, round(latency, 3)]
+                  for (trial, key, value, latency) in self.events()]
+        self.count = 0
+        return events
@@ -7,14 +7,26 @@ Created on Wed Aug 28 15:56:33 2019
 @author: Amin Saberi
 """
 
+import sys
+# Imported first, to profile the other imports with --profile-startup
+import startup
+STARTUP_PROFILE_FILEPATH, EXIT_AFTER_STARTUP, NO_AUDIO = startup.parse_args(sys.argv)
+if STARTUP_PROFILE_FILEPATH:
+    startup.PROFILE.start()
 from PyQt5.QtWidgets import QApplication, QDialog, QPushButton, QHBoxLayout,\
  QGroupBox, QVBoxLayout, QLabel, QGridLayout, QLineEdit, QMessageBox,\
  QMainWindow, QAction, QFormLayout, QSpinBox, QCheckBox
 from PyQt5 import QtGui
 from PyQt5 import QtCore
-import sys, random, time
-import helpers
-from threads import PlayNumbersThread, PlayDemoThread, TimerThread, resource_path
+import os, json, datetime
+# storage (and sqlite3) is imported when the first results are saved
+import helpers, timing, tracing, journal, keystrokes
+from helpers import resource_path
+from audio import AudioEngine, ClipCache, NullSink, AudioUnavailableError
+from speech import SpeechIndex
+from engine import SessionEngine
+from threads import PlayNumbersThread, PlayDemoThread, PlayTrackThread
+startup.PROFILE.mark("imports")
 
 #TODO: Define sessions and trials
 #TODO: Used globals for the language change, it works but isn't a good practice!
@@ -26,10 +38,39 @@ PAIRS_IN_DEMO = 2
 INTERVAL = 3 #seconds
 TRIAL_LENGTH = NUMBERS_PER_TRIAL * INTERVAL #seconds
 AUTOSAVE = True
+# "csv": rewrite the results CSV file on every save (helpers.update_csv)
+# "append": append to a log file (storage.AppendOnlyStore), which can be
+# written as a results CSV file with `python storage.py compact`
+# "sqlite": save in an SQLite database (storage.SQLiteBackend)
+# "collector": send to the collector of the lab at the address in RESULTS_FILEPATHS
+# (storage.CollectorBackend, see collector.py), queueing the sessions while it is down
+# "archive": add to a memory-mapped session archive in the folder in RESULTS_FILEPATHS
+# (archive.SessionArchive), to query the sessions of a participant with `python archive.py show`
+RESULTS_STORAGE = "csv"
+RESULTS_FILEPATHS = {"csv": "results.csv", "append": "results.log", "sqlite": "results.sqlite",
+                     "collector": "127.0.0.1:8765", "archive": "archive"}
+# Every scored response is appended to a journal in this folder (None to
+# disable), one per running instance, from which the sessions interrupted by a
+# crash (or whose results were not saved) are recovered and saved on the next
+# launch. It is emptied when the results of the sessions are saved.
+JOURNAL_DIR = "journal"
+# If set, every finished session is also saved to this folder as a JSON record
+# of its stimuli, onsets and input, which can be replayed with replay.py
+SESSION_RECORDS_DIR = None
+# If set, the latencies of every trial of a session (scheduler, audio, signals,
+# GUI updates and responses) are traced and saved to this folder as a Chrome
+# trace JSON file, to be opened in chrome://tracing or ui.perfetto.dev
+TRACE_DIR = None
+# If True, the numbers of PASAT are rendered into one audio track which is
+# played continuously, and the numbers are shown when the playback reaches them
+# (threads.PlayTrackThread), so the onsets follow the audio clock
+PRERENDERED_TRACK = False
+# The point of each number the reaction times of PASAT are measured from:
+# "stimulus" (the start of its sound), "speech onset" or "speech offset" (of
+# the spoken digit, detected once per audio file, see speech.py)
+RT_REFERENCE = "stimulus"
 LANGUAGE = "en"
 _, _n = helpers.redefine_gettext(LANGUAGE)
-
-EXIT_CODE_REBOOT = -123
         
 #### Main Window ####
 class Window(QMainWindow):
@@ -37,14 +78,14 @@ class Window(QMainWindow):
     The main Window of the program. See the documentation on each function for
     more detail.
     """
-    def __init__(self):
+    def __init__(self, audio_engine):
         """
         With the help of InitWindow(), initializes the window and draws the initial
-        objects on the screen. Also, random_numbers list are defined here, which will
-        be later passed on to PlayNumbersThread via self._start. Also, baseline states
-        of the program (answerButton_clicked and current_typed_answer) are initialized
-        here, as well as self.played_numbers which will store the numbers that had been
-        played so far.
+        objects on the screen. Also, baseline states of the program are initialized
+        here. The state of a PASAT or demo session (numbers played, answers and
+        their scores) is kept by an engine.SessionEngine, which is created in
+        self._start or self._start_demo. audio_engine (audio.AudioEngine) is created once in __main__ and
+        has the sounds of all the languages loaded.
         """
         # Using super() initilize an empty window, and then populate it
         # using self.InitWindow()
@@ -54,11 +95,7 @@ class Window(QMainWindow):
         self.left = 100
         self.width = 800
         self.height = 600
-        # this is necessary for changing the language from the menu. every time
-        # language is changed, __init__ is called again, and _ and _n need to be
-        # redefined
-        global _, _n
-        _, _n = helpers.redefine_gettext(LANGUAGE)
+        self.audio_engine = audio_engine
 
         # Set the title and geometry of the window
         self.setWindowIcon(QtGui.QIcon(resource_path("icon.ico")))
@@ -71,16 +108,11 @@ class Window(QMainWindow):
                 
         self.player_name = ''
         self.player_code = ''
-        # Initilize answerButton_clicked, so that when during an INTERVAL that
-        # a number has been played, user cannot click on more than one answers,
-        # and also cannot use keyboard to type the answer
-        self.answerButton_clicked = False
-        # Initialize allow_answer. Do not allow_answer (inside _on_click_answer and 
-        # keyboard handler), until more than one numbers have been presented
-        self.allow_answer = False
-        # Initialize the current_typed_answer (which is the value for self.answer_input).
-        # This will record the typed answer, and is reset after each interval
-        self.current_typed_answer = ''
+        # The engine of the current session (self.engine), and the last PASAT and
+        # demo sessions, which are saved together
+        self.engine = None
+        self.pasat_engine = None
+        self.demo_engine = None
         # Record if the trial has been started, so clicking start afterwards wouldn't
         # do anything.
         self.trial_started = False
@@ -88,19 +120,41 @@ class Window(QMainWindow):
         self.mode = ''
         # By default, show the demo. Can change it in the preferences.
         self.show_demo_on = True
-        # Initialize time_presented. This is not the time_presented for the first
-        # number, it's only here to prevent undefined error.
         self.show_timer_on = False
-        self.time_presented = time.time()
-        self.csv_filepath = 'results.csv' #TODO
+        # Initialize session_clock. It is replaced when a PASAT or demo is started,
+        # it's only here to prevent undefined error.
+        self.session_clock = timing.SessionClock()
+        # The timer_label is updated by sampling the session_clock on each tick
+        # of self.timer
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self._update_timer)
+        # Timestamp (ms, QInputEvent.timestamp()) of the last key or mouse response
+        # in the current interval, which is mapped onto the session clock by
+        # event_time_mapper to calculate the reaction time
+        self.last_input_timestamp = None
+        self.event_time_mapper = timing.EventTimestampMapper()
+        # A new tracing.Tracer is used for each session if TRACE_DIR is set
+        self.tracer = tracing.NULL_TRACER
+        # The results backend is opened when the first results are saved
+        self.results_backend = None
+        # The sessions interrupted in the earlier launches are saved from their
+        # journals, and the sessions of this launch are journaled in a new one
+        self.journal_writer = None
+        if JOURNAL_DIR:
+            self._recover_journals()
+            self.journal_writer = journal.JournalWriter(journal.new_journal_filepath(JOURNAL_DIR))
         
  
     def CreateMenu(self):
+        """
+        Creates the menus. Their texts are set by retranslateUi.
+        """
         mainMenu = self.menuBar()
-        sessionMenu = mainMenu.addMenu(_('Session'))
-        runMenu = mainMenu.addMenu(_('Run'))
-        optionsMenu = mainMenu.addMenu(_('Options'))
-        helpMenu = mainMenu.addMenu(_('Help'))
+        self.sessionMenu = sessionMenu = mainMenu.addMenu('')
+        self.runMenu = runMenu = mainMenu.addMenu('')
+        self.optionsMenu = optionsMenu = mainMenu.addMenu('')
+        self.helpMenu = helpMenu = mainMenu.addMenu('')
         
 #        newSessionAction = QAction(_('New Session'), self)
 #        sessionMenu.addAction(newSessionAction)
@@ -108,47 +162,46 @@ class Window(QMainWindow):
 #        sessionMenu.addAction(saveSessionAction)
 #        showSessionResultsAction = QAction(_("Show Results"), self)
 #        sessionMenu.addAction(showSessionResultsAction)
-        exitAction = QAction(_("Exit"), self)
-        exitAction.triggered.connect(self._exit)
-        sessionMenu.addAction(exitAction)
+        self.exitAction = QAction(self)
+        self.exitAction.triggered.connect(self._exit)
+        sessionMenu.addAction(self.exitAction)
         
-        self.startRunAction = QAction(_("Start"), self)
+        self.startRunAction = QAction(self)
         self.startRunAction.triggered.connect(self._start)
         runMenu.addAction(self.startRunAction)
-        self.demoRunAction = QAction(_("Demo"), self)
+        self.demoRunAction = QAction(self)
         self.demoRunAction.triggered.connect(self._start_demo)
         runMenu.addAction(self.demoRunAction)
-        self.stopRunAction = QAction(_("Stop"), self)
+        self.stopRunAction = QAction(self)
         self.stopRunAction.setEnabled(False)
         self.stopRunAction.triggered.connect(self._stop)
         runMenu.addAction(self.stopRunAction)
-        self.pauseRunAction = QAction(_("Pause"), self)
+        self.pauseRunAction = QAction(self)
         self.pauseRunAction.setEnabled(False)
         self.pauseRunAction.triggered.connect(self._pause)
         runMenu.addAction(self.pauseRunAction)
-        self.resumeRunAction = QAction(_("Resume"), self)
+        self.resumeRunAction = QAction(self)
         self.resumeRunAction.setEnabled(False)
         self.resumeRunAction.triggered.connect(self._resume)
         runMenu.addAction(self.resumeRunAction)
         
-        preferencesAction = QAction(_("Preferences"), self)
-        preferencesAction.triggered.connect(self.ShowPreferences)
-        optionsMenu.addAction(preferencesAction)
-        languagesMenu = optionsMenu.addMenu(_("Languages"))
-        faAction = QAction(_("Farsi"), self)
-        if LANGUAGE == "fa":
-            faAction.setEnabled(False)
-        faAction.triggered.connect(self._change_language)
-        languagesMenu.addAction(faAction)
-        enAction = QAction(_("English"), self)
-        if LANGUAGE == "en":
-            enAction.setEnabled(False)
-        enAction.triggered.connect(self._change_language)
-        languagesMenu.addAction(enAction)
+        self.preferencesAction = QAction(self)
+        self.preferencesAction.triggered.connect(self.ShowPreferences)
+        optionsMenu.addAction(self.preferencesAction)
+        self.languagesMenu = optionsMenu.addMenu('')
+        # The language of each action is kept in its data
+        self.faAction = QAction(self)
+        self.faAction.setData("fa")
+        self.faAction.triggered.connect(self._change_language)
+        self.languagesMenu.addAction(self.faAction)
+        self.enAction = QAction(self)
+        self.enAction.setData("en")
+        self.enAction.triggered.connect(self._change_language)
+        self.languagesMenu.addAction(self.enAction)
         
-        aboutAction = QAction(_("About"), self)
-        aboutAction.triggered.connect(self._show_about)
-        helpMenu.addAction(aboutAction)
+        self.aboutAction = QAction(self)
+        self.aboutAction.triggered.connect(self._show_about)
+        helpMenu.addAction(self.aboutAction)
 #        helpAction = QAction(_("How it woks"), self)
 #        helpMenu.addAction(helpAction)
 
@@ -161,8 +214,11 @@ class Window(QMainWindow):
         registerForm are hidden before that the registration is completed. They are .show n
         inside _on_click_register. TODO: There might be a better solution to this.
         """        
-        # Initialize the vertical layout container vbox
+        # Initialize the vertical layout container vbox. Its first paint ends
+        # the startup (see eventFilter)
         self.mainBox = QGroupBox()
+        self.mainBox.installEventFilter(self)
+        self.first_painted = False
         vbox = QVBoxLayout()
         
         self.CreateRegisterForm()
@@ -173,6 +229,8 @@ class Window(QMainWindow):
         self.number_label.setAlignment(QtCore.Qt.AlignCenter)
         self.number_label.setFont(QtGui.QFont("Sanserif", 20)) #TODO: Change to Farsi fonts and embedd it to the .exe file
         self.number_label.hide()
+        # Its paint events are traced (see eventFilter)
+        self.number_label.installEventFilter(self)
         vbox.addWidget(self.number_label)
         
         # Add the timer_label below the played number label TODO: maybe change its position
@@ -180,6 +238,12 @@ class Window(QMainWindow):
         self.timer_label.setAlignment(QtCore.Qt.AlignCenter)
         self.timer_label.hide()
         vbox.addWidget(self.timer_label)
+
+        # Add the performance_label, a live readout of the correct answers so far
+        self.performance_label = QLabel()
+        self.performance_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.performance_label.hide()
+        vbox.addWidget(self.performance_label)
         
         # Add the answerButtons which are QPushButtons from [1 to 20], and
         # serve as one way of entering the answer
@@ -187,7 +251,7 @@ class Window(QMainWindow):
         self.answerButtons.hide()
         vbox.addWidget(self.answerButtons)
         
-        # Add the answer_input which prints the self.current_typed_answer
+        # Add the answer_input which prints the typed answer
         # and serves as another way of entering the answer. Could've used text-input,
         # but this seems more suitable for my purpose.
         self.answer_input = QLineEdit()
@@ -215,10 +279,43 @@ class Window(QMainWindow):
         # widgets and groups of widgets)
         self.mainBox.setLayout(vbox)
         self.setCentralWidget(self.mainBox)
+        self.retranslateUi()
         
         # Display the Window
         self.show()
 
+    def retranslateUi(self):
+        """
+        Sets the texts of the menus and the widgets in the current LANGUAGE.
+        Called when the Window is created and whenever the language is changed.
+        """
+        self.sessionMenu.setTitle(_('Session'))
+        self.runMenu.setTitle(_('Run'))
+        self.optionsMenu.setTitle(_('Options'))
+        self.helpMenu.setTitle(_('Help'))
+        self.exitAction.setText(_("Exit"))
+        self.startRunAction.setText(_("Start"))
+        self.demoRunAction.setText(_("Demo"))
+        self.stopRunAction.setText(_("Stop"))
+        self.pauseRunAction.setText(_("Pause"))
+        self.resumeRunAction.setText(_("Resume"))
+        self.preferencesAction.setText(_("Preferences"))
+        self.languagesMenu.setTitle(_("Languages"))
+        self.faAction.setText(_("Farsi"))
+        self.faAction.setEnabled(LANGUAGE != "fa")
+        self.enAction.setText(_("English"))
+        self.enAction.setEnabled(LANGUAGE != "en")
+        self.aboutAction.setText(_("About"))
+
+        self.name_label.setText(_("Name"))
+        self.code_label.setText(_("Code"))
+        self.submit_btn.setText(_("Register"))
+        for (i, btn) in enumerate(self.btns):
+            btn.setText(_n(str(i + 1)))
+        self.start_btn.setText(_("Start"))
+        self.demo_btn.setText(_("Demo"))
+        self.exit_btn.setText(_("Exit"))
+
     def CreateRegisterForm(self):
         """
         Shows a registration form at the top of the window. Handles the
@@ -228,15 +325,15 @@ class Window(QMainWindow):
         hbox = QHBoxLayout()
         self.name_input = QLineEdit(self)
 #        self.lineedit.setFont(QtGui.QFont("Sanserif", 15))
-        name_label = QLabel(_("Name"))
+        self.name_label = QLabel()
 #        self.label.setFont(QtGui.QFont("Sanserif", 15))
         self.code_input = QLineEdit(self)
-        code_label = QLabel(_("Code"))
-        self.submit_btn = QPushButton(_("Register"))
+        self.code_label = QLabel()
+        self.submit_btn = QPushButton()
         self.submit_btn.clicked.connect(self._on_click_register)
-        hbox.addWidget(name_label)
+        hbox.addWidget(self.name_label)
         hbox.addWidget(self.name_input)
-        hbox.addWidget(code_label)
+        hbox.addWidget(self.code_label)
         hbox.addWidget(self.code_input)
         hbox.addWidget(self.submit_btn)
         hbox.setAlignment(QtCore.Qt.AlignTop)
@@ -252,9 +349,11 @@ class Window(QMainWindow):
         self.btns = []
         for i in range(2):
             for j in range(10):
-                btn = QPushButton(_n(str(10*i + j + 1)))
-                btn.setMaximumWidth(self.width/12)
+                btn = QPushButton()
+                btn.setMaximumWidth(self.width//12)
                 btn.clicked.connect(self._on_click_answer)
+                # Catch the mouse events of the button for their timestamps
+                btn.installEventFilter(self)
                 gridLayout.addWidget(btn, i, j)
                 self.btns.append(btn)
         self.answerButtons.setLayout(gridLayout)
@@ -268,17 +367,17 @@ class Window(QMainWindow):
         self.actionButtons = QGroupBox()
         hboxLayout = QHBoxLayout()
 
-        self.start_btn = QPushButton(_("Start"), self)
+        self.start_btn = QPushButton(self)
         self.start_btn.setMinimumHeight(40)
         self.start_btn.clicked.connect(self._start)
         hboxLayout.addWidget(self.start_btn)
         
-        self.demo_btn = QPushButton(_("Demo"), self)
+        self.demo_btn = QPushButton(self)
         self.demo_btn.setMinimumHeight(40)
         self.demo_btn.clicked.connect(self._start_demo)
         hboxLayout.addWidget(self.demo_btn)
 
-        self.exit_btn = QPushButton(_("Exit"), self)
+        self.exit_btn = QPushButton(self)
         self.exit_btn.setMinimumHeight(40)
         self.exit_btn.clicked.connect(self._exit)
         hboxLayout.addWidget(self.exit_btn)        
@@ -297,7 +396,7 @@ class Window(QMainWindow):
             self.results_dialog.setWindowTitle(_("Results"))
         elif self.mode == 'Demo':
             self.results_dialog.setWindowTitle(_("Demo Results"))            
-        self.results_dialog.setGeometry(self.left, self.top, self.width*0.75, self.height*0.75)
+        self.results_dialog.setGeometry(self.left, self.top, int(self.width*0.75), int(self.height*0.75))
         helpers.center_widget(App, self.results_dialog)
         
         # Initialize the vertical layout container vbox and add the title
@@ -324,7 +423,7 @@ class Window(QMainWindow):
             vbox.addWidget(QLabel(_("Results were automatically saved")))
         else:
             cancel_btn = QPushButton(_("Discard"))
-            cancel_btn.clicked.connect(self.results_dialog.close)
+            cancel_btn.clicked.connect(self._discard_results)
             save_btn = QPushButton(_("Save"))
             save_btn.clicked.connect(self._save_results)   
             vbox.addWidget(cancel_btn)
@@ -345,7 +444,7 @@ class Window(QMainWindow):
         """
         self.preferences_dialog = QDialog(self)
         self.preferences_dialog.setWindowTitle(_("Preferences"))
-        self.preferences_dialog.setGeometry(self.left, self.top, self.width*0.75, self.height*0.75)
+        self.preferences_dialog.setGeometry(self.left, self.top, int(self.width*0.75), int(self.height*0.75))
         helpers.center_widget(App, self.preferences_dialog)
         
         vbox = QVBoxLayout()
@@ -402,6 +501,7 @@ class Window(QMainWindow):
             self.player_code = self.code_input.text()
             self.number_label.show()
             self.timer_label.show()
+            self.performance_label.show()
             self.answer_input.show()
             self.answerButtons.show()
             self.actionButtons.show()
@@ -415,39 +515,33 @@ class Window(QMainWindow):
     def _start_demo(self):
         """
         By clicking demo button, if it has not already started, the task begins. 
-        This functions initializes, runs and talks with two simultaneous 
-        (and independent) threads: PlayPairsThread which shows the pairs of 
-        random_numbers one by one (e.g. 2 + 5), and TimerThread which updates 
-        the timer_label.
+        This functions initializes, runs and talks with PlayDemoThread which
+        shows the pairs of random_numbers one by one (e.g. 2 + 5). The session
+        clock of the thread is sampled by self.timer to update the timer_label.
         """
         if not (self.trial_started | self.demo_started):
-            # Create pairs (n = PAIRS_IN_DEMO) to be used in PlayDemoThread
-            self.current_pair = ()
-            # Keep track of reaction_times and "C" (correct)/"I" (incorrect)/"N" (not answered)
-            self.demo_reaction_times = []
-            self.demo_results = []
-            
-            self.demo_pairs = []
-            for dummy in range(PAIRS_IN_DEMO):
-                self.demo_pairs.append((random.randint(1,10), random.randint(1,10)))
-            # Initialize and start the self.demo_thread
-            self.demo_thread = PlayDemoThread(self.demo_pairs, INTERVAL)
-            self.demo_thread.start()
+            # Create a new session with PAIRS_IN_DEMO pairs to be used in PlayDemoThread
+            # (the results of the last demo are discarded if they were not saved)
+            self._end_journal(self.demo_engine)
+            self.demo_engine = SessionEngine('Demo', PAIRS_IN_DEMO, INTERVAL)
+            self.engine = self.demo_engine
+            self._start_journal()
+            self.tracer = tracing.Tracer() if TRACE_DIR else tracing.NULL_TRACER
+            self.demo_thread = PlayDemoThread(self.engine.stimuli, INTERVAL, self.engine.clock, self.tracer)
             # self.demo_thread will signal self._update_demo_pair when a new_pair is up
             self.demo_thread.new_pair.connect(self._update_demo_pair)
             # self.demo_thread will signal self._demo_finished when all pairs have been read
             self.demo_thread.finished.connect(self._finished)
+            # Start the self.demo_thread
+            self.demo_thread.start()
             
-            # Initialize and start the self.timer_thread
+            # Use the session clock for timer_label and reaction times
+            self.session_clock = self.engine.clock
             if self.show_timer_on:
-                self.timer_thread = TimerThread(PAIRS_IN_DEMO * INTERVAL)
-                self.timer_thread.start()
-                self.timer_thread.time_step.connect(self._update_timer)
+                self.timer.start()
             
             # Change the state of the program
             self.demo_started = True
-            self.allow_answer = False
-            self.answerButton_clicked = False
             self.mode = 'Demo'
             self.demo_btn.setEnabled(False)
             self.start_btn.setEnabled(False)
@@ -457,32 +551,32 @@ class Window(QMainWindow):
     def _start(self):
         """
         By clicking start, if it has not already started, the task begins. 
-        This functions initializes, runs and talks with two simultaneous 
-        (and independent) threads: PlayNumbersThread which shows and reads aloud 
-        the random_numbers one by one, and TimerThread which updates the timer_label.
+        This functions initializes, runs and talks with PlayNumbersThread which
+        shows and reads aloud the random_numbers one by one. The session clock
+        of the thread is sampled by self.timer to update the timer_label.
         """
         if not self.trial_started:
-            self.reaction_times = []
-            self.results = []
-            self.played_numbers = []
-            # Create a list of random_numbers with the length of NUMBERS_PER_TRIAL. The range
-            # of random numbers is [1, 10], so the possible answers are [2, 20]
-            self.random_numbers = []
-            for dummy in range(NUMBERS_PER_TRIAL):
-                self.random_numbers.append(random.randint(1,10))
-            self.audio_thread = PlayNumbersThread(self.random_numbers, INTERVAL, LANGUAGE)
-            self.audio_thread.start()
+            # Create a new session with NUMBERS_PER_TRIAL random numbers
+            # (the results of the last PASAT are discarded if they were not saved)
+            self._end_journal(self.pasat_engine)
+            self.pasat_engine = SessionEngine('PASAT', NUMBERS_PER_TRIAL, INTERVAL,
+                                              reference_offsets=self.audio_engine.reference_offsets(LANGUAGE, RT_REFERENCE))
+            self.engine = self.pasat_engine
+            self._start_journal()
+            self.tracer = tracing.Tracer() if TRACE_DIR else tracing.NULL_TRACER
+            thread_class = PlayTrackThread if PRERENDERED_TRACK else PlayNumbersThread
+            self.audio_thread = thread_class(self.engine.stimuli, INTERVAL, LANGUAGE, self.audio_engine,
+                                             self.engine.clock, self.tracer)
             self.audio_thread.new_number.connect(self._update_number)
             self.audio_thread.finished.connect(self._finished)
+            self.audio_thread.start()
             
+            # Use the session clock for timer_label and reaction times
+            self.session_clock = self.engine.clock
             if self.show_timer_on:
-                self.timer_thread = TimerThread(TRIAL_LENGTH)
-                self.timer_thread.start()
-                self.timer_thread.time_step.connect(self._update_timer)
+                self.timer.start()
             
             self.trial_started = True
-            self.allow_answer = False
-            self.answerButton_clicked = False
             self.mode = 'PASAT'
             self.demo_btn.setEnabled(False)
             self.start_btn.setEnabled(False)
@@ -494,35 +588,32 @@ class Window(QMainWindow):
         When a button from answerButtons is clicked, this function is activated,
         which simply passes on the number that has been clicked to _submit_answer.
         """
-        # Do not change answer_input if allow_answer is False (i.e. only one number
-        # has been presented)
-        if not self.allow_answer:
-            return
         # Identify the button clicked using self.sender() and then _submit_answer
-        if not self.answerButton_clicked:
-            btn = self.sender()
-            self.answerButton_clicked = True
-            # Based on the state of program, decide which scorer function to use
-            if self.mode == 'PASAT':
-                self._submit_answer(btn.text())
-            elif self.mode == 'Demo':
-                self._submit_demo_answer(btn.text())
+        btn = self.sender()
+        self._submit_answer(btn.text(), keystrokes.BUTTON)
         
     def _answer_input_return_pressed(self):
         """
         When Key_Return or Key_Enter is pressed while focus is on answer_input
         (which is always, since keyPressEvent sets focus to answer_input), relays
-        current text of answer_input to _submit_answer or _submit_demo_answer
-        depending on self.mode
+        current text of answer_input to _submit_answer
         """
-        if not self.allow_answer:
-            return
-        if not self.answerButton_clicked:
-            self.answerButton_clicked = True
-            if self.mode == 'PASAT':
-                self._submit_answer(self.answer_input.text())
-            elif self.mode == 'Demo':
-                self._submit_demo_answer(self.answer_input.text())
+        self._submit_answer(self.answer_input.text())
+
+    def eventFilter(self, obj, e):
+        """
+        Installed on the answer buttons. Records the timestamp of the mouse release
+        (which triggers the clicked signal) before _on_click_answer is called.
+        Also installed on number_label to trace when the stimulus is painted.
+        """
+        if e.type() == QtCore.QEvent.MouseButtonRelease:
+            self.last_input_timestamp = e.timestamp()
+        elif e.type() == QtCore.QEvent.Paint and obj is self.number_label and self.tracer.enabled:
+            self.tracer.instant("number_label paint", "gui", trial=self._trace_trial())
+        elif e.type() == QtCore.QEvent.Paint and obj is self.mainBox and not self.first_painted:
+            self.first_painted = True
+            self._on_first_paint()
+        return super().eventFilter(obj, e)
 
     def keyPressEvent(self, e):
         """
@@ -530,137 +621,133 @@ class Window(QMainWindow):
         if the focus is not already on the answer_input, catches the key pressed
         and if it's a number enters it in the answer_input
         """
-        # Do not change answer_input if allow_answer is False (i.e. only one number
-        # has been presented)
-        if not self.allow_answer:
+        # Do not change answer_input if answers are not accepted (e.g. only one
+        # number has been presented)
+        if self.engine is None or not self.engine.accepting:
             return
-        # Backspace will remove the last digit
+        self.last_input_timestamp = e.timestamp()
         # self.answer_input.setFocus()
         if e.key() in [QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter]:
             self._answer_input_return_pressed() 
+        elif e.key() == QtCore.Qt.Key_Backspace:
+            # Backspace removes the last digit, which is logged as a correction
+            if self.engine.erase_digit(*self._get_response_time()):
+                self.answer_input.setText(self.engine.typed_answer)
+            return
         try:
             key_str = chr(e.key())
         except:
             pass
         else:
             if key_str in ['0','1','2','3','4','5','6','7','8','9']:
-                self.current_typed_answer += key_str
-                self.answer_input.setText(self.current_typed_answer)
+                # If the answer is not confirmed by Enter, the engine scores
+                # it at the next number, timed to the last digit typed
+                with self.tracer.span("type digit", "input", trial=self._trace_trial()):
+                    if self.engine.type_digit(key_str, *self._get_response_time()):
+                        self.answer_input.setText(self.engine.typed_answer)
                 
 ### Threads event handlers ###
     def _update_demo_pair(self, pair, time_presented):
         """
         This function is called whenever a new pair of numbers is presented by
-        PlayDemoThread (message is ralayed in the _start_demo). First,
-        if a answerButton has not already been clicked, or Key_Q has not
-        been pressed, the number currently in the current_typed_answer is
-        saved as the answer for the previous interval. Then the state variables
-        are reinitialized, and finally the new pair is shown on number_label,
-        the time it was presented is recorded and the current_pair is recorded
-        to be scored by _submit_demo_answer.
-        """
-        # If the answer has not been already entered, use the current value of
-        # current_typed_answer as the answer for previous interval. If no answer
-        # is provided, pass "" to the _submit_answer, which indicates not answered
-        if ((self.allow_answer) and (not self.answerButton_clicked)):
-            self._submit_demo_answer(self.current_typed_answer)
-        
-        self.answerButton_clicked = False
-        self.current_typed_answer = ''
-        self.answer_input.setText('')
-
-        self.time_presented = time_presented
-
-        self.number_label.setText(_n(str(pair[0])) + ' + ' + _n(str(pair[1])))
-        self.current_pair = pair
-        self.allow_answer = True
+        PlayDemoThread (message is ralayed in the _start_demo). The engine
+        scores the typed answer of the previous interval (if the answer has not
+        been already submitted) and records the new pair and the time it was
+        presented. Then answer_input is cleared and the new pair is shown on
+        number_label.
+        """
+        self._trace_dispatch(time_presented)
+        with self.tracer.span("gui update", "gui", trial=self._trace_trial()):
+            self.engine.present(pair, time_presented)
+            self._update_performance()
+            self.answer_input.setText('')
+            self.last_input_timestamp = None
+            self.number_label.setText(_n(str(pair[0])) + ' + ' + _n(str(pair[1])))
                     
     def _update_number(self, number, time_presented):
         """
         This function is called whenever a new number is presented by
-        PlayNumbersThread (message is ralayed in the _start). First,
-        if a answerButton has not already been clicked, or Key_Q has not
-        been pressed, the number currently in the current_typed_answer is
-        saved as the answer for the previous interval. Then the state variables
-        are reinitialized, and finally the new number is shown on number_label,
-        the time it was presented is recorded and it is added to the played_numbers
-        list.
-        """
-        # If the answer has not been already entered, use the current value of
-        # current_typed_answer as the answer for previous interval. If no answer
-        # is provided, pass "" to the _submit_answer, which indicates not answered
-        if ((self.allow_answer) and (not self.answerButton_clicked)):
-            self._submit_answer(self.current_typed_answer)
-
-        # Reinitialize state variables and answer_input
-        self.answerButton_clicked = False
-        self.current_typed_answer = ''
-        self.answer_input.setText('')
-
-        # Record the time that the new number was presented
-        self.time_presented = time_presented
-        # Add the new number to the played_numbers list
-        # Update the number_label text
-        self.number_label.setText(_n('%d'%number))
-        self.played_numbers.append(number)
-        if len(self.played_numbers) >= 2:
-            self.allow_answer = True
-
-    def _update_timer(self, total_time):
-        """
-        This function simply shows the total_time elapsed since
-        the start of the trial. TimerThread takes care of measuring
-        the time
-        """
-        self.timer_label.setText(_n('%.1f' % total_time))
+        PlayNumbersThread (message is ralayed in the _start). The engine
+        scores the typed answer of the previous interval (if the answer has not
+        been already submitted) and records the new number and the time it was
+        presented. Then answer_input is cleared and the new number is shown
+        on number_label.
+        """
+        self._trace_dispatch(time_presented)
+        with self.tracer.span("gui update", "gui", trial=self._trace_trial()):
+            self.engine.present(number, time_presented)
+            self._update_performance()
+            self.answer_input.setText('')
+            self.last_input_timestamp = None
+            self.number_label.setText(_n('%d'%number))
 
-### Test dynamics event handlers ###
-    def _submit_demo_answer(self, user_answer):
-        """
-        This is where demo answers are scored.
-        """
-        # Reaction time is calulated as the time elapsed since the number was
-        # presented till the user clicked or typed an answer
-        reaction_time = round(time.time()-self.time_presented, 1)
-        if user_answer:
-            # answer is a string, whether it comes from mouse or keyboard input
-            user_answer = int(user_answer)
-            correct_answer = self.current_pair[0] + self.current_pair[1]
-            if user_answer == correct_answer:
-                self.number_label.setText(_("Correct"))
-                self.demo_results.append('C')
-                self.demo_reaction_times.append(reaction_time)
-            else:
-                self.number_label.setText(_("Incorrect"))
-                self.demo_results.append('I')
-                self.demo_reaction_times.append(0)
-        else:
-            self.demo_results.append('N')
-            self.demo_reaction_times.append(0)
+    def _trace_trial(self):
+        """
+        Returns the index of the current trial (the last stimulus presented) for tracing
+        """
+        return self.engine.buffer.n_presented - 1 if self.engine is not None else None
 
-        
-    def _submit_answer(self,user_answer):
-        """
-        This is where answers are recorded and scored.
-        """
-        # Reaction time is calulated as the time elapsed since the number was
-        # presented till the user clicked or typed an answer
-        reaction_time = round(time.time()-self.time_presented, 1)
-        if user_answer:
-            # answer is a string, whether it comes from mouse or keyboard input
-            user_answer = int(user_answer)
-            correct_answer = self.played_numbers[-1] + self.played_numbers[-2]
-            if user_answer == correct_answer:
-                self.number_label.setText(_("Correct"))
-                self.results.append('C')
-                self.reaction_times.append(reaction_time)
-            else:
-                self.number_label.setText(_("Incorrect"))
-                self.results.append('I')
-                self.reaction_times.append(0)
+    def _trace_dispatch(self, time_presented):
+        """
+        Traces the time from the onset of the stimulus until its signal reached Window
+        """
+        if self.tracer.enabled:
+            onset_ns = self.session_clock.to_perf_counter_ns(int(time_presented * 1e9))
+            self.tracer.complete("signal dispatch", onset_ns, category="signal", trial=self._trace_trial() + 1)
+
+    def _update_timer(self):
+        """
+        This function is called on every tick of self.timer, and simply shows
+        the time elapsed since the start of the trial (excluding pauses),
+        sampled from the session_clock
+        """
+        self.timer_label.setText(_n('%.1f' % self.session_clock.elapsed()))
+
+    def _update_performance(self):
+        """
+        Shows the correct answers so far on performance_label, read from the
+        stats of the engine, which are updated with every scored answer
+        """
+        session_stats = self.engine.session_stats
+        if session_stats.n_responses:
+            self.performance_label.setText(_("Correct") + ": " + _n(str(session_stats.correct_count))
+                                           + " / " + _n(str(session_stats.n_responses)))
         else:
-            self.results.append('N')
-            self.reaction_times.append(0)
+            self.performance_label.setText('')
+
+### Test dynamics event handlers ###
+    def _get_response_time(self):
+        """
+        Returns the time of the current answer on the session clock, and the delay
+        until the event loop handled the input (dispatch latency), both in seconds.
+        The time of the answer is taken from the timestamp of the input event
+        (mapped onto the session clock), not from the time it reached the event handler.
+        """
+        if self.last_input_timestamp is None:
+            return self.session_clock.elapsed(), None
+        return self.event_time_mapper.map(self.last_input_timestamp, self.session_clock)
+
+    def _submit_answer(self, user_answer, key=keystrokes.ENTER):
+        """
+        This is where answers of PASAT and the demo are submitted to the engine,
+        which scores them. key is the key which submitted the answer
+        (keystrokes.ENTER or keystrokes.BUTTON). The result is shown on number_label.
+        """
+        # Ignore the answers before the session has started (e.g. an answer
+        # button clicked after Register) or while they are not accepted
+        if self.engine is None or not self.engine.accepting:
+            return
+        response_time, dispatch_latency = self._get_response_time()
+        if self.tracer.enabled:
+            self.tracer.instant("input event", "input", self.session_clock.to_perf_counter_ns(int(response_time * 1e9)),
+                                trial=self._trace_trial())
+        with self.tracer.span("response", "input", trial=self._trace_trial()):
+            result = self.engine.respond(user_answer, response_time, dispatch_latency, key)
+        self._update_performance()
+        if result == 'C':
+            self.number_label.setText(_("Correct"))
+        elif result == 'I':
+            self.number_label.setText(_("Incorrect"))
         
     def _finished(self):
         """
@@ -668,73 +755,185 @@ class Window(QMainWindow):
         calculates the stats, shows the results using ShowResultsDialog and
         restates the program so a new game can be started.
         """
-        # When only two numbers are shown, there's no results and this code can lead
-        # to errors. Just is here to prevent this error.
-        if type(self.sender()) == PlayNumbersThread:
-            results = self.results
-            reaction_times = self.reaction_times
+        self.engine.finish(self.sender().scheduler.onsets())
+        if self.mode == 'PASAT':
             self.number_label.setText(_("Finished"))
-        elif type(self.sender()) == PlayDemoThread:
-            results = self.demo_results
-            reaction_times = self.demo_reaction_times
+        elif self.mode == 'Demo':
             self.number_label.setText(_("Demo Finished"))
 
-        if results:
-            # Calculate correct_percent and mean_reaction_time (for correct answers that are nonzero)
-            correct_percent = 100 * (results.count('C')/len(results))
-            mean_reaction_time = helpers.non_zero_mean(reaction_times)
+        # When only two numbers are shown, there's no results
+        if self.engine.results:
             # Define stats to be shown in the statsgrid
-            self.stats = [(_('Correct Answers'), results.count('C')),
-                             (_('Incorrect Answers'), results.count('I')),
-                             (_('Not Answered'), results.count('N')),
-                             (_('Correct %'), correct_percent),
-                             (_('Results List'), results),
-                             (_('Reaction Times'), reaction_times),
-                             (_('Mean Reaction Time'),mean_reaction_time),
-                             (_('Last third correct - First third correct'), helpers.get_fatigability(results)),
-                             (_('Percent decrease in the last third'), helpers.get_fatigability(results, as_percent=True))]
+            self.stats = [(_(name), value) for (name, value) in self.engine.stats().items()]
             if AUTOSAVE:
                 self._save_results()
+            if SESSION_RECORDS_DIR:
+                self._save_record()
             self.ShowResultsDialog()
+            if self.engine.keystrokes_dropped:
+                self.statusBar().showMessage(_("%d keystrokes could not be logged, the keystroke latencies "
+                                               "of the first trials are missing") % self.engine.keystrokes_dropped)
+        else:
+            # Nothing to save
+            self._end_journal(self.engine)
+        if TRACE_DIR:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            self.tracer.save(os.path.join(TRACE_DIR, self._session_filename("trace.json")))
         
+        self.timer.stop()
         self.trial_started = False
         self.demo_started = False
-        self.allow_answer = False
         self.start_btn.setEnabled(True)
         self.demo_btn.setEnabled(True)
 
     def _save_results(self):
         """
-        Prepares the data for helpers.update_csv and calls it. Called if AUTOSAVE is enabled, 
-        or when Save button from results_dialog is
-        clicked. 
+        Prepares the data and saves it with the results backend of RESULTS_STORAGE.
+        Called if AUTOSAVE is enabled, or when Save button from results_dialog is
+        clicked. Only the sessions which have not been saved (or discarded) yet
+        are saved, the backends update the other modes of the player's results.
         """
+        engines = [engine for engine in (self.demo_engine, self.pasat_engine)
+                   if engine is not None and not engine.saved]
         all_results = {'Addition':[], 'PASAT':[]} #TODO inconsistent variable names
         all_reaction_times = {'Addition':[], 'PASAT':[]}
+        all_onsets = {'Addition':[], 'PASAT':[]}
+        all_dispatch_latencies = {'Addition':[], 'PASAT':[]}
+        all_stimuli = {'Addition':[], 'PASAT':[]}
+        all_stats = {}
+        all_keystroke_latencies = {'Addition':{'first key':[], 'completion':[]},
+                                   'PASAT':{'first key':[], 'completion':[]}}
         modes = []
         session_ids = {'Addition':1, 'PASAT':1} #TOOD
-        if hasattr(self, 'demo_results'):
-            all_results['Addition'] = self.demo_results
-            all_reaction_times['Addition'] = self.demo_reaction_times
-            modes.append('Addition')
-        if hasattr(self, 'results'):
-            all_results['PASAT'] = self.results
-            all_reaction_times['PASAT'] = self.reaction_times
-            modes.append('PASAT')
-        helpers.update_csv(self.csv_filepath, self.player_name, self.player_code,\
-                           all_results, all_reaction_times, modes, session_ids)
+        for engine in engines:
+            mode = engine.result_mode
+            all_results[mode] = engine.results
+            all_reaction_times[mode] = engine.reaction_times
+            all_onsets[mode] = engine.onsets
+            all_dispatch_latencies[mode] = engine.dispatch_latencies
+            all_stimuli[mode] = engine.stimuli
+            all_stats[mode] = engine.session_stats
+            all_keystroke_latencies[mode] = engine.keystroke_latencies
+            modes.append(mode)
+        if modes:
+            try:
+                self._open_results_backend().save_session(self.player_name, self.player_code, session_ids, modes,
+                                                  all_results, all_reaction_times, all_onsets,
+                                                  all_dispatch_latencies, all_stimuli, all_stats,
+                                                  all_keystroke_latencies)
+            except (ValueError, OSError) as error:
+                # The sessions are kept in the journal
+                QMessageBox.critical(self, "PASAT", _("The results could not be saved: %s") % error)
+                return
+        for engine in engines:
+            engine.saved = True
+            # The finished sessions are no longer needed in the journal once saved
+            if engine.finished:
+                self._end_journal(engine)
         try:
             self.results_dialog.close()
         except:
             pass
 
+    def _discard_results(self):
+        """
+        Called when the Discard button from results_dialog is clicked: the
+        finished sessions are ended in the journal, so they are not recovered
+        and saved on the next launch
+        """
+        for engine in (self.demo_engine, self.pasat_engine):
+            if engine is not None and engine.finished and not engine.saved:
+                engine.saved = True
+                self._end_journal(engine)
+        self.results_dialog.close()
+
+    def _open_results_backend(self):
+        """
+        Returns the results backend of RESULTS_STORAGE, which is opened the first time
+        """
+        if self.results_backend is None:
+            import storage
+            # Without a coalesce window, so every session is on disk once saved
+            self.results_backend = storage.open_backend(RESULTS_STORAGE, RESULTS_FILEPATHS[RESULTS_STORAGE])
+        return self.results_backend
+
+    def _start_journal(self):
+        """
+        Starts journaling the responses of the new session of self.engine
+        """
+        if self.journal_writer is not None:
+            self.engine.journal = self.journal_writer.start_session(self.engine.mode, self.player_name,
+                                                                    self.player_code, INTERVAL, self.engine.stimuli)
+
+    def _end_journal(self, engine):
+        """
+        Ends the journal of the session of engine (if any), once its results
+        are saved or discarded, and empties the journal if no other session is open
+        """
+        if engine is not None and engine.journal is not None:
+            engine.journal.end()
+            engine.journal = None
+            self.journal_writer.truncate()
+
+    def _recover_journals(self):
+        """
+        Saves the responses of the sessions which were interrupted in an earlier
+        launch (e.g. by a crash) from the journals which are not in use by
+        another running instance, with the results backend
+        """
+        try:
+            recovered = journal.recover_abandoned(JOURNAL_DIR, self._save_recovered_session)
+        except Exception as error:
+            # The journal is kept, to be recovered on the next launch
+            self.statusBar().showMessage(_("The interrupted sessions could not be recovered: %s") % error)
+            return
+        if recovered:
+            self.statusBar().showMessage(_("Recovered the results of %d interrupted session(s)") % recovered)
+
+    def _save_recovered_session(self, session):
+        """
+        Saves a session recovered from a journal (see journal.recover)
+        """
+        mode = 'PASAT' if session['mode'] == 'PASAT' else 'Addition'
+        all_results = {'Addition':[], 'PASAT':[]}
+        all_reaction_times = {'Addition':[], 'PASAT':[]}
+        all_dispatch_latencies = {'Addition':[], 'PASAT':[]}
+        all_stimuli = {'Addition':[], 'PASAT':[]}
+        all_results[mode] = session['results']
+        all_reaction_times[mode] = session['reaction_times']
+        all_dispatch_latencies[mode] = session['dispatch_latencies']
+        all_stimuli[mode] = [tuple(stimulus) if isinstance(stimulus, list) else stimulus
+                             for stimulus in session['stimuli']]
+        self._open_results_backend().save_session(session['player_name'], session['player_code'],
+                                                  {'Addition':1, 'PASAT':1}, [mode], all_results,
+                                                  all_reaction_times, None, all_dispatch_latencies, all_stimuli)
+
+    def _save_record(self):
+        """
+        Saves the record of the finished session (SessionEngine.record) in
+        SESSION_RECORDS_DIR, named by the player code, the mode and the time
+        """
+        os.makedirs(SESSION_RECORDS_DIR, exist_ok=True)
+        filename = self._session_filename("json")
+        with open(os.path.join(SESSION_RECORDS_DIR, filename), 'w', encoding='utf-8') as record_file:
+            json.dump(self.engine.record(), record_file)
+
+    def _session_filename(self, extension):
+        """
+        Returns the name of a file of the current session, by the player code,
+        the mode and the time
+        """
+        return "%s_%s_%s.%s" % (self.player_code or 'anonymous', self.mode,
+                                datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), extension)
+
 
 ### Menu actions event handlers (except views) ###
     def _stop(self):
         """
         When stopRunAction is pressed from the Run menu, this function is called.
-        It simply calls the .stop() function of the currently running thread and 
-        disables pause and stop menu actions.
+        It simply calls the .stop() function of the currently running threads,
+        which makes them finish as soon as possible, and disables pause and stop
+        menu actions.
         """
         if self.mode == 'PASAT':
             self.audio_thread.stop()
@@ -742,6 +941,7 @@ class Window(QMainWindow):
             self.demo_thread.stop()
         # Disable pause and stop within the Run menu    
         self.pauseRunAction.setEnabled(False)
+        self.resumeRunAction.setEnabled(False)
         self.stopRunAction.setEnabled(False)
     
     def _pause(self):
@@ -755,10 +955,8 @@ class Window(QMainWindow):
             self.audio_thread.paused = True
         elif self.mode == 'Demo':
             self.demo_thread.paused = True
-        if self.show_timer_on:
-            self.timer_thread.paused = True
-        # TODO: this does not work appropriately
-        self.allow_answer = False
+        # Do not accept answers while paused
+        self.engine.pause()
         # Disable pause action and enable resume action within Run menu
         self.pauseRunAction.setEnabled(False)
         self.resumeRunAction.setEnabled(True)
@@ -774,27 +972,28 @@ class Window(QMainWindow):
             self.audio_thread.paused = False
         elif self.mode == 'Demo':
             self.demo_thread.paused = False
-        if self.show_timer_on:
-            self.timer_thread.paused = False
-        # TODO: this does not work appropriately
-        self.allow_answer = True
+        self.engine.resume()
         # Disable pause action and enable resume action within Run menu
         self.pauseRunAction.setEnabled(True)
         self.resumeRunAction.setEnabled(False)
         
     def _change_language(self):
         """
-        Changes the global variable LANGUAGE to the user selected languaged and
-        restarts the application.
+        Changes the global variable LANGUAGE to the user selected language, and
+        switches the Window to it in place: the texts are translated again with
+        the (cached) catalog of the language, the layout direction is changed,
+        and the sounds of the language are used from the next PASAT.
         """
         #TODO: do not use global
-        global LANGUAGE
-        selected_language = self.sender().text()
-        if selected_language == _("Farsi"):
-            LANGUAGE = "fa"
-        elif selected_language == _("English"):
-            LANGUAGE = "en"
-        App.exit(EXIT_CODE_REBOOT)
+        global LANGUAGE, _, _n
+        LANGUAGE = self.sender().data()
+        _, _n = helpers.redefine_gettext(LANGUAGE)
+        App.setLayoutDirection(QtCore.Qt.RightToLeft if LANGUAGE == "fa" else QtCore.Qt.LeftToRight)
+        if LANGUAGE not in self.audio_engine.loaded_languages():
+            self.audio_engine.preload([LANGUAGE])
+        self.retranslateUi()
+        if self.engine is not None:
+            self._update_performance()
             
     def _save_preferences(self):
         """
@@ -832,20 +1031,51 @@ class Window(QMainWindow):
         Developed by Amin Saberi (amnsbr@gmail.com)
         2019.08"""))
             
+    def _on_first_paint(self):
+        """
+        Called when the Window is painted for the first time. Writes the startup
+        profile if --profile-startup is given, and exits if --exit-after-startup is given.
+        """
+        startup.PROFILE.mark("first paint")
+        if STARTUP_PROFILE_FILEPATH:
+            startup.PROFILE.save(STARTUP_PROFILE_FILEPATH)
+        if EXIT_AFTER_STARTUP:
+            QtCore.QTimer.singleShot(0, App.quit)
+
     def _exit(self):
         """
         Exits the program
         """
+        if self.results_backend is not None:
+            self.results_backend.close()
+        if self.journal_writer is not None:
+            self.journal_writer.close()
+        self.audio_engine.close()
         sys.exit()
     
 if __name__ == '__main__':
-    # currentExitCode is necessary for changing languages in Gui, do not know the dynamics
-    currentExitCode = EXIT_CODE_REBOOT
-    while currentExitCode == EXIT_CODE_REBOOT:
-        App = QApplication(sys.argv)
-        if LANGUAGE == "fa":
-            App.setLayoutDirection(QtCore.Qt.RightToLeft)
-        window = Window()
-        currentExitCode = App.exec_()
-        App = None
+    App = QApplication(sys.argv)
+    if LANGUAGE == "fa":
+        App.setLayoutDirection(QtCore.Qt.RightToLeft)
+    startup.PROFILE.mark("QApplication")
+    # Decode and normalize the sounds of the language once (and find the speech
+    # onsets and offsets), which are cached for the next launches, and keep the
+    # output stream open until the program exits. The other languages are
+    # loaded when they are selected. The test is not run without sound, unless
+    # --no-audio is given.
+    try:
+        audio_engine = AudioEngine(resource_path("audio"), NullSink() if NO_AUDIO else None,
+                                   speech_index=SpeechIndex(), clip_cache=ClipCache())
+    except AudioUnavailableError as error:
+        QMessageBox.critical(None, "PASAT", _("The stimuli cannot be played: %s") % error)
+        sys.exit(1)
+    audio_engine.preload([LANGUAGE])
+    startup.PROFILE.mark("audio")
+    window = Window(audio_engine)
+    startup.PROFILE.mark("Window")
+    exit_code = App.exec_()
+    if window.journal_writer is not None:
+        window.journal_writer.close()
+    audio_engine.close()
+    sys.exit(exit_code)
 
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Replays recorded sessions (see SESSION_RECORDS_DIR in main.py and
+SessionEngine.record) through the stimulus threads and the scoring of
+SessionEngine on a virtual clock, and checks that the results are the same
+as the recorded ones. A session is replayed in a few milliseconds instead of
+its real duration, e.g. to re-score the archive of recorded sessions after
+an upgrade:
+
+    python replay.py records/*.json
+"""
+
+import sys, json, time, argparse
+from collections import deque
+import timing
+from engine import SessionEngine
+from keystrokes import BUTTON
+from helpers import resource_path
+
+class RecordedOnsetsClock(timing.VirtualClock):
+    """
+    A virtual clock which reproduces the recorded lateness of the onsets, so
+    that the replayed reaction times are measured from the same onsets as in
+    the recorded session
+    """
+    def __init__(self, onsets, start_ns=0):
+        super().__init__(start_ns)
+        self.lateness_ns = deque(round((actual - planned) * 1e9) for (planned, actual) in onsets)
+
+    def spin_until(self, deadline_ns):
+        # Called once at each onset by StimulusScheduler
+        lateness_ns = self.lateness_ns.popleft() if self.lateness_ns else 0
+        return super().spin_until(deadline_ns + lateness_ns)
+
+def replay_session(record, audio_engine=None, language='en'):
+    """
+    Replays the record (as returned by SessionEngine.record) through
+    PlayNumbersThread or PlayDemoThread, which run synchronously on a
+    RecordedOnsetsClock, and feeds the recorded input events to a new
+    SessionEngine at their recorded times. Returns the finished SessionEngine.
+    audio_engine is used by PlayNumbersThread, an AudioEngine with a NullSink by default.
+    """
+    # Imported here, as Qt is only needed for the threads
+    from threads import PlayNumbersThread, PlayDemoThread
+    source = RecordedOnsetsClock(record.get('onsets', []))
+    clock = timing.SessionClock(source)
+    mode = record['mode']
+    stimuli = [tuple(stimulus) if isinstance(stimulus, list) else stimulus for stimulus in record['stimuli']]
+    reference_offsets = {stimulus: offset for (stimulus, offset) in record.get('reference_offsets', [])}
+    engine = SessionEngine(mode, len(stimuli), record['interval'], clock=clock, stimuli=stimuli,
+                           reference_offsets=reference_offsets)
+    if mode == 'PASAT':
+        if audio_engine is None:
+            from audio import AudioEngine, NullSink
+            audio_engine = AudioEngine(resource_path("audio"), NullSink())
+        thread = PlayNumbersThread(engine.stimuli, engine.interval, language, audio_engine, clock)
+        thread.new_number.connect(engine.present)
+    else:
+        thread = PlayDemoThread(engine.stimuli, engine.interval, clock)
+        thread.new_pair.connect(engine.present)
+
+    def feed(kind, value, response_time):
+        if kind == 'type':
+            engine.type_digit(value, response_time)
+        elif kind == 'erase':
+            engine.erase_digit(response_time)
+        elif kind == 'respond':
+            engine.respond(value, response_time)
+        elif kind == 'button':
+            engine.respond(value, response_time, key=BUTTON)
+    # The session clock starts at 0 on the virtual clock, so the session times
+    # of the events are also their times on the virtual clock
+    for (response_time, kind, value) in record['events']:
+        source.call_at(round(response_time * 1e9), feed, kind, value, response_time)
+    # Run the thread in this thread, the signals are delivered directly
+    thread.run()
+    engine.finish(thread.scheduler.onsets())
+    return engine
+
+def compare(record, engine, tolerance=0.001):
+    """
+    Returns a list of the differences between the recorded results and the
+    results of the replayed engine (empty if they are the same). Reaction
+    times may differ by tolerance seconds.
+    """
+    differences = []
+    if engine.results != record['results']:
+        differences.append("results: %s != %s" % (engine.results, record['results']))
+    if len(engine.reaction_times) != len(record['reaction_times']) or \
+       any(abs(replayed - recorded) > tolerance
+           for (replayed, recorded) in zip(engine.reaction_times, record['reaction_times'])):
+        differences.append("reaction times: %s != %s" % (engine.reaction_times, record['reaction_times']))
+    return differences
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded PASAT sessions and check their results")
+    parser.add_argument('records', nargs='+', help="JSON files saved by SessionEngine.record")
+    args = parser.parse_args(argv)
+    from audio import AudioEngine, NullSink
+    audio_engine = AudioEngine(resource_path("audio"), NullSink())
+    n_failed = 0
+    for filepath in args.records:
+        with open(filepath, 'r', encoding='utf-8') as record_file:
+            record = json.load(record_file)
+        started = time.perf_counter()
+        engine = replay_session(record, audio_engine)
+        elapsed = time.perf_counter() - started
+        differences = compare(record, engine)
+        duration = (len(record['stimuli']) + 1) * record['interval']
+        print("%s: %s (%.0fx)" % (filepath, "MISMATCH" if differences else "OK", duration / max(elapsed, 1e-9)))
+        for difference in differences:
+            print("    " + difference)
+        n_failed += bool(differences)
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized scoring of many sessions at once with NumPy, e.g. to re-score an
+archive of results. The results of the sessions are stacked in a 2-D int8
+matrix of RESULT_CODES and their reaction times in a float matrix, one row
+per session; shorter sessions are padded with 0 (PADDING) and masked. The
+statistics of helpers.RESULTS_FORMULAS and helpers.REACTION_TIME_FORMULAS are
+computed for all the rows in a few passes over the matrices, and give the
+same values as the formulas (None is nan).
+"""
+
+from collections import OrderedDict
+import numpy as np
+from buffers import RESULT_CODES
+
+PADDING = 0
+
+def encode_results(all_results, width=None):
+    """
+    Stacks the results lists (of "C"/"I"/"N") of the sessions in an int8 matrix
+    of RESULT_CODES with width columns (the longest session by default).
+    Returns the matrix and the lengths of the sessions.
+    """
+    lengths = np.array([len(results) for results in all_results], dtype=np.int64)
+    if width is None:
+        width = int(lengths.max()) if len(lengths) else 0
+    codes = np.full((len(all_results), width), PADDING, dtype=np.int8)
+    for row, results in enumerate(all_results):
+        codes[row, :len(results)] = [RESULT_CODES[result] for result in results]
+    return codes, lengths
+
+def encode_reaction_times(all_reaction_times, width=None):
+    """
+    Stacks the reaction times of the sessions in a float64 matrix with width
+    columns (the longest session by default), padded with 0. None is stored as 0.
+    The values are kept as they are in the lists, so the means are the ones of
+    the formulas.
+    """
+    if width is None:
+        width = max((len(reaction_times) for reaction_times in all_reaction_times), default=0)
+    matrix = np.zeros((len(all_reaction_times), width), dtype=np.float64)
+    for row, reaction_times in enumerate(all_reaction_times):
+        matrix[row, :len(reaction_times)] = [reaction_time or 0 for reaction_time in reaction_times]
+    return matrix
+
+def encode_buffers(buffers, width=None):
+    """
+    Stacks the results and reaction times of buffers (buffers.SessionBuffer)
+    as encode_results and encode_reaction_times do, copying each array at once
+    from its buffer. The missing reaction times are nan. Returns the codes, the
+    reaction times and the lengths.
+    """
+    lengths = np.array([len(buffer) for buffer in buffers], dtype=np.int64)
+    if width is None:
+        width = int(lengths.max()) if len(lengths) else 0
+    codes = np.full((len(buffers), width), PADDING, dtype=np.int8)
+    reaction_times = np.zeros((len(buffers), width), dtype=np.float32)
+    for row, buffer in enumerate(buffers):
+        codes[row, :len(buffer)] = np.frombuffer(buffer.results, dtype=np.int8)
+        reaction_times[row, :len(buffer)] = np.frombuffer(buffer.reaction_times, dtype=np.float32)
+    return codes, reaction_times, lengths
+
+def non_zero_means(matrix, mask=None):
+    """
+    Returns the mean of the non-zero (and non-nan) values of each row where
+    mask is True, or 0 if there are none (as helpers.non_zero_mean)
+    """
+    # Summed as float64, as helpers.non_zero_mean sums Python floats
+    values = np.nan_to_num(matrix.astype(np.float64))
+    included = values != 0
+    if mask is not None:
+        included &= mask
+    counts = included.sum(axis=1)
+    sums = np.where(included, values, 0).sum(axis=1)
+    return np.divide(sums, counts, out=np.zeros(len(values)), where=counts > 0)
+
+def non_zero_sds(matrix, mask=None):
+    """
+    Returns the (population) standard deviation of the non-zero (and non-nan)
+    values of each row where mask is True, or nan if there are none (as
+    helpers.non_zero_sd)
+    """
+    values = np.nan_to_num(matrix.astype(np.float64))
+    included = values != 0
+    if mask is not None:
+        included &= mask
+    counts = included.sum(axis=1)
+    means = non_zero_means(matrix, mask)
+    squares = np.where(included, (values - means[:, np.newaxis]) ** 2, 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, np.sqrt(squares / counts), np.nan)
+
+def fatigability(correct_cumsum, lengths, denominator=3):
+    """
+    Returns the raw and the percent fatigability of each row (as
+    helpers.get_fatigability) from the cumulative sums of its correct answers,
+    with a leading 0 column. The percent is nan where there are no correct
+    answers in the first portion.
+    """
+    rows = np.arange(len(lengths))
+    portion = lengths // denominator
+    first_correct = correct_cumsum[rows, portion]
+    # results[-0:] is the whole list, so a session shorter than the denominator
+    # is compared with all of its results
+    last_start = np.where(portion > 0, lengths - portion, 0)
+    last_correct = correct_cumsum[rows, lengths] - correct_cumsum[rows, last_start]
+    difference = last_correct - first_correct
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = np.where(first_correct > 0, -difference / first_correct * 100, np.nan)
+    return difference, percent
+
+def score_batch(codes, reaction_times=None, lengths=None, denominator=3):
+    """
+    Scores all the sessions (rows) of codes, the matrix of RESULT_CODES, and
+    reaction_times, the matrix of their reaction times (optional). lengths
+    are the lengths of the sessions, by default the number of non-padding codes
+    in each row. Returns an OrderedDict of arrays, one value per session, named
+    as in RESULTS_FORMULAS and REACTION_TIME_FORMULAS (except for the lists).
+    """
+    codes = np.asarray(codes)
+    mask = codes != PADDING
+    if lengths is None:
+        lengths = mask.sum(axis=1)
+    else:
+        lengths = np.asarray(lengths, dtype=np.int64)
+        mask &= np.arange(codes.shape[1]) < lengths[:, np.newaxis]
+    correct = (codes == RESULT_CODES['C']) & mask
+    correct_cumsum = np.zeros((codes.shape[0], codes.shape[1] + 1), dtype=np.int64)
+    np.cumsum(correct, axis=1, out=correct_cumsum[:, 1:])
+    correct_count = correct_cumsum[:, -1]
+    incorrect_count = ((codes == RESULT_CODES['I']) & mask).sum(axis=1)
+    not_answered_count = ((codes == RESULT_CODES['N']) & mask).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correct_percent = 100 * (correct_count / lengths)
+    difference, percent = fatigability(correct_cumsum, lengths, denominator)
+    columns = OrderedDict([("correct count", correct_count),
+                           ("incorrect count", incorrect_count),
+                           ("not answered count", not_answered_count),
+                           ("correct %", correct_percent),
+                           ("last third correct - first third correct", difference),
+                           ("percent decrease in the last third", percent)])
+    if reaction_times is not None:
+        columns["mean reaction time"] = non_zero_means(np.asarray(reaction_times), mask)
+        columns["reaction time SD"] = non_zero_sds(np.asarray(reaction_times), mask)
+    return columns
+
+def score_sessions(all_results, all_reaction_times=None):
+    """
+    Encodes and scores the results lists (and reaction times) of the sessions
+    with score_batch
+    """
+    codes, lengths = encode_results(all_results)
+    reaction_times = None
+    if all_reaction_times is not None:
+        reaction_times = encode_reaction_times(all_reaction_times, codes.shape[1])
+    return score_batch(codes, reaction_times, lengths)
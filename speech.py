@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Speech onset and offset of the audio stimuli. Every recording has a different
+amount of leading silence and a different word duration, so reaction times
+measured from the start of the playback are biased by the digit. The onset
+and offset of the speech are detected once per file with an energy threshold,
+and kept in an index (a small JSON file in the user cache folder) keyed by
+the hash of the file, so they are computed again only if a file changes.
+"""
+
+import os, json, hashlib
+import numpy as np
+from helpers import user_cache_dir
+
+# The reference points of the reaction times (see RT_REFERENCE in main.py)
+RT_REFERENCES = ("stimulus", "speech onset", "speech offset")
+
+def detect_speech(frames, sample_rate, channels, sample_width, threshold_db=-30, window=0.005):
+    """
+    Returns the onset and offset of the speech in raw PCM frames (seconds from
+    the start), i.e. the start of the first and the end of the last window
+    whose RMS energy is above threshold_db relative to the loudest window.
+    Returns (0, duration) if the frames are silent.
+    """
+    samples = np.frombuffer(frames, dtype='<i%d' % sample_width).astype(np.float64)
+    if channels == 2:
+        samples = samples[:len(samples) - len(samples) % 2].reshape(-1, 2).mean(axis=1)
+    duration = len(samples) / sample_rate
+    if not len(samples):
+        return 0.0, duration
+    window_frames = max(1, int(window * sample_rate))
+    # The RMS of each window (the last one may be shorter)
+    starts = np.arange(0, len(samples), window_frames)
+    energies = np.sqrt(np.add.reduceat(samples ** 2, starts) / np.diff(np.append(starts, len(samples))))
+    if not energies.max():
+        return 0.0, duration
+    threshold = energies.max() * 10 ** (threshold_db / 20)
+    loud = np.flatnonzero(energies >= threshold)
+    onset = int(loud[0]) * window_frames / sample_rate
+    offset = min(duration, (int(loud[-1]) + 1) * window_frames / sample_rate)
+    return onset, offset
+
+def file_hash(filepath):
+    with open(filepath, 'rb') as audio_file:
+        return hashlib.sha1(audio_file.read()).hexdigest()
+
+class SpeechIndex:
+    """
+    The speech onsets and offsets of audio files, as {file hash: [onset, offset]},
+    saved in index_filepath (speech_index.json in the user cache folder by default)
+    """
+    def __init__(self, index_filepath=None):
+        if index_filepath is None:
+            index_filepath = os.path.join(user_cache_dir(), "speech_index.json")
+        self.index_filepath = index_filepath
+        self.index = {}
+        self.changed = False
+        if os.path.isfile(index_filepath):
+            try:
+                with open(index_filepath, 'r', encoding='utf-8') as index_file:
+                    self.index = json.load(index_file)
+            except ValueError:
+                # A corrupted cache is rebuilt
+                self.index = {}
+
+    def get(self, filepath, clip, sample_rate, channels, sample_width):
+        """
+        Returns the (onset, offset) of the speech of the file, which has been
+        decoded into clip (audio.Clip), from the index or by detecting them
+        """
+        key = file_hash(filepath)
+        if key not in self.index:
+            self.index[key] = list(detect_speech(clip.frames, sample_rate, channels, sample_width))
+            self.changed = True
+        onset, offset = self.index[key]
+        return onset, offset
+
+    def save(self):
+        """
+        Writes the index if new files have been analyzed
+        """
+        if not self.changed:
+            return
+        with open(self.index_filepath, 'w', encoding='utf-8') as index_file:
+            json.dump(self.index, index_file)
+        self.changed = False
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Startup profiling. When main.py is run with --profile-startup, the time of
+every module imported during startup and of the phases of the startup (marked
+with PROFILE.mark) until the first paint of the Window is written as JSON
+(startup_profile.json by default, or --profile-startup=FILE).
+This module only uses the standard library, as it is imported first.
+"""
+
+import sys, time, json, builtins
+
+class StartupProfile:
+    """
+    Records the phases of the startup and, once started, the imports
+    """
+    def __init__(self):
+        self.enabled = False
+        self.origin_ns = time.perf_counter_ns()
+        self.last_ns = self.origin_ns
+        self.phases = []
+        # {module: [inclusive ns, self ns]}
+        self.imports = {}
+        self._stack = []
+        self._import = None
+
+    def start(self):
+        """
+        Starts recording the imports
+        """
+        self.enabled = True
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, *args, **kwargs):
+        # Only the first import of a module takes time
+        if name in sys.modules:
+            return self._import(name, *args, **kwargs)
+        self._stack.append(0)
+        started_ns = time.perf_counter_ns()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed_ns = time.perf_counter_ns() - started_ns
+            nested_ns = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed_ns
+            times = self.imports.setdefault(name, [0, 0])
+            times[0] += elapsed_ns
+            times[1] += elapsed_ns - nested_ns
+
+    def mark(self, phase):
+        """
+        Records the end of a phase of the startup, which started at the last mark
+        """
+        if not self.enabled:
+            return
+        now_ns = time.perf_counter_ns()
+        self.phases.append((phase, (now_ns - self.last_ns) / 1e6, (now_ns - self.origin_ns) / 1e6))
+        self.last_ns = now_ns
+
+    def results(self, n_imports=30):
+        """
+        Returns the phases and the n_imports slowest imports (by their own time) in ms
+        """
+        imports = sorted(self.imports.items(), key=lambda item: item[1][1], reverse=True)
+        return {'total_ms': (self.last_ns - self.origin_ns) / 1e6,
+                'phases': [{'phase': phase, 'ms': ms, 'since_start_ms': since_start_ms}
+                           for (phase, ms, since_start_ms) in self.phases],
+                'imports': [{'module': module, 'inclusive_ms': inclusive_ns / 1e6, 'self_ms': self_ns / 1e6}
+                            for (module, (inclusive_ns, self_ns)) in imports[:n_imports]]}
+
+    def save(self, filepath):
+        self.stop()
+        with open(filepath, 'w', encoding='utf-8') as profile_file:
+            json.dump(self.results(), profile_file, indent=2)
+
+PROFILE = StartupProfile()
+
+def parse_args(argv):
+    """
+    Removes the startup options from argv (before it is passed to QApplication).
+    Returns the file to write the profile to (None if not profiling), whether
+    to exit after the first paint, and whether to discard the audio
+    (--no-audio, for headless runs such as the startup benchmark).
+    """
+    profile_filepath = None
+    exit_after_startup = False
+    no_audio = False
+    for arg in list(argv[1:]):
+        if arg == '--profile-startup' or arg.startswith('--profile-startup='):
+            profile_filepath = arg.partition('=')[2] or 'startup_profile.json'
+            argv.remove(arg)
+        elif arg == '--exit-after-startup':
+            exit_after_startup = True
+            argv.remove(arg)
+        elif arg == '--no-audio':
+            no_audio = True
+            argv.remove(arg)
+    return profile_filepath, exit_after_startup, no_audio
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Online statistics of a session. SessionStats is updated once per scored
+response in O(1), and gives the same values as helpers.RESULTS_FORMULAS and
+REACTION_TIME_FORMULAS at any time, so the live readout, the results dialog
+and the results backends read them without going through the lists again.
+"""
+
+import math
+from collections import OrderedDict
+
+class SessionStats:
+    """
+    Counts of the results, running sums of the non-zero reaction times and
+    dispatch latencies, the running variance of the reaction times (Welford's
+    method), and the cumulative number of correct responses after each
+    response, from which the correct responses of any portion (e.g. the first
+    and last thirds) are one subtraction.
+    """
+    def __init__(self):
+        self.counts = {'C': 0, 'I': 0, 'N': 0}
+        self.correct_cumsum = [0]
+        self.reaction_time_count = 0
+        self.reaction_time_sum = 0.0
+        self._reaction_time_mean = 0.0
+        self._reaction_time_m2 = 0.0
+        self.dispatch_latency_count = 0
+        self.dispatch_latency_sum = 0.0
+
+    @classmethod
+    def from_results(cls, results, reaction_times, dispatch_latencies=None):
+        """
+        Returns the SessionStats of a finished session from its lists
+        """
+        session_stats = cls()
+        if dispatch_latencies is None:
+            dispatch_latencies = [None] * len(results)
+        for result, reaction_time, dispatch_latency in zip(results, reaction_times, dispatch_latencies):
+            session_stats.add(result, reaction_time, dispatch_latency)
+        return session_stats
+
+    def add(self, result, reaction_time=0, dispatch_latency=None):
+        """
+        Adds a response with its result ("C"/"I"/"N"), reaction time (0 if not
+        correct) and dispatch latency (None if unknown)
+        """
+        self.counts[result] += 1
+        self.correct_cumsum.append(self.correct_cumsum[-1] + (result == 'C'))
+        # Zeros are left out, as in helpers.non_zero_mean
+        if reaction_time:
+            self.reaction_time_count += 1
+            self.reaction_time_sum += reaction_time
+            delta = reaction_time - self._reaction_time_mean
+            self._reaction_time_mean += delta / self.reaction_time_count
+            self._reaction_time_m2 += delta * (reaction_time - self._reaction_time_mean)
+        if dispatch_latency:
+            self.dispatch_latency_count += 1
+            self.dispatch_latency_sum += dispatch_latency
+
+    @property
+    def n_responses(self):
+        return len(self.correct_cumsum) - 1
+
+    @property
+    def correct_count(self):
+        return self.counts['C']
+
+    @property
+    def correct_percent(self):
+        """
+        Percent of correct responses, None before the first response
+        """
+        if not self.n_responses:
+            return None
+        return 100 * (self.counts['C'] / self.n_responses)
+
+    @property
+    def mean_reaction_time(self):
+        """
+        Mean of the non-zero reaction times, 0 if there are none
+        """
+        # The mean is the sum over the count, as in helpers.non_zero_mean, so
+        # that both give exactly the same value
+        if not self.reaction_time_count:
+            return 0
+        return self.reaction_time_sum / self.reaction_time_count
+
+    @property
+    def reaction_time_sd(self):
+        """
+        Standard deviation of the non-zero reaction times, None if there are none
+        """
+        if not self.reaction_time_count:
+            return None
+        return math.sqrt(self._reaction_time_m2 / self.reaction_time_count)
+
+    @property
+    def mean_dispatch_latency(self):
+        if not self.dispatch_latency_count:
+            return 0
+        return self.dispatch_latency_sum / self.dispatch_latency_count
+
+    def correct_between(self, start, stop):
+        """
+        Returns the number of correct responses in results[start:stop]
+        """
+        return self.correct_cumsum[stop] - self.correct_cumsum[start]
+
+    def fatigability(self, denominator=3, as_percent=False):
+        """
+        Same as helpers.get_fatigability of the results so far
+        """
+        all_count = self.n_responses
+        portion = all_count // denominator
+        first_correct = self.correct_between(0, portion)
+        # results[-0:] is the whole list
+        last_correct = self.correct_between(all_count - portion if portion else 0, all_count)
+        if as_percent:
+            if first_correct:
+                return (first_correct - last_correct) / first_correct * 100
+            return None
+        return last_correct - first_correct
+
+    def values(self):
+        """
+        Returns the stats as an OrderedDict named as in RESULTS_FORMULAS,
+        REACTION_TIME_FORMULAS and DISPATCH_LATENCY_FORMULAS (except for the lists)
+        """
+        return OrderedDict([("correct count", self.counts['C']),
+                            ("incorrect count", self.counts['I']),
+                            ("not answered count", self.counts['N']),
+                            ("correct %", self.correct_percent),
+                            ("last third correct - first third correct", self.fatigability()),
+                            ("percent decrease in the last third", self.fatigability(as_percent=True)),
+                            ("mean reaction time", self.mean_reaction_time),
+                            ("reaction time SD", self.reaction_time_sd),
+                            ("mean dispatch latency", self.mean_dispatch_latency)])
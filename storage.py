@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""
+Results backends. Window saves the results of a session through one of them
+(see open_backend):
+ - CSVBackend rewrites the wide results CSV file (helpers.update_csv)
+ - AppendOnlyStore appends to a log file
+ - SQLiteBackend stores participants, sessions and responses in an SQLite database
+ - CollectorBackend sends the results to a collector (see collector.py),
+   which saves the results of several stations in one store
+
+AppendOnlyStore appends one record per session to a log file, and keeps an
+index of (player code, session id) to the byte offset of the latest record
+of that session in a second file. Saving a session and looking up or
+updating an earlier one therefore never reads the whole log. The wide CSV
+layout of helpers.update_csv can be produced on demand with compact(), or from
+the command line:
+
+    python storage.py compact results.log results.csv
+"""
+
+import os, sys, json, csv, time, uuid, socket, hashlib, argparse, datetime, sqlite3, threading
+from collections import OrderedDict
+import helpers
+from stats import SessionStats
+
+class ResultsBackend:
+    """
+    Base class of the results backends. The arguments of save_session are the
+    same as helpers.update_csv, plus all_stimuli which is a dict of the numbers
+    (PASAT) or pairs (Addition) presented in each mode. all_stats are the
+    stats.SessionStats of the modes, used instead of calculating the stats again,
+    and all_keystroke_latencies the first-key and completion latencies of the
+    modes (see helpers.KEYSTROKE_LATENCY_FORMULAS).
+    """
+    def save_session(self, player_name, player_code, session_ids, modes, all_results, all_reaction_times,
+                     all_onsets=None, all_dispatch_latencies=None, all_stimuli=None, all_stats=None,
+                     all_keystroke_latencies=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class CSVBackend(ResultsBackend):
+    """
+    Saves the results in the wide results CSV file, using helpers.update_csv_rows,
+    which locks and replaces the file, so several processes can save to it. If
+    coalesce_window (seconds) is set, the sessions saved within the window
+    after a save are written together, when the window ends or by flush().
+    Coalescing is meant for the collector (collector.py), which saves many
+    sessions and flushes after each batch; the application saves one session
+    at a time and needs it on disk at once (its journal entry is ended when
+    it is saved), so it uses no window.
+    """
+    def __init__(self, csv_filepath, coalesce_window=0):
+        self.csv_filepath = csv_filepath
+        self.coalesce_window = coalesce_window
+        self.pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        # Held while writing, so the rows are written in the order they were saved
+        self._flush_lock = threading.Lock()
+
+    def save_session(self, player_name, player_code, session_ids, modes, all_results, all_reaction_times,
+                     all_onsets=None, all_dispatch_latencies=None, all_stimuli=None, all_stats=None,
+                     all_keystroke_latencies=None):
+        row_data = helpers.get_row_data(player_name, player_code, all_results, all_reaction_times, modes,
+                                        all_onsets, all_dispatch_latencies, all_stats, all_keystroke_latencies)
+        with self._lock:
+            self.pending.append(row_data)
+            if self.coalesce_window and self._timer is None:
+                self._timer = threading.Timer(self.coalesce_window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if not self.coalesce_window:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the sessions saved since the last write
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows_data, self.pending = self.pending, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if rows_data:
+                try:
+                    helpers.update_csv_rows(self.csv_filepath, rows_data)
+                except Exception:
+                    # Kept to be written by the next flush
+                    with self._lock:
+                        self.pending[:0] = rows_data
+                    raise
+
+    def close(self):
+        self.flush()
+
+class AppendOnlyStore(ResultsBackend):
+    """
+    Append-only results store. Each line of the log file is a JSON object with
+    the columns of the results file (helpers.get_fieldnames()), and each line of
+    the index file is a JSON list of [player code, session id, offset, length]
+    pointing at a line of the log. Updating a session appends a new record, and
+    the latest one wins.
+    """
+    def __init__(self, log_filepath, index_filepath=None):
+        """
+        Initializes the store with the paths to the log file and the index file
+        (log_filepath + '.idx' by default), and loads the index
+        """
+        self.log_filepath = log_filepath
+        self.index_filepath = index_filepath or log_filepath + '.idx'
+        self.index = OrderedDict()
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Reads the index file, and indexes the records that were appended to the
+        log after the last index entry (e.g. if the program crashed in between)
+        """
+        end = 0
+        if os.path.isfile(self.index_filepath):
+            with open(self.index_filepath, 'r', encoding='utf-8') as index_file:
+                for line in index_file:
+                    try:
+                        player_code, session_id, offset, length = json.loads(line)
+                    except ValueError: # an incomplete last line
+                        continue
+                    self.index[(player_code, session_id)] = (offset, length)
+                    end = max(end, offset + length)
+        if os.path.isfile(self.log_filepath) and os.path.getsize(self.log_filepath) > end:
+            with open(self.log_filepath, 'rb') as log_file:
+                log_file.seek(end)
+                offset = end
+                for line in log_file:
+                    if line.endswith(b'\n'):
+                        record = json.loads(line.decode('utf-8'))
+                        self._add_to_index(record['Player Code'], record['Session'], offset, len(line))
+                    offset += len(line)
+
+    def _add_to_index(self, player_code, session_id, offset, length):
+        self.index[(player_code, session_id)] = (offset, length)
+        with open(self.index_filepath, 'a', encoding='utf-8') as index_file:
+            index_file.write(json.dumps([player_code, session_id, offset, length]) + '\n')
+
+    def get(self, player_code, session_id=1):
+        """
+        Returns the latest record of the session as an OrderedDict, or None if
+        the session has not been saved
+        """
+        if (player_code, session_id) not in self.index:
+            return None
+        offset, length = self.index[(player_code, session_id)]
+        with open(self.log_filepath, 'rb') as log_file:
+            log_file.seek(offset)
+            line = log_file.read(length)
+        return json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict)
+
+    def save(self, row_data, session_id=1):
+        """
+        Appends the row_data (as returned by helpers.get_row_data) of the session.
+        If the session has already been saved, e.g. with the demo results, the
+        earlier record is updated with row_data.
+        """
+        record = self.get(row_data['Player Code'], session_id) or OrderedDict()
+        record.update(row_data)
+        record['Session'] = session_id
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with open(self.log_filepath, 'ab') as log_file:
+            log_file.seek(0, os.SEEK_END)
+            offset = log_file.tell()
+            log_file.write(line)
+        self._add_to_index(record['Player Code'], session_id, offset, len(line))
+        return record
+
+    def save_session(self, player_name, player_code, session_ids, modes, all_results, all_reaction_times,
+                     all_onsets=None, all_dispatch_latencies=None, all_stimuli=None, all_stats=None,
+                     all_keystroke_latencies=None):
+        row_data = helpers.get_row_data(player_name, player_code, all_results, all_reaction_times, modes,
+                                        all_onsets, all_dispatch_latencies, all_stats, all_keystroke_latencies)
+        self.save(row_data, session_ids['PASAT'])
+
+    def records(self):
+        """
+        Yields the latest record of every session, in the order they were first saved
+        """
+        for (player_code, session_id) in self.index:
+            yield self.get(player_code, session_id)
+
+    def compact(self, csv_filepath, fieldnames=None):
+        """
+        Writes the latest record of every session to csv_filepath in the layout
+        of helpers.update_csv, i.e. with a header and the lists written as Python
+        lists
+        """
+        if fieldnames is None:
+            fieldnames = helpers.get_fieldnames()
+        with open(csv_filepath, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames, dialect='excel', extrasaction='ignore')
+            writer.writeheader()
+            for record in self.records():
+                writer.writerow(OrderedDict((key, str(value) if isinstance(value, list) else value)
+                                            for key, value in record.items()))
+
+def iter_trials(mode, results, reaction_times, dispatch_latencies=None, onsets=None, stimuli=None,
+                keystroke_latencies=None):
+    """
+    Yields the data of every response of a session in mode ('Addition' or 'PASAT')
+    as a dict. In PASAT, the response number i is the sum of the numbers i and i+1
+    and is timed from the onset of number i+1, while in the demo (Addition) it is
+    the sum of the pair number i and is timed from its onset.
+    """
+    dispatch_latencies = dispatch_latencies or []
+    keystroke_latencies = keystroke_latencies or {}
+    first_key_latencies = keystroke_latencies.get('first key', [])
+    completion_latencies = keystroke_latencies.get('completion', [])
+    onsets = onsets or []
+    stimuli = stimuli or []
+    # the index of the stimulus that each response belongs to
+    shift = 1 if mode == 'PASAT' else 0
+    for trial, (result, reaction_time) in enumerate(zip(results, reaction_times)):
+        stimulus_index = trial + shift
+        if stimulus_index < len(stimuli):
+            if mode == 'PASAT':
+                stimulus = stimuli[stimulus_index]
+                correct_answer = stimuli[stimulus_index-1] + stimuli[stimulus_index]
+            else:
+                stimulus = None
+                correct_answer = sum(stimuli[stimulus_index])
+        else:
+            stimulus = correct_answer = None
+        planned_onset, actual_onset = onsets[stimulus_index] if stimulus_index < len(onsets) else (None, None)
+        yield {'trial': trial,
+               'stimulus': stimulus,
+               'correct_answer': correct_answer,
+               'result': result,
+               # 0 stands for no reaction time in the results lists
+               'reaction_time': reaction_time or None,
+               'dispatch_latency': dispatch_latencies[trial] if trial < len(dispatch_latencies) else None,
+               'first_key_latency': first_key_latencies[trial] or None if trial < len(first_key_latencies) else None,
+               'completion_latency': completion_latencies[trial] or None if trial < len(completion_latencies) else None,
+               'planned_onset': planned_onset,
+               'actual_onset': actual_onset}
+
+def session_fingerprint(results, reaction_times, stimuli=None):
+    """
+    Returns a hash of the responses of a session, which identifies it (the
+    reaction times of two sessions are never all the same)
+    """
+    content = json.dumps([list(results), list(reaction_times), [list(stimulus) if isinstance(stimulus, tuple)
+                                                                else stimulus for stimulus in stimuli or []]])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+class SQLiteBackend(ResultsBackend):
+    """
+    Saves the results in an SQLite database with the tables participants,
+    sessions (one row per mode of a session, with its stats) and responses
+    (one row per response). The database is in WAL mode, and all the rows of a
+    session are inserted in a single transaction.
+
+    The sessions of a participant are numbered by the database, in each mode,
+    in the order they are saved (session_ids are not used). A session is
+    identified by a fingerprint of its responses, so one which is saved again
+    (e.g. the demo, which is saved again with the PASAT) is not added twice.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS participants (
+        id INTEGER PRIMARY KEY,
+        code TEXT NOT NULL UNIQUE,
+        name TEXT
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER PRIMARY KEY,
+        participant_id INTEGER NOT NULL REFERENCES participants(id),
+        session_number INTEGER NOT NULL,
+        mode TEXT NOT NULL,
+        date TEXT NOT NULL,
+        correct_count INTEGER,
+        incorrect_count INTEGER,
+        not_answered_count INTEGER,
+        correct_percent REAL,
+        mean_reaction_time REAL,
+        fatigability INTEGER,
+        fatigability_percent REAL,
+        fingerprint TEXT
+    );
+    CREATE TABLE IF NOT EXISTS responses (
+        session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+        trial INTEGER NOT NULL,
+        stimulus INTEGER,
+        correct_answer INTEGER,
+        result TEXT NOT NULL,
+        reaction_time REAL,
+        dispatch_latency REAL,
+        planned_onset REAL,
+        actual_onset REAL,
+        first_key_latency REAL,
+        completion_latency REAL,
+        PRIMARY KEY (session_id, trial)
+    );
+    CREATE INDEX IF NOT EXISTS sessions_participant ON sessions(participant_id, session_number);
+    CREATE INDEX IF NOT EXISTS sessions_date ON sessions(date);
+    """
+    # The columns added to the responses of the databases created by earlier versions
+    ADDED_RESPONSE_COLUMNS = (("first_key_latency", "REAL"), ("completion_latency", "REAL"))
+    ADDED_SESSION_COLUMNS = (("fingerprint", "TEXT"),)
+    def __init__(self, db_filepath):
+        self.db_filepath = db_filepath
+        self.connection = sqlite3.connect(db_filepath)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(self.SCHEMA)
+        response_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(responses)")]
+        for (column, column_type) in self.ADDED_RESPONSE_COLUMNS:
+            if column not in response_columns:
+                self.connection.execute("ALTER TABLE responses ADD COLUMN %s %s" % (column, column_type))
+        session_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(sessions)")]
+        for (column, column_type) in self.ADDED_SESSION_COLUMNS:
+            if column not in session_columns:
+                self.connection.execute("ALTER TABLE sessions ADD COLUMN %s %s" % (column, column_type))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_fingerprint "
+                                "ON sessions(participant_id, mode, fingerprint)")
+
+    def save_session(self, player_name, player_code, session_ids, modes, all_results, all_reaction_times,
+                     all_onsets=None, all_dispatch_latencies=None, all_stimuli=None, all_stats=None,
+                     all_keystroke_latencies=None):
+        all_onsets = all_onsets or {}
+        all_dispatch_latencies = all_dispatch_latencies or {}
+        all_stimuli = all_stimuli or {}
+        all_stats = all_stats or {}
+        all_keystroke_latencies = all_keystroke_latencies or {}
+        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # The connection as a context manager commits everything at the end, or rolls back
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR IGNORE INTO participants (code, name) VALUES (?, ?)", (player_code, player_name))
+            cursor.execute("UPDATE participants SET name=? WHERE code=?", (player_name, player_code))
+            participant_id = cursor.execute("SELECT id FROM participants WHERE code=?", (player_code,)).fetchone()[0]
+            for mode in modes:
+                results = all_results[mode]
+                reaction_times = all_reaction_times[mode]
+                session_stats = all_stats.get(mode) or SessionStats.from_results(results, reaction_times)
+                fingerprint = session_fingerprint(results, reaction_times, all_stimuli.get(mode))
+                if cursor.execute("SELECT 1 FROM sessions WHERE participant_id=? AND mode=? AND fingerprint=?",
+                                  (participant_id, mode, fingerprint)).fetchone():
+                    # The same session saved again
+                    continue
+                session_number = cursor.execute("SELECT COALESCE(MAX(session_number), 0) + 1 FROM sessions "
+                                                "WHERE participant_id=? AND mode=?",
+                                                (participant_id, mode)).fetchone()[0]
+                cursor.execute("INSERT INTO sessions (participant_id, session_number, mode, date, correct_count, "
+                               "incorrect_count, not_answered_count, correct_percent, mean_reaction_time, "
+                               "fatigability, fatigability_percent, fingerprint) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (participant_id, session_number, mode, date,
+                                session_stats.counts['C'], session_stats.counts['I'], session_stats.counts['N'],
+                                session_stats.correct_percent, session_stats.mean_reaction_time,
+                                session_stats.fatigability(), session_stats.fatigability(as_percent=True),
+                                fingerprint))
+                session_id = cursor.lastrowid
+                cursor.executemany("INSERT INTO responses (session_id, trial, stimulus, correct_answer, result, "
+                                   "reaction_time, dispatch_latency, planned_onset, actual_onset, "
+                                   "first_key_latency, completion_latency) "
+                                   "VALUES (:session_id, :trial, :stimulus, :correct_answer, :result, "
+                                   ":reaction_time, :dispatch_latency, :planned_onset, :actual_onset, "
+                                   ":first_key_latency, :completion_latency)",
+                                   (dict(trial, session_id=session_id) for trial in
+                                    iter_trials(mode, results, reaction_times, all_dispatch_latencies.get(mode),
+                                                all_onsets.get(mode), all_stimuli.get(mode),
+                                                all_keystroke_latencies.get(mode))))
+
+    def mean_reaction_time_by_session(self, mode='PASAT'):
+        """
+        Returns a list of (session number, mean reaction time of the correct responses,
+        number of participants) of the cohort
+        """
+        return self.connection.execute(
+            "SELECT s.session_number, AVG(r.reaction_time), COUNT(DISTINCT s.participant_id) "
+            "FROM sessions s JOIN responses r ON r.session_id = s.id "
+            "WHERE s.mode = ? AND r.result = 'C' "
+            "GROUP BY s.session_number ORDER BY s.session_number", (mode,)).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+def parse_address(address):
+    """
+    Returns the family and address of a collector address, which is either
+    "host:port" (TCP) or "unix:/path/to/socket" (a Unix socket)
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, separator, port = address.rpartition(':')
+    if not separator:
+        raise ValueError("The collector address must be host:port or unix:path, not %s" % address)
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+class CollectorBackend(ResultsBackend):
+    """
+    Sends the results of this station to a collector (see collector.py). Every
+    session is first written to outbox_dir as a JSON message, and is deleted
+    from there once the collector has acknowledged it. The messages which are
+    not acknowledged (e.g. when the collector is not reachable) are sent again
+    with the next session, when the backend is opened, every RETRY_INTERVAL
+    seconds, or by send_queued().
+    The stats are computed again by the collector, so all_stats are not sent.
+
+    The messages are sent by a background thread, so save_session only writes
+    to the outbox and does not wait for the collector (e.g. on the GUI thread
+    while the collector is down). With background=False they are sent by
+    save_session itself.
+    """
+    RETRY_INTERVAL = 30
+
+    def __init__(self, address, station=None, outbox_dir="collector_outbox", timeout=2, background=True):
+        self.family, self.address = parse_address(address)
+        self.station = station or socket.gethostname()
+        self.outbox_dir = outbox_dir
+        self.timeout = timeout
+        os.makedirs(outbox_dir, exist_ok=True)
+        # Held while sending, so that a message is not sent by two threads at once
+        self._send_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._sender = None
+        if background:
+            self._sender = threading.Thread(target=self._send_in_background, name="collector outbox", daemon=True)
+            self._sender.start()
+        else:
+            self.send_queued()
+
+    def _send_in_background(self):
+        while not self._closing:
+            self.send_queued()
+            self._wake.wait(self.RETRY_INTERVAL)
+            self._wake.clear()
+        # Including the messages saved before close()
+        self.send_queued()
+
+    def save_session(self, player_name, player_code, session_ids, modes, all_results, all_reaction_times,
+                     all_onsets=None, all_dispatch_latencies=None, all_stimuli=None, all_stats=None,
+                     all_keystroke_latencies=None):
+        message_id = uuid.uuid4().hex
+        message = OrderedDict([('id', message_id),
+                               ('station', self.station),
+                               ('session', OrderedDict([('player_name', player_name),
+                                                        ('player_code', player_code),
+                                                        ('session_ids', session_ids),
+                                                        ('modes', modes),
+                                                        ('all_results', all_results),
+                                                        ('all_reaction_times', all_reaction_times),
+                                                        ('all_onsets', all_onsets),
+                                                        ('all_dispatch_latencies', all_dispatch_latencies),
+                                                        ('all_stimuli', all_stimuli),
+                                                        ('all_keystroke_latencies', all_keystroke_latencies)]))])
+        # Named by the time, so that the queued sessions are sent in order
+        filepath = os.path.join(self.outbox_dir, "%d_%s.json" % (time.time_ns(), message_id))
+        with open(filepath + '.tmp', 'w', encoding='utf-8') as message_file:
+            json.dump(message, message_file, ensure_ascii=False)
+            message_file.flush()
+            os.fsync(message_file.fileno())
+        os.replace(filepath + '.tmp', filepath)
+        if self._sender is not None:
+            self._wake.set()
+        else:
+            self.send_queued()
+
+    def queued(self):
+        """
+        Returns the paths of the messages which have not been acknowledged, oldest first
+        """
+        return [os.path.join(self.outbox_dir, filename) for filename in sorted(os.listdir(self.outbox_dir))
+                if filename.endswith('.json')]
+
+    def send_queued(self):
+        """
+        Sends the queued messages over one connection and deletes the ones the
+        collector has acknowledged. Returns the number of messages acknowledged,
+        which is 0 if the collector is not reachable.
+        """
+        with self._send_lock:
+            return self._send_queued()
+
+    def _send_queued(self):
+        filepaths = {os.path.basename(filepath).split('_', 1)[1][:-len('.json')]: filepath
+                     for filepath in self.queued()}
+        if not filepaths:
+            return 0
+        acknowledged = 0
+        n_replies = 0
+        try:
+            with socket.socket(self.family, socket.SOCK_STREAM) as connection:
+                connection.settimeout(self.timeout)
+                connection.connect(self.address)
+                for filepath in filepaths.values():
+                    # One message per line (json.dump does not write newlines)
+                    with open(filepath, 'rb') as message_file:
+                        connection.sendall(message_file.read() + b'\n')
+                replies = connection.makefile('r', encoding='utf-8')
+                # One reply per message, including the errors (which are sent again later)
+                while n_replies < len(filepaths):
+                    line = replies.readline()
+                    if not line:
+                        break
+                    n_replies += 1
+                    reply = json.loads(line)
+                    if reply.get('ok') and reply.get('id') in filepaths:
+                        os.remove(filepaths[reply['id']])
+                        acknowledged += 1
+        except OSError: # the collector is not reachable, or did not reply in time
+            pass
+        return acknowledged
+
+    def close(self):
+        """
+        Stops the background thread after a last attempt to send the queued
+        messages (those still queued are sent when the backend is opened again)
+        """
+        if self._sender is not None:
+            self._closing = True
+            self._wake.set()
+            self._sender.join()
+            self._sender = None
+
+def open_backend(storage, filepath, coalesce_window=0):
+    """
+    Returns the results backend of type storage ("csv", "append", "sqlite",
+    "collector" or "archive") saving to filepath (the address of the collector
+    for "collector", the folder of the archive for "archive").
+    coalesce_window is passed to CSVBackend.
+    """
+    if storage == "csv":
+        return CSVBackend(filepath, coalesce_window)
+    elif storage == "append":
+        return AppendOnlyStore(filepath)
+    elif storage == "sqlite":
+        return SQLiteBackend(filepath)
+    elif storage == "collector":
+        return CollectorBackend(filepath)
+    elif storage == "archive":
+        # Imported here, as archive imports this module
+        from archive import SessionArchive
+        return SessionArchive(filepath)
+    raise ValueError("Unknown results storage: %s" % storage)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the PASAT results stores")
+    subparsers = parser.add_subparsers(dest='command')
+    compact_parser = subparsers.add_parser('compact', help="Write an append-only results log as a results CSV file")
+    compact_parser.add_argument('log_filepath')
+    compact_parser.add_argument('csv_filepath')
+    args = parser.parse_args(argv)
+    if args.command == 'compact':
+        AppendOnlyStore(args.log_filepath).compact(args.csv_filepath)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the collector and of the stations sending to it (storage.CollectorBackend)
+"""
+import os, sys, time, random, socket, asyncio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage, collector
+
+def _long_session(n_stimuli):
+    rng = random.Random(0)
+    results = [rng.choice('CIN') for index in range(n_stimuli - 1)]
+    reaction_times = [round(rng.uniform(0.5, 2.5), 3) if result != 'N' else 0 for result in results]
+    stimuli = [rng.randint(1, 9) for index in range(n_stimuli)]
+    empty = {'Addition': [], 'PASAT': []}
+    return dict(player_name='', player_code='P01', session_ids={'Addition': 1, 'PASAT': 1}, modes=['PASAT'],
+                all_results=dict(empty, PASAT=results), all_reaction_times=dict(empty, PASAT=reaction_times),
+                all_onsets=dict(empty, PASAT=[(index * 3.0, index * 3.0 + 0.002) for index in range(n_stimuli)]),
+                all_dispatch_latencies=dict(empty, PASAT=[0.001] * (n_stimuli - 1)),
+                all_stimuli=dict(empty, PASAT=stimuli),
+                all_keystroke_latencies={'Addition': {'first key': [], 'completion': []},
+                                         'PASAT': {'first key': [round(rng.uniform(0.3, 1.5), 6) for result in results],
+                                                   'completion': [round(rng.uniform(0.5, 2.5), 6)
+                                                                  for result in results]}})
+
+def _run(tmp_path, the_collector, sessions):
+    """
+    Sends the sessions from a station to the_collector, and returns the
+    number of sessions still queued at the station
+    """
+    address = "unix:" + str(tmp_path / "collector.sock")
+    def send():
+        station = storage.CollectorBackend(address, "station", str(tmp_path / "outbox"), timeout=10)
+        for session in sessions:
+            station.save_session(**session)
+        station.close()
+        return len(station.queued())
+    async def run():
+        await the_collector.start(address)
+        still_queued = await asyncio.get_running_loop().run_in_executor(None, send)
+        await the_collector.stop()
+        return still_queued
+    return asyncio.run(run())
+
+def test_long_session_is_saved(tmp_path):
+    db_filepath = str(tmp_path / "results.sqlite")
+    the_collector = collector.Collector("sqlite", db_filepath)
+    still_queued = _run(tmp_path, the_collector, [_long_session(1500), _long_session(61)])
+    assert still_queued == 0
+    assert the_collector.n_saved == 2
+    backend = storage.SQLiteBackend(db_filepath)
+    assert backend.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 1499 + 60
+    backend.close()
+
+def test_message_over_the_limit_is_refused(tmp_path):
+    the_collector = collector.Collector("sqlite", str(tmp_path / "results.sqlite"))
+    the_collector.MESSAGE_LIMIT = 64 * 1024
+    # The long session is refused and stays queued, the next one is saved
+    still_queued = _run(tmp_path, the_collector, [_long_session(1500), _long_session(61)])
+    assert still_queued == 1
+    assert the_collector.n_saved == 1
+
+def test_saving_does_not_wait_for_the_collector(tmp_path):
+    # A collector which accepts the connections but never replies
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        station = storage.CollectorBackend("127.0.0.1:%d" % listener.getsockname()[1], "station",
+                                           str(tmp_path / "outbox"), timeout=1)
+        started = time.perf_counter()
+        for index in range(3):
+            station.save_session(**_long_session(61))
+        elapsed = time.perf_counter() - started
+        station.close()
+    assert elapsed < 0.5
+    assert len(station.queued()) == 3
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the results CSV file handlers of helpers
+"""
+import os, sys, csv, stat
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import helpers
+
+# The columns of the results files written before the dispatch latency,
+# onset and keystroke latency columns were added
+BASELINE_FIELDNAMES = ['Player Code', 'Player Name', 'Date', 'Time'] + \
+    [prefix + " " + stat_name for prefix in helpers.PREFIXES
+     for (stat_name, formula) in helpers.RESULTS_FORMULAS + helpers.REACTION_TIME_FORMULAS]
+
+def _write_baseline_file(csv_filepath):
+    row = {fieldname: '' for fieldname in BASELINE_FIELDNAMES}
+    row.update({'Player Code': 'P01', 'Player Name': 'First', 'Date': '2019 September 01', 'Time': '10:00:00 AM',
+                'PASAT correct count': '40', 'PASAT results list': "['C', 'I']",
+                'PASAT reaction times': '[1.2, 0]', 'PASAT mean reaction time': '1.2'})
+    with open(csv_filepath, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, BASELINE_FIELDNAMES, dialect='excel')
+        writer.writeheader()
+        writer.writerow(row)
+
+def _read(csv_filepath):
+    with open(csv_filepath, 'r', newline='') as csvfile:
+        reader = csv.DictReader(csvfile, dialect='excel')
+        return reader.fieldnames, list(reader)
+
+def _update(csv_filepath, player_code):
+    helpers.update_csv(csv_filepath, 'Second', player_code, {'Addition': [], 'PASAT': ['C', 'N', 'C']},
+                       {'Addition': [], 'PASAT': [1.5, 0, 1.1]}, ['PASAT'], {'Addition': 1, 'PASAT': 1})
+
+def test_update_baseline_file_keeps_columns(tmp_path):
+    csv_filepath = str(tmp_path / "results.csv")
+    _write_baseline_file(csv_filepath)
+    _update(csv_filepath, 'P02')
+    fieldnames, rows = _read(csv_filepath)
+    assert fieldnames == helpers.get_fieldnames()
+    assert [row['Player Code'] for row in rows] == ['P01', 'P02']
+    old_row = rows[0]
+    assert old_row['Player Name'] == 'First'
+    assert old_row['PASAT correct count'] == '40'
+    assert old_row['PASAT results list'] == "['C', 'I']"
+    assert old_row['PASAT reaction times'] == '[1.2, 0]'
+    assert old_row['PASAT mean reaction time'] == '1.2'
+    # The new columns are empty for the rows of the earlier version
+    assert old_row['PASAT dispatch latencies'] == ''
+    assert old_row['Addition dispatch latencies'] == ''
+    assert old_row['PASAT onset error mean (ms)'] == ''
+    assert old_row['PASAT first key latencies'] == ''
+    assert rows[1]['PASAT correct count'] == '2'
+
+def test_update_row_of_baseline_file(tmp_path):
+    csv_filepath = str(tmp_path / "results.csv")
+    _write_baseline_file(csv_filepath)
+    _update(csv_filepath, 'P01')
+    fieldnames, rows = _read(csv_filepath)
+    assert len(rows) == 1
+    assert rows[0]['PASAT correct count'] == '2'
+    assert rows[0]['Player Name'] == 'Second'
+
+def test_unknown_columns_are_kept(tmp_path):
+    csv_filepath = str(tmp_path / "results.csv")
+    with open(csv_filepath, 'w', newline='') as csvfile:
+        csvfile.write("Player Code,Notes\r\nP01,left early\r\n")
+    _update(csv_filepath, 'P02')
+    fieldnames, rows = _read(csv_filepath)
+    assert fieldnames[-1] == 'Notes'
+    assert rows[0]['Notes'] == 'left early'
+    assert rows[1]['Notes'] == ''
+
+def test_update_file_without_dispatch_latency_columns(tmp_path):
+    # The columns of the results files written with the onset columns, before
+    # the dispatch latency columns were inserted before them
+    fieldnames = ['Player Code', 'Player Name', 'Date', 'Time'] + \
+        [prefix + " " + stat_name for prefix in helpers.PREFIXES
+         for (stat_name, formula) in helpers.RESULTS_FORMULAS + helpers.REACTION_TIME_FORMULAS +
+                                     helpers.ONSET_FORMULAS]
+    csv_filepath = str(tmp_path / "results.csv")
+    with open(csv_filepath, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames, restval='', dialect='excel')
+        writer.writeheader()
+        writer.writerow({'Player Code': 'P01', 'PASAT mean reaction time': '1.2',
+                         'PASAT onset error mean (ms)': '0.5', 'Addition onset error max (ms)': '2.0'})
+    _update(csv_filepath, 'P02')
+    fieldnames, rows = _read(csv_filepath)
+    assert rows[0]['PASAT mean reaction time'] == '1.2'
+    assert rows[0]['PASAT onset error mean (ms)'] == '0.5'
+    assert rows[0]['Addition onset error max (ms)'] == '2.0'
+    assert rows[0]['PASAT dispatch latencies'] == ''
+    assert rows[0]['PASAT mean dispatch latency'] == ''
+
+def test_update_file_without_keystroke_latency_columns(tmp_path):
+    # The columns of the results files written before the keystroke latency
+    # columns were added to each mode
+    fieldnames = ['Player Code', 'Player Name', 'Date', 'Time'] + \
+        [prefix + " " + stat_name for prefix in helpers.PREFIXES
+         for (stat_name, formula) in helpers.RESULTS_FORMULAS + helpers.REACTION_TIME_FORMULAS +
+                                     helpers.DISPATCH_LATENCY_FORMULAS + helpers.ONSET_FORMULAS]
+    csv_filepath = str(tmp_path / "results.csv")
+    with open(csv_filepath, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames, restval='', dialect='excel')
+        writer.writeheader()
+        writer.writerow({'Player Code': 'P01', 'Addition onset error max (ms)': '2.0',
+                         'PASAT correct count': '40', 'PASAT mean dispatch latency': '0.004'})
+    _update(csv_filepath, 'P02')
+    fieldnames, rows = _read(csv_filepath)
+    assert rows[0]['Addition onset error max (ms)'] == '2.0'
+    assert rows[0]['PASAT correct count'] == '40'
+    assert rows[0]['PASAT mean dispatch latency'] == '0.004'
+    assert rows[0]['Addition first key latencies'] == ''
+    assert rows[0]['PASAT mean completion latency'] == ''
+
+def test_new_file_has_the_default_permissions(tmp_path):
+    csv_filepath = str(tmp_path / "results.csv")
+    umask = os.umask(0o022)
+    try:
+        _update(csv_filepath, 'P01')
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(csv_filepath).st_mode) == 0o644
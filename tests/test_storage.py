@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the results backends of storage
+"""
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage
+
+def _save(backend, player_code, pasat_reaction_times, demo_reaction_times=None):
+    modes = ['PASAT'] if pasat_reaction_times else []
+    all_results = {'Addition': [], 'PASAT': ['C'] * len(pasat_reaction_times)}
+    all_reaction_times = {'Addition': [], 'PASAT': pasat_reaction_times}
+    if demo_reaction_times is not None:
+        modes.insert(0, 'Addition')
+        all_results['Addition'] = ['C'] * len(demo_reaction_times)
+        all_reaction_times['Addition'] = demo_reaction_times
+    # The application passes session number 1 for every session
+    backend.save_session('', player_code, {'Addition': 1, 'PASAT': 1}, modes, all_results, all_reaction_times)
+
+def _sessions(backend):
+    return backend.connection.execute(
+        "SELECT p.code, s.mode, s.session_number, s.mean_reaction_time FROM sessions s "
+        "JOIN participants p ON p.id = s.participant_id ORDER BY p.code, s.mode, s.session_number").fetchall()
+
+def test_sqlite_keeps_the_visits_of_a_returning_participant(tmp_path):
+    backend = storage.SQLiteBackend(str(tmp_path / "results.sqlite"))
+    _save(backend, 'P01', [1.0, 1.0])
+    _save(backend, 'P01', [2.0, 2.0])
+    _save(backend, 'P02', [1.5, 1.5])
+    assert _sessions(backend) == [('P01', 'PASAT', 1, 1.0), ('P01', 'PASAT', 2, 2.0), ('P02', 'PASAT', 1, 1.5)]
+    assert [(number, n_participants) for (number, mean, n_participants)
+            in backend.mean_reaction_time_by_session()] == [(1, 2), (2, 1)]
+    backend.close()
+
+def test_sqlite_saves_a_session_saved_again_once(tmp_path):
+    backend = storage.SQLiteBackend(str(tmp_path / "results.sqlite"))
+    # The demo is saved again with the PASAT
+    _save(backend, 'P01', [], demo_reaction_times=[0.5, 0.7])
+    _save(backend, 'P01', [1.0, 1.2], demo_reaction_times=[0.5, 0.7])
+    _save(backend, 'P01', [1.0, 1.2], demo_reaction_times=[0.5, 0.7])
+    assert [(mode, number) for (code, mode, number, mean) in _sessions(backend)] == \
+        [('Addition', 1), ('PASAT', 1)]
+    assert backend.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 4
+    backend.close()
@@ -5,46 +5,43 @@ Created on Thu Aug 29 17:29:54 2019
 @author: Amin Saberi
 """
 
-import os, sys
 from PyQt5 import QtCore
-from playsound import playsound
-import time
-from multiprocessing import Process
+from timing import StimulusScheduler
+from tracing import NULL_TRACER
 
-def resource_path(relative_path):
+class ScheduledThread(QtCore.QThread):
     """
-    Needed for PyInstaller to find the audio files
+    Base class of the threads which are paced by a timing.StimulusScheduler.
+    Pausing, resuming and stopping are relayed to the scheduler, which blocks
+    the thread (without using CPU) until it is resumed or stopped. Stopping is
+    cooperative: run() returns as soon as the scheduler is stopped.
+    The times emitted by the threads are in seconds of the session clock
+    (self.scheduler.clock), which is also sampled by Window for the timer_label
+    and the reaction times. The waits and the presentation of each stimulus
+    are recorded by tracer (a tracing.Tracer, which records nothing by default).
     """
-    try:
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-
-    return os.path.join(base_path, relative_path)
-
-
-def run_with_limited_time(func, args, kwargs, time):
-    """Runs a function with time limit
-
-    :param func: The function to run
-    :param args: The functions args, given as tuple
-    :param kwargs: The functions keywords, given as dict
-    :param time: The time limit in seconds
-    :return: True if the function ended successfully. False if it was terminated.
+    def __init__(self, interval, clock=None, tracer=None, parent=None):
+        super().__init__()
+        self.interval = interval
+        self.scheduler = StimulusScheduler(interval, clock=clock)
+        self.tracer = tracer if tracer is not None else NULL_TRACER
 
-    This is useful for playsound in Linux. Because in Linux (unlike Windows), playsound goes
-    forever, and stops the next line of code from running
-    """
-    p = Process(target=func, args=args, kwargs=kwargs)
-    p.start()
-    p.join(time)
-    if p.is_alive():
-        p.terminate()
-        return False
+    @property
+    def paused(self):
+        return self.scheduler.paused
+    @paused.setter
+    def paused(self, paused):
+        # Pausing is handled by the scheduler, which shifts the upcoming
+        # onsets by the duration of the pause
+        if paused:
+            self.scheduler.pause()
+        else:
+            self.scheduler.resume()
 
-    return True
+    def stop(self):
+        self.scheduler.stop()
 
-class PlayNumbersThread(QtCore.QThread):
+class PlayNumbersThread(ScheduledThread):
     """
     When "Start" is clicked, this QThread class runs a thread
     simultaneous to the main program. The only argument for this
@@ -52,139 +49,170 @@ class PlayNumbersThread(QtCore.QThread):
     from 1 to 10, which has been constructed in Window.__init__.
     The main objective of this class is to play the sound of each
     number, wait for INTERVAL seconds, and do the same for all the
-    numbers in random_numbers list.
+    numbers in random_numbers list. The sounds are played by the
+    audio_engine (audio.AudioEngine) which has already loaded them.
     """
     # Define the event of playing a new_number, which will
     # emit two variables: the number played and the time it was played
     # (which is used to claculate reaction time)
     new_number = QtCore.pyqtSignal(int, float)
     finished = QtCore.pyqtSignal()
-    def __init__(self, random_numbers, interval, language, parent=None):
+    def __init__(self, random_numbers, interval, language, audio_engine, clock=None, tracer=None, parent=None):
         """
-        Initializes the PlayNumbersThread with random_numbers (list), interval (int)
-        and language ("en"/"fa") as its arguments 
+        Initializes the PlayNumbersThread with random_numbers (list), interval (int),
+        language ("en"/"fa"), audio_engine (audio.AudioEngine), clock (the
+        timing.SessionClock of the session) and tracer (tracing.Tracer) as its arguments 
         """
-        super().__init__()
+        super().__init__(interval, clock, tracer, parent)
         self.random_numbers = random_numbers
         self.language = language
-        self.interval = interval
-        self.paused = False
+        self.audio_engine = audio_engine
+
     def run(self):
         """
         Overwrites QThread.run function which executes the thread. It loops
         through the random_numbers list, tells Window._start about the number
-        that is playing and the time it was played, plays the sound of each number 
-        , (using playsound package, TODO: Use QSound), waits for 3 seconds 
-        (after adjusting for the length of the sound played) and then does 
-        the same for the next number on the list.
+        that is playing and the time it was played, starts playing the sound of
+        each number (without waiting for it to end), and then waits for the
+        onset of the next number on the list. The onsets are planned by
+        self.scheduler every INTERVAL seconds from the start of the thread.
         """
-        for number in self.random_numbers:
-            # Record the time that number has started playing, to calculate
-            # its length, and also to calculate reaction time
-            time_before_playsound = time.time()
-            self.new_number.emit(number, time_before_playsound)
-            run_with_limited_time(playsound,[resource_path(os.path.join("audio", self.language, "{:d}.wav".format(number)))], {}, 1)
-            length = time.time() - time_before_playsound
-            for i in range(round(100*(self.interval-length))):
-                while self.paused:
-                    pass
-                time.sleep(0.01)           
+        for index, number in enumerate(self.random_numbers):
+            # Wait for the planned onset of the number, and record the actual
+            # onset which is also used to calculate reaction time
+            with self.tracer.span("scheduler wait", "scheduler", trial=index):
+                onset = self.scheduler.wait_for_onset(index)
+            if onset is None: # stopped
+                break
+            with self.tracer.span("audio start", "audio", trial=index, number=number) as span:
+                self.audio_engine.play(self.language, number)
+            if self.tracer.enabled:
+                # The end of the playback is planned from the duration of the clip
+                duration_ns = int(self.audio_engine.duration(self.language, number) * 1e9)
+                self.tracer.complete("audio playback", span.start_ns, span.start_ns + duration_ns, "audio",
+                                     trial=index, number=number)
+            self.tracer.instant("new_number emit", "signal", trial=index)
+            self.new_number.emit(number, onset)
+        else:
+            self.scheduler.wait_for_onset(len(self.random_numbers), record=False)
         # This 0 serves as a right-padding and is necessary for the last interval
         # to be calculated when the input is via keyboard 
-        self.new_number.emit(0, time.time())
+        self.new_number.emit(0, self.scheduler.clock.elapsed())
         self.finished.emit()
         
     def stop(self):
-        # This 0 serves as a right-padding and is necessary for the last interval
-        # to be calculated when the input is via keyboard 
-        self.new_number.emit(0, time.time())
-        self.finished.emit()
-        self.terminate()
+        super().stop()
+        self.audio_engine.stop()
 
-class PlayDemoThread(QtCore.QThread):
+class PlayDemoThread(ScheduledThread):
     """
-    When "Start" is clicked, this QThread class runs a thread
+    When "Demo" is clicked, this QThread class runs a thread
     simultaneous to the main program. The only argument for this
-    class is a NUMBERS_PER_TRIAL length list of random numbers 
-    from 1 to 10, which has been constructed in Window.__init__.
-    The main objective of this class is to play the sound of each
-    number, wait for INTERVAL seconds, and do the same for all the
-    numbers in random_numbers list.
+    class is a PAIRS_IN_DEMO length list of pairs of random numbers 
+    from 1 to 10, which has been constructed in Window._start_demo.
+    The main objective of this class is to show each pair, wait for
+    INTERVAL seconds, and do the same for all the pairs in demo_pairs list.
     """
-    # Define the event of playing a new_number, which will
-    # emit two variables: the number played and the time it was played
+    # Define the event of showing a new_pair, which will
+    # emit two variables: the pair shown and the time it was shown
     # (which is used to claculate reaction time)
     new_pair = QtCore.pyqtSignal(tuple, float)
     finished = QtCore.pyqtSignal()
-    def __init__(self, demo_pairs, interval, parent=None):
+    def __init__(self, demo_pairs, interval, clock=None, tracer=None, parent=None):
         """
-        Initializes the PlayNumbersThread with random_numbers (list), interval (int)
-        and language ("en"/"fa") as its arguments 
+        Initializes the PlayDemoThread with demo_pairs (list), interval (int),
+        clock (the timing.SessionClock of the session) and tracer (tracing.Tracer)
+        as its arguments 
         """
-        super().__init__()
+        super().__init__(interval, clock, tracer, parent)
         self.demo_pairs = demo_pairs
-        self.interval = interval
-        self.paused = False
+
     def run(self):
         """
         Overwrites QThread.run function which executes the thread. It loops
-        through the random_numbers list, tells Window._start about the number
-        that is playing and the time it was played, plays the sound of each number 
-        , (using playsound package, TODO: Use QSound), waits for 3 seconds 
-        (after adjusting for the length of the sound played) and then does 
-        the same for the next number on the list.
+        through the demo_pairs list, tells Window._start_demo about the pair
+        that is shown and the time it was shown, and then waits for the onset
+        of the next pair, which is planned by self.scheduler.
         """
-        for pair in self.demo_pairs:
-            # Record the time that number has started playing, to calculate
-            # its length, and also to calculate reaction time
-            time_before_playsound = time.time()
-            self.new_pair.emit(pair, time_before_playsound)
-            for i in range(self.interval*100):
-                while self.paused:
-                    pass
-                time.sleep(0.01)
+        for index, pair in enumerate(self.demo_pairs):
+            # Wait for the planned onset of the pair, and record the actual
+            # onset which is also used to calculate reaction time
+            with self.tracer.span("scheduler wait", "scheduler", trial=index):
+                onset = self.scheduler.wait_for_onset(index)
+            if onset is None: # stopped
+                break
+            self.tracer.instant("new_pair emit", "signal", trial=index)
+            self.new_pair.emit(pair, onset)
+        else:
+            self.scheduler.wait_for_onset(len(self.demo_pairs), record=False)
         # This 0 serves as a right-padding and is necessary for the last interval
         # to be calculated when the input is via keyboard 
-        self.new_pair.emit((0,0), time.time())
-        self.finished.emit()
-        
-    def stop(self):
-        self.new_pair.emit((0,0), time.time())
+        self.new_pair.emit((0,0), self.scheduler.clock.elapsed())
         self.finished.emit()
-        self.terminate()        
 
-            
-class TimerThread(QtCore.QThread):
+class PlayTrackThread(PlayNumbersThread):
     """
-    When "Start" is clicked, this QThread class runs a thread
-    simultaneous to the main program. Its only job is to update
-    the Window.timer_label via Window._update_timer, and has
-    nothing to do with reaction times and dynamics of the program.
-    In fact, it has no communication means with PlayNumbersThread.
-    QTimer was an alternative, but counting time in a thread is more
-    accurate (is it?!).
+    Plays the whole session as one track instead of one sound per number: the
+    random_numbers are rendered by the audio_engine into a single buffer, each
+    at the exact frame of its onset, which is played as one continuous stream.
+    new_number is emitted when the playback position reaches the onset of the
+    number, and the onset is measured by the audio clock, so its error does
+    not depend on when the thread wakes up.
     """
-    # Each 0.1 seconds, TimeThread emits the time_step signal,
-    # which carries the total_time passed to be shown on Window.timer_label
-    time_step = QtCore.pyqtSignal(float)
-    def __init__(self, duration, parent=None):
+    # Seconds between the polls of the playback position near an onset
+    poll_time = 0.0005
+
+    def run(self):
         """
-        Initializes the TimerThread with duration  as its only argument
+        Overwrites PlayNumbersThread.run. The track is rendered, the session
+        clock is started with the playback, and for each number the thread
+        sleeps until shortly before the planned onset (see self.scheduler) and
+        then polls the playback position until it has reached the onset.
         """
-        super().__init__()
-        self.duration = duration
-        self.paused = False
+        track, self.onset_frames = self.audio_engine.render_track(self.language, self.random_numbers, self.interval)
+        self.scheduler.start()
+        self.audio_engine.play_track(track)
+        for index, number in enumerate(self.random_numbers):
+            onset = self.wait_for_frame(index)
+            if onset is None: # stopped
+                break
+            self.scheduler.record_onset(index, onset)
+            self.tracer.instant("new_number emit", "signal", trial=index)
+            self.new_number.emit(number, onset)
+        else:
+            self.wait_for_frame(len(self.random_numbers))
+        # This 0 serves as a right-padding and is necessary for the last interval
+        # to be calculated when the input is via keyboard 
+        self.new_number.emit(0, self.scheduler.clock.elapsed())
+        self.finished.emit()
 
-    def run(self):
+    def wait_for_frame(self, index):
         """
-        Runs the TimerThread. Until reaching the TRIAL_LENGTH, every 0.01 seconds
-        sends a signal to Window._start carrying the total time spent. Which is
-        then used by Window._update_timer to draw it on the screen.
+        Waits until the playback position reaches the onset of number index and
+        returns the time the onset was played in seconds of the session clock,
+        or None if stopped
         """
-        total_time = 0
-        while total_time <= self.duration-0.1:
-            while self.paused:
-                time.sleep(0.1)
-            time.sleep(0.1)
-            total_time+=0.1
-            self.time_step.emit(total_time)
+        with self.tracer.span("scheduler wait", "scheduler", trial=index):
+            onset_frame = self.onset_frames[index]
+            while True:
+                # Sleep on the session clock until the spin time before the
+                # onset, or while paused
+                if self.scheduler.sleep_until_onset(index, spin=False) is None:
+                    return None
+                position, measured_ns = self.audio_engine.position()
+                if position >= onset_frame:
+                    break
+                self.scheduler.clock.source.sleep(self.poll_time)
+        # The time the onset frame was played, from the current position
+        onset_ns = measured_ns - int((position - onset_frame) / self.audio_engine.sample_rate * 1e9)
+        return self.scheduler.clock.to_session_ns(onset_ns) / 1e9
+
+    @ScheduledThread.paused.setter
+    def paused(self, paused):
+        # The track is paused with the session clock
+        if paused:
+            self.audio_engine.pause()
+            self.scheduler.pause()
+        else:
+            self.scheduler.resume()
+            self.audio_engine.resume()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Timing utilities used by the stimulus threads and the Window. All times are
+taken from a clock source: MONOTONIC_CLOCK, i.e. time.perf_counter_ns(), which
+is monotonic and has the highest available resolution, or a VirtualClock which
+advances instantly for simulations and replays (see replay.py).
+"""
+
+import time, math, threading, heapq, itertools
+
+class MonotonicClock:
+    """
+    The real clock source, time.perf_counter_ns()
+    """
+    def now_ns(self):
+        return time.perf_counter_ns()
+
+    def wait(self, condition, timeout_ns=None):
+        """
+        Waits on condition (which must be acquired) until it is notified, or
+        timeout_ns have passed
+        """
+        condition.wait(None if timeout_ns is None else timeout_ns / 1e9)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def spin_until(self, deadline_ns):
+        """
+        Busy-waits until deadline_ns and returns the time
+        """
+        now_ns = time.perf_counter_ns()
+        while now_ns < deadline_ns:
+            now_ns = time.perf_counter_ns()
+        return now_ns
+
+MONOTONIC_CLOCK = MonotonicClock()
+
+class VirtualClock:
+    """
+    A clock source that only advances when it is waited on, and then jumps to
+    the end of the wait instantly. Callbacks can be scheduled at virtual times
+    with call_at; they are called in order, with the clock set to their time,
+    while the clock advances through them.
+    """
+    def __init__(self, start_ns=0):
+        self._now_ns = start_ns
+        self._timers = []
+        self._counter = itertools.count()
+
+    def now_ns(self):
+        return self._now_ns
+
+    def call_at(self, time_ns, callback, *args):
+        heapq.heappush(self._timers, (time_ns, next(self._counter), callback, args))
+
+    def advance_to(self, time_ns):
+        """
+        Advances the clock to time_ns, calling the callbacks scheduled until then
+        """
+        while self._timers and self._timers[0][0] <= time_ns:
+            timer_ns, dummy, callback, args = heapq.heappop(self._timers)
+            self._now_ns = max(self._now_ns, timer_ns)
+            callback(*args)
+        self._now_ns = max(self._now_ns, time_ns)
+
+    def wait(self, condition, timeout_ns=None):
+        if timeout_ns is None:
+            # Nothing else can advance the clock, so wait for a real notification
+            condition.wait()
+        else:
+            self.advance_to(self._now_ns + timeout_ns)
+
+    def sleep(self, seconds):
+        self.advance_to(self._now_ns + int(seconds * 1e9))
+
+    def spin_until(self, deadline_ns):
+        self.advance_to(deadline_ns)
+        return self._now_ns
+
+class SessionClock:
+    """
+    The single time base of a session. Its elapsed time starts at 0 when the
+    session is started and does not advance while the session is paused. The
+    stimulus onsets, the reaction times and the timer_label all use it.
+    """
+    def __init__(self, source=None):
+        """
+        Initializes the clock with its source (MONOTONIC_CLOCK by default)
+        """
+        self.source = source if source is not None else MONOTONIC_CLOCK
+        self.origin_ns = None
+        self.paused_ns = 0
+        self.pause_started_ns = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        return self.origin_ns is not None
+
+    @property
+    def paused(self):
+        return self.pause_started_ns is not None
+
+    def start(self):
+        """
+        Takes the origin of the clock. Returns it in nanoseconds.
+        """
+        with self._lock:
+            self.origin_ns = self.source.now_ns()
+            self.paused_ns = 0
+            self.pause_started_ns = None
+        return self.origin_ns
+
+    def pause(self):
+        with self._lock:
+            if self.pause_started_ns is None:
+                self.pause_started_ns = self.source.now_ns()
+
+    def resume(self):
+        with self._lock:
+            if self.pause_started_ns is not None:
+                self.paused_ns += self.source.now_ns() - self.pause_started_ns
+                self.pause_started_ns = None
+
+    def to_session_ns(self, perf_counter_ns):
+        """
+        Converts a time of the source (e.g. time.perf_counter_ns()) to the elapsed
+        time of the session
+        """
+        return perf_counter_ns - self.origin_ns - self.paused_ns
+
+    def to_perf_counter_ns(self, session_ns):
+        """
+        Converts an elapsed time of the session to a time of the source, assuming that the session is not paused until then
+        """
+        return self.origin_ns + self.paused_ns + session_ns
+
+    def elapsed_ns(self):
+        """
+        Returns the elapsed time of the session in nanoseconds (0 if not started)
+        """
+        with self._lock:
+            if self.origin_ns is None:
+                return 0
+            if self.pause_started_ns is not None:
+                return self.to_session_ns(self.pause_started_ns)
+            return self.to_session_ns(self.source.now_ns())
+
+    def elapsed(self):
+        """
+        Returns the elapsed time of the session in seconds (0 if not started)
+        """
+        return self.elapsed_ns() / 1e9
+
+class StimulusScheduler:
+    """
+    Paces the stimuli at a fixed interval without drifting. The onset of the
+    stimulus number index is planned at index * interval on the session clock
+    (a SessionClock, which is started once with the scheduler), so the errors
+    of sleeping do not add up from one stimulus to the next. The scheduler
+    sleeps until shortly before each deadline and spin-waits for the remaining time.
+    Sleeping, pausing and stopping are built on a condition variable, so a
+    paused scheduler uses no CPU and wakes up as soon as it is resumed or stopped.
+    The planned and actual onsets of every stimulus are recorded (in seconds
+    of the session clock) so that the jitter can be reported with the results.
+    """
+    def __init__(self, interval, spin_time=0.002, clock=None):
+        """
+        Initializes the scheduler with interval (seconds), spin_time (seconds
+        before each deadline that are spin-waited instead of slept) and clock
+        (the SessionClock of the session, a new one by default)
+        """
+        self.interval_ns = int(round(interval * 1e9))
+        self.spin_ns = int(spin_time * 1e9)
+        self.clock = clock if clock is not None else SessionClock()
+        self.stopped = False
+        self._condition = threading.Condition()
+        self.planned_onsets = []
+        self.actual_onsets = []
+
+    @property
+    def paused(self):
+        return self.clock.paused
+
+    def start(self):
+        """
+        Starts the session clock. Returns its origin in nanoseconds.
+        """
+        return self.clock.start()
+
+    def deadline(self, index):
+        """
+        Returns the planned onset of stimulus number index (ns, on the clock source)
+        """
+        return self.clock.to_perf_counter_ns(index * self.interval_ns)
+
+    def pause(self):
+        with self._condition:
+            self.clock.pause()
+            self._condition.notify_all()
+
+    def resume(self):
+        """
+        Resumes the schedule. As the session clock does not advance while paused,
+        all the upcoming deadlines are shifted by the duration of the pause.
+        """
+        with self._condition:
+            self.clock.resume()
+            self._condition.notify_all()
+
+    def stop(self):
+        """
+        Stops the schedule. Any ongoing or later wait returns None immediately.
+        """
+        with self._condition:
+            self.stopped = True
+            self._condition.notify_all()
+
+    def sleep_until_onset(self, index, spin=True):
+        """
+        Sleeps until the planned onset of stimulus number index, which is shifted
+        forward if the scheduler is paused in the meantime, and returns the
+        actual time in ns. Returns None if the scheduler is stopped. If spin is
+        False, returns spin_time before the onset instead of spin-waiting.
+        """
+        with self._condition:
+            while not self.stopped:
+                if self.paused:
+                    self.clock.source.wait(self._condition)
+                    continue
+                remaining_ns = self.deadline(index) - self.clock.source.now_ns()
+                if remaining_ns <= self.spin_ns:
+                    break
+                self.clock.source.wait(self._condition, remaining_ns - self.spin_ns)
+            if self.stopped:
+                return None
+            deadline_ns = self.deadline(index)
+        if not spin:
+            return self.clock.source.now_ns()
+        # Spin for the last part, as sleeping can overshoot by more than a millisecond
+        return self.clock.source.spin_until(deadline_ns)
+
+    def wait_for_onset(self, index, record=True):
+        """
+        Waits until the onset of stimulus number index and records it (unless
+        record is False). Returns the actual onset in seconds of the session clock,
+        or None if the scheduler has been stopped.
+        """
+        if not self.clock.started:
+            self.start()
+        actual_ns = self.sleep_until_onset(index)
+        if actual_ns is None:
+            return None
+        actual_onset = self.clock.to_session_ns(actual_ns) / 1e9
+        if record:
+            self.record_onset(index, actual_onset)
+        return actual_onset
+
+    def record_onset(self, index, actual_onset):
+        """
+        Records the actual onset (seconds of the session clock) of stimulus number
+        index, e.g. when it is measured by another clock (see threads.PlayTrackThread)
+        """
+        self.planned_onsets.append(index * self.interval_ns / 1e9)
+        self.actual_onsets.append(actual_onset)
+
+    def onsets(self):
+        """
+        Returns a list of (planned, actual) onsets in seconds of the session clock
+        """
+        return list(zip(self.planned_onsets, self.actual_onsets))
+
+def onset_errors(onsets):
+    """
+    Returns the onset errors (actual - planned) in milliseconds
+    """
+    return [1000 * (actual - planned) for (planned, actual) in onsets]
+
+def jitter_stats(onsets):
+    """
+    Returns the mean, standard deviation and maximum absolute value of the
+    onset errors (ms). Returns Nones if there are no onsets.
+    """
+    errors = onset_errors(onsets)
+    if not errors:
+        return None, None, None
+    mean = sum(errors) / len(errors)
+    sd = math.sqrt(sum((error - mean)**2 for error in errors) / len(errors))
+    return mean, sd, max(abs(error) for error in errors)
+
+class EventTimestampMapper:
+    """
+    Maps the timestamps of Qt input events (QInputEvent.timestamp(), which are
+    milliseconds on the clock of the windowing system) onto the source of a
+    SessionClock (time.perf_counter_ns() by default), and from there onto the
+    SessionClock. The offset between the two clocks
+    is estimated as the smallest difference seen so far between the time an
+    event is handled and its timestamp, i.e. the event that was dispatched the
+    fastest is assumed to have had no delay.
+    """
+    def __init__(self):
+        self.offset_ns = None
+
+    def map(self, timestamp, clock):
+        """
+        Returns the time of the event with the timestamp (ms) in seconds of the clock
+        (a SessionClock), and the delay between the event and its handling in seconds
+        (the event-loop dispatch latency). Some platforms do not timestamp the events
+        (timestamp is 0), then the handling time and None are returned.
+        """
+        handled_ns = clock.source.now_ns()
+        if not timestamp:
+            return clock.to_session_ns(handled_ns) / 1e9, None
+        offset_ns = handled_ns - timestamp * 1000000
+        if self.offset_ns is None or offset_ns < self.offset_ns:
+            self.offset_ns = offset_ns
+        event_ns = timestamp * 1000000 + self.offset_ns
+        return clock.to_session_ns(event_ns) / 1e9, (handled_ns - event_ns) / 1e9
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in tracing of the latencies of every trial (see TRACE_DIR in main.py).
+A Tracer records timestamped spans, e.g. the scheduler waking up, the audio
+starting and playing, the signals reaching Window, the GUI updates and the
+responses, from any thread. save() writes them in the Chrome trace event
+format, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+When tracing is off, NULL_TRACER is used, which records nothing.
+"""
+
+import os, json, time, threading
+
+class _Span:
+    """
+    Context manager returned by Tracer.span, which records a complete event
+    from its entering to its exit
+    """
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start_ns')
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.start_ns, category=self.category, **self.args)
+
+class Tracer:
+    """
+    Records the events of a session in memory. All the timestamps are
+    time.perf_counter_ns() values, the source of the timing.SessionClock, so
+    the session clock can be converted to them with to_perf_counter_ns.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self._thread_names = {}
+        self._lock = threading.Lock()
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event['pid'] = self.pid
+        event['tid'] = thread.ident
+        with self._lock:
+            if thread.ident not in self._thread_names:
+                self._thread_names[thread.ident] = thread.name
+            self.events.append(event)
+
+    def span(self, name, category='', **args):
+        """
+        Returns a context manager which records the time spent in it, e.g.
+        with tracer.span("gui update", "gui", trial=index): ...
+        """
+        return _Span(self, name, category, args)
+
+    def complete(self, name, start_ns, end_ns=None, category='', **args):
+        """
+        Records a span from start_ns until end_ns (now by default)
+        """
+        if end_ns is None:
+            end_ns = time.perf_counter_ns()
+        self._add({'name': name, 'cat': category, 'ph': 'X', 'ts': start_ns / 1000,
+                   'dur': (end_ns - start_ns) / 1000, 'args': args})
+
+    def instant(self, name, category='', time_ns=None, **args):
+        """
+        Records an event without duration at time_ns (now by default)
+        """
+        if time_ns is None:
+            time_ns = time.perf_counter_ns()
+        self._add({'name': name, 'cat': category, 'ph': 'i', 's': 't', 'ts': time_ns / 1000, 'args': args})
+
+    def save(self, filepath):
+        """
+        Writes the events as a Chrome trace JSON file
+        """
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self._thread_names)
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                   for (tid, name) in thread_names.items()]
+        with open(filepath, 'w', encoding='utf-8') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+class _NullSpan:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        pass
+
+class NullTracer(Tracer):
+    """
+    A tracer which records nothing
+    """
+    enabled = False
+    _null_span = _NullSpan()
+
+    def span(self, name, category='', **args):
+        return self._null_span
+    def complete(self, name, start_ns, end_ns=None, category='', **args):
+        pass
+    def instant(self, name, category='', time_ns=None, **args):
+        pass
+    def save(self, filepath):
+        pass
+
+NULL_TRACER = NullTracer()